@@ -1,10 +1,53 @@
 import curses
-from time import time, sleep
-from os import environ, listdir, getcwd
+import argparse
+import locale
+from math import ceil
+from time import monotonic, monotonic_ns, sleep
+from os import environ
 import helpers
+import replay
+import history
+import widths
+from stats import TypingStats
+from render import Renderer
+from perf import FrameProfiler
 
 
-def main(window):
+# Default maximum number of screen redraws per second
+DEFAULT_FRAME_CAP = 60
+
+# Test length used until another is chosen
+DEFAULT_TEST_MODE = ("time", 30)
+
+
+def game_mode(opponent, test_mode):
+    ''' Returns the test length of a game, races are as long as the
+    server says and recorded sessions as long as they were played'''
+
+    if opponent == None:
+        return test_mode
+    if opponent.mode == "race":
+        return ("time", opponent.duration)
+    return opponent.test_mode
+
+
+def prepare_prompt(prompt_layout, test_mode, text_start_y, racing=False):
+    ''' Cuts a prompt to the test's number of words, and shows
+    as many of its rows at a time as fit on screen'''
+
+    word_limit = test_mode[1] if test_mode[0] == "words" else None
+    if word_limit != prompt_layout.word_limit:
+        prompt_layout = prompt_layout.limit_words(word_limit)
+    prompt_layout.set_rows(helpers.prompt_rows(text_start_y, racing))
+
+    # Have the prompt ready for common terminal sizes in case of a resize
+    prompt_layout.precompute(helpers.prompt_width(columns)
+                             for columns in helpers.COMMON_COLUMNS)
+    return prompt_layout
+
+
+def main(window, frame_cap=DEFAULT_FRAME_CAP, trace_file=None,
+         test_mode=DEFAULT_TEST_MODE):
     ''' Main app function, a typing speed game'''
 
     # Calculate window sizes to start game
@@ -13,174 +56,415 @@ def main(window):
     text_start_x = window_sizes[1]
     text_start_y = window_sizes[2]
 
-    # Generate all Curser colours to be used in the app
-    curses.start_color()
-    curses.use_default_colors()
-    for i in range(0, curses.COLORS):
-        curses.init_pair(i, i, -1)
+    # Generate the Curses colours used in the app
+    helpers.init_colours()
 
-    # If the scores file doesn't exist, create one
-    if "scores.txt" not in listdir(getcwd()):
-        with open("scores.txt", "w") as f:
-            pass
+    # Ask user for menu choice, return a typing prompt and the recorded
+    # session to race or replay or the live race, if one was chosen
+    prompt_layout, opponent = helpers.menu(window, text_start_x,
+                                           text_start_y, max_width)
+
+    # Length of this game, chosen with 'left'/'right' before it starts
+    mode = game_mode(opponent, test_mode)
+    prompt_layout = prepare_prompt(prompt_layout, mode, text_start_y,
+                                   opponent != None and opponent.mode == "race")
 
-    # Ask user for menu choice, return a typing prompt
-    typing_prompt_wrapped = helpers.menu(window, text_start_x,
-                                         text_start_y, max_width)
+    # Frame timings for the performance HUD and trace file
+    profiler = FrameProfiler(trace_file)
 
     # Booleans for checking if game has started and ended
     start = None
     finished_typing = False
 
+    # Boolean for an endless test the user has ended with 'enter'
+    end_requested = False
+
     # Boolean for the difficulty setting, False = easy, True = hard
     hard_mode = False
 
-    # Boolean for detect if a user pressed a key
-    typed = False
-
     # Variable to store user input
     user_typed_string = ""
 
-    # Variable to store wpm each time a user types
-    # something, used by the consistency function
-    wpm_values = []
+    # Running wpm, accuracy and consistency for the current prompt
+    stats = TypingStats(prompt_layout.text)
+
+    # Draws the game screen, only sending changes to the terminal
+    renderer = Renderer(window)
+    renderer.invalidate()
+
+    # Number of typed characters on screen, None to redraw the whole prompt
+    drawn_length = None
+
+    # Position of the ghost cursor on screen
+    drawn_ghost = None
+
+    # Time the screen was last drawn, used to enforce the frame cap
+    last_frame = 0
+
+    # Boolean for a redraw that is waiting on the frame cap,
+    # starts True so the game screen is drawn straight away
+    redraw_pending = True
 
     # Loop to get user input
     while helpers.check_valid_terminal():
 
+        # Booleans for watching a replay rather than typing,
+        # and for racing other players
+        replaying = opponent != None and opponent.mode == "replay"
+        racing = opponent != None and opponent.mode == "race"
+
         # Set cursor visibility so user can see where they are typing
         curses.curs_set(1)
 
-        # Update delay so that program isn't waiting on user input
-        window.nodelay(True)
-
-        # Calculate window sizes in while loop so terminal window is adaptive
+        # Block on input until a key is pressed, the countdown ticks
+        # over, a ghost or replay keystroke or race update is due or
+        # a capped frame is due to be drawn
+        next_event = None
+        if opponent != None:
+            next_event = opponent.next_event_ms(monotonic_ns())
+        window.timeout(helpers.get_input_timeout(start, last_frame,
+                                                 redraw_pending, frame_cap,
+                                                 monotonic(), next_event))
+
+        # Get window sizes in while loop so terminal window is adaptive,
+        # they are cached so this only reads the terminal after a resize
         window_sizes = helpers.get_window_sizes()
         max_width = window_sizes[0]
         text_start_x = window_sizes[1]
         text_start_y = window_sizes[2]
 
-        # Get user input
-        key = window.getch()
+        # Get user input, and the time it was pressed, any
+        # character comes back as a string
+        key = helpers.get_key(window)
+        key_time = monotonic_ns()
+        if key != -1:
+            profiler.key(key_time)
+
+        # A race starts for everyone at once, not at the first key
+        if racing and start == None and opponent.started(monotonic()):
+            start = opponent.start_time
+            stats.begin(int(start * 1e9))
 
         # Check user input
         if key == 9:  # If 'tab', change difficulty mode
-            if start != None:
+            if start != None or replaying:
                 continue
             # Flip difficulty
             hard_mode = not hard_mode
         if helpers.check_esc(key):  # If 'esc', return to menu
+            if racing:
+                opponent.close()
             # Clear user typed string
             user_typed_string = ""
             # Reset timer and finished typing
             start = None
             finished_typing = False
+            end_requested = False
             # Return to menu
-            typing_prompt_wrapped = helpers.menu(window, text_start_x,
-                                                 text_start_y, max_width)
+            prompt_layout, opponent = helpers.menu(window, text_start_x,
+                                                   text_start_y, max_width)
+            mode = game_mode(opponent, test_mode)
+            prompt_layout = prepare_prompt(
+                prompt_layout, mode, text_start_y,
+                opponent != None and opponent.mode == "race")
+            stats = TypingStats(prompt_layout.text)
+            # Draw the whole game screen without waiting for a key
+            renderer.invalidate()
+            drawn_length = None
+            redraw_pending = True
             continue
-        elif helpers.check_ascii_input(key):  # If key ascii
-            # Check if first input, start typing timer
-            if len(user_typed_string) == 0:
-                # started = True
-                start = time()
-            user_typed_string += chr(key)
-            typed = True
+        elif helpers.check_hud_key(key):  # If 'F2', show or hide the HUD
+            profiler.toggle()
+            renderer.invalidate()
+            drawn_length = None
+        elif helpers.check_resize(key):  # If terminal resized, redraw it all
+            if not helpers.check_valid_terminal():
+                continue
+            window_sizes = helpers.get_window_sizes()
+            max_width = window_sizes[0]
+            text_start_x = window_sizes[1]
+            text_start_y = window_sizes[2]
+            # Re-wrap the prompt to the new width, keeping typed input,
+            # and show as many rows as now fit
+            prompt_layout = prompt_layout.reflow(max_width)
+            prompt_layout.set_rows(helpers.prompt_rows(text_start_y, racing))
+            renderer.invalidate()
+            drawn_length = None
+        elif replaying and key in (curses.KEY_LEFT, curses.KEY_RIGHT):
+            # Change the replay speed, 'left' for slower
+            speed = replay.SPEEDS.index(opponent.speed)
+            if key == curses.KEY_LEFT:
+                speed = max(0, speed - 1)
+            else:
+                speed = min(len(replay.SPEEDS) - 1, speed + 1)
+            opponent.set_speed(replay.SPEEDS[speed], key_time)
+        elif replaying:  # Typing, backspace and enter do nothing in a replay
+            pass
+        elif (key in (curses.KEY_LEFT, curses.KEY_RIGHT) and start == None
+              and opponent == None):
+            # Change the length of the test before it starts
+            test_mode = helpers.next_test_mode(
+                test_mode, -1 if key == curses.KEY_LEFT else 1)
+            mode = test_mode
+            prompt_layout = prepare_prompt(prompt_layout, mode, text_start_y)
+            stats = TypingStats(prompt_layout.text)
+            renderer.invalidate()
+            drawn_length = None
+        elif helpers.check_enter_input(key):  # If 'enter', end endless test
+            if mode[0] == "endless" and start != None:
+                end_requested = True
+        elif helpers.check_text_input(key):  # If key is a character
+            # In a race, typing waits for the countdown
+            if racing and start == None:
+                continue
+            # An accent typed after its letter is combined with it,
+            # as prompts have their accents combined
+            composed = None
+            if len(user_typed_string) > prompt_layout.start():
+                composed = widths.compose(user_typed_string[-1], key)
+            if composed != None and stats.backspace(key_time):
+                user_typed_string = user_typed_string[:-1]
+                key = composed
+            typed = stats.add_char(key, key_time)
+            profiler.add_stats_time(monotonic_ns() - key_time)
+            if typed:
+                user_typed_string += key
+                # Check if first input, start typing timer
+                if start == None:
+                    start = key_time / 1e9
         elif helpers.check_backspace(key):  # If 'backspace', delete
-            # Hard mode prevents user from using backspace
-            if hard_mode:
+            # Hard mode prevents user from using backspace, and
+            # rows that have scrolled well off screen can't be changed
+            if hard_mode or len(user_typed_string) <= prompt_layout.start():
                 continue
-            if len(user_typed_string) > 0:
+            # The whole grapheme goes, like a letter and its accents
+            grapheme = max(prompt_layout.grapheme_start(
+                len(user_typed_string) - 1), prompt_layout.start())
+            while len(user_typed_string) > grapheme and stats.backspace(
+                    key_time):
                 user_typed_string = user_typed_string[:-1]
-
-        # Map the user input text to the wrapped prompt
-        user_typed_wrapped = helpers.wrap_user_input(user_typed_string,
-                                                     typing_prompt_wrapped)
+        # If keys arrive faster than the frame cap, hold
+        # the redraw until the current frame has elapsed
+        if key != -1 and monotonic() - last_frame < 1 / frame_cap:
+            redraw_pending = True
+            continue
+        redraw_pending = False
+        last_frame = monotonic()
+        profiler.start_frame(monotonic_ns())
+
+        # Play a replay up to now, showing its typing as the user's
+        if replaying:
+            if not opponent.started():
+                opponent.start(monotonic_ns())
+            opponent.seek(opponent.log_time(monotonic_ns()))
+            user_typed_string = opponent.typed_text()
+            stats = opponent.stats
+
+        # Add more words to a growing prompt as the user nears its end,
+        # and scroll to the row being typed, which redraws every row
+        added = prompt_layout.fill(len(user_typed_string),
+                                   prompt_layout.width * 3)
+        if added:
+            stats.extend(added)
+            drawn_length = None
+        if prompt_layout.scroll_to(len(user_typed_string)):
+            drawn_length = None
 
         # Boolean variable to see if user has
         # typed the full length of the prompt
-        finished_typing = (len(''.join(user_typed_wrapped)) ==
-                           len(''.join(typing_prompt_wrapped)))
-
-        # Clear screen so new text can be drawn
-        window.erase()
+        finished_typing = stats.finished() and prompt_layout.complete()
 
         # Draw directions to screen
-        window.addstr(
+        renderer.draw(
             0, 0, "Press 'esc' to return to menu - score will not be saved",
             curses.color_pair(39))
 
         # Display difficulty mode
-        if hard_mode:
-            window.addstr(
+        if replaying:
+            renderer.draw(
+                1, 0, f"Replay at {opponent.speed}x "
+                "('left'/'right' to change speed)", curses.color_pair(208))
+        elif hard_mode:
+            renderer.draw(
                 1, 0, "Difficulty: HARD / No backspaces('tab' to change)",
                 curses.color_pair(13))
         else:
-            window.addstr(1, 0, "Difficulty: EASY ('tab' to change)",
+            renderer.draw(1, 0, "Difficulty: EASY ('tab' to change)",
                           curses.color_pair(39))
 
+        # The ghost starts when the user starts typing
+        ghost = None
+        if opponent != None and opponent.mode == "ghost":
+            if start != None and not opponent.started():
+                opponent.start(stats.log.times[0])
+            ghost_time = opponent.log_time(monotonic_ns())
+            opponent.seek(ghost_time)
+            ghost = len(opponent.typed)
+            # Rows the ghost has left behind may have been dropped
+            if ghost < prompt_layout.start():
+                ghost = None
+            if opponent.started():
+                renderer.draw(text_start_y - 4, text_start_x,
+                              f"Ghost WPM: {opponent.wpm(ghost_time)[0]}",
+                              curses.color_pair(13))
+            else:
+                renderer.draw(text_start_y - 4, text_start_x,
+                              "Racing your ghost, it starts when you do!",
+                              curses.color_pair(13))
+
+        if replaying:
+            # Show how far through the replay is, then its statistics
+            replay_time = opponent.log_time(monotonic_ns())
+            if opponent.finished():
+                renderer.draw(text_start_y - 3, text_start_x,
+                              "Replay finished, press 'esc' to return "
+                              "to menu", curses.color_pair(208))
+            else:
+                renderer.draw(text_start_y - 3, text_start_x,
+                              f"Replay time: {int(replay_time / 1e9)}",
+                              curses.color_pair(208))
+            wpm = opponent.wpm(replay_time)
+            renderer.draw(text_start_y - 2, text_start_x,
+                          f"Total WPM: {wpm[0]}, "
+                          f"Consistency: {stats.consistency()}%",
+                          curses.color_pair(39))
         # Show game and stats once user starts typing
-        if start != None:
-            # Print countdown timer
-            countdown = str(30 - (int(time() - start)))
-            window.addstr(text_start_y - 3, text_start_x,
-                          f"Time remaining: {countdown}",
+        elif start != None:
+            # Print countdown timer, words left or time so far
+            now = monotonic_ns()
+            elapsed = stats.elapsed(now)
+            kind, amount = mode
+            time_up = False
+            if kind == "time":
+                countdown = max(0, amount - int(elapsed))
+                progress = f"Time remaining: {countdown}"
+                time_up = elapsed >= amount
+            elif kind == "words":
+                words = prompt_layout.words_left(len(user_typed_string))
+                progress = f"Words remaining: {words}"
+            else:
+                minutes, seconds = divmod(int(elapsed), 60)
+                progress = (f"Time: {minutes}:{seconds:02} "
+                            "('enter' to finish)")
+            renderer.draw(text_start_y - 3, text_start_x, progress,
                           curses.color_pair(208))
 
-            # Calculate wpm and accuracy
-            wpm = helpers.calculate_wpm(''.join(typing_prompt_wrapped),
-                                        ''.join(user_typed_wrapped),
-                                        31 - int(countdown))
-
-            # Store wpm value each time user types a char
-            # so consistency value can be computed
-            if typed == True:
-                wpm_values.append(wpm[1])
-                typed = False
+            # Statistics are measured up to the end of the test, or
+            # the last keystroke if the whole prompt has been typed
+            # or an endless test was ended
+            if finished_typing or end_requested:
+                now = stats.last_key_time()
+            elif time_up:
+                now = stats.start_time() + amount * 10**9
 
-            # Calculate consistency
-            consistency = helpers.measure_consistency(wpm_values)
+            # Calculate wpm, accuracy and consistency
+            stats_start = monotonic_ns()
+            wpm = stats.wpm_at(now)
+            consistency = stats.consistency()
+            profiler.add_stats_time(monotonic_ns() - stats_start)
 
             # Print statistics live
-            window.addstr(text_start_y - 2, text_start_x,
+            renderer.draw(text_start_y - 2, text_start_x,
                           f"Total WPM: {wpm[0]}, Consistency: {consistency}%",
                           curses.color_pair(39))
 
+            # Tell the other racers how far through the prompt the user is
+            if racing:
+                opponent.send_progress(stats.typed, wpm[0],
+                                       time_up or finished_typing)
+
             # Check if game time is finished or user has finished typing
-            if int(countdown) == 0 or finished_typing:
+            if time_up or finished_typing or end_requested:
+                # Keep the session so it can be raced or replayed, add
+                # its keystrokes to the key speed heatmap and its
+                # results to the history
+                if stats.started():
+                    replay.save_session(stats.prompt, stats.log,
+                                        wpm[1], wpm[2], consistency,
+                                        hard_mode, mode)
+                    # numpy is slow to import, so only load it when needed
+                    import keystats
+                    keystats.record_session(stats.prompt, stats.log)
+                    history.record_session(stats, now, helpers.prompt_source,
+                                           hard_mode, mode)
+
                 # Generate final screen with stats
                 restart = helpers.final_screen(window, consistency,
                                                wpm[1], wpm[2], hard_mode,
                                                text_start_x, text_start_y)
                 if restart == 1:
+                    if racing:
+                        opponent.close()
                     # Clear user typed string
                     user_typed_string = ""
                     # Reset timer and finished typing
                     start = None
                     finished_typing = False
+                    end_requested = False
                     # Erase screen
                     window.erase()
                     # Return to menu
-                    typing_prompt_wrapped = helpers.menu(
+                    prompt_layout, opponent = helpers.menu(
                         window, text_start_x, text_start_y, max_width)
+                    mode = game_mode(opponent, test_mode)
+                    prompt_layout = prepare_prompt(
+                        prompt_layout, mode, text_start_y,
+                        opponent != None and opponent.mode == "race")
+                    stats = TypingStats(prompt_layout.text)
+                    # Draw the whole game screen without waiting for a key
+                    renderer.invalidate()
+                    drawn_length = None
+                    redraw_pending = True
                     continue
-        else:
-            # Print start game prompt
-            window.addstr(text_start_y - 3, text_start_x,
-                          f"Start typing to begin the 30 second timer!",
+        elif racing:
+            # Count down to the start of the race
+            renderer.draw(text_start_y - 3, text_start_x,
+                          "Race starts in "
+                          f"{ceil(opponent.start_time - monotonic())}...",
                           curses.color_pair(208))
+        else:
+            # Print start game prompt, with the length of the test
+            if opponent == None:
+                renderer.draw(text_start_y - 3, text_start_x,
+                              "Start typing to begin the "
+                              f"{helpers.test_mode_text(mode)}! "
+                              "('left'/'right' to change)",
+                              curses.color_pair(208))
+            else:
+                renderer.draw(text_start_y - 3, text_start_x,
+                              "Start typing to begin the "
+                              f"{helpers.test_mode_text(mode)}!",
+                              curses.color_pair(208))
 
         # Draw typing test on screen
-        helpers.print_typing_text(window, typing_prompt_wrapped,
-                                  user_typed_wrapped,
-                                  text_start_x, text_start_y)
-
-        # Position cursor at start of typing prompt
-        if start == None:
-            window.move(text_start_y, text_start_x)
-
-        # Refresh display with new content
-        window.refresh()
+        helpers.print_typing_text(renderer, prompt_layout,
+                                  user_typed_string,
+                                  text_start_x, text_start_y, drawn_length,
+                                  ghost, drawn_ghost)
+        drawn_length = len(user_typed_string)
+        drawn_ghost = ghost
+
+        # Show every racer's progress under the prompt
+        if racing:
+            board_y = (text_start_y + len(prompt_layout.visible_rows())
+                       + 1)
+            helpers.print_race_board(
+                renderer, opponent.standings(), len(prompt_layout.text),
+                opponent.name, text_start_x, board_y,
+                helpers.get_terminal_dimensions()[1] - board_y - 1)
+
+        # Position cursor where the user is typing
+        cursor = prompt_layout.locate(len(user_typed_string))
+
+        # Show the timings of the last frame along the bottom row
+        if profiler.visible:
+            renderer.draw(helpers.get_terminal_dimensions()[1] - 1, 0,
+                          profiler.hud_text(), curses.color_pair(77))
+
+        # Send the changes to the terminal
+        renderer.flush(text_start_y + cursor[0] - prompt_layout.top,
+                       text_start_x + prompt_layout.display_column(*cursor))
+        profiler.end_frame(monotonic_ns(), renderer.take_calls())
 
     helpers.quick_print(window, text_start_x, text_start_y,
                         "Terminal window too small - closing app",
@@ -193,9 +477,56 @@ if __name__ == "__main__":
     # Sets delay on escape key to 25 milliseconds
     environ.setdefault("ESCDELAY", "25")
 
+    # Use the terminal's encoding, so curses reads and draws any
+    # language's characters rather than single bytes
+    locale.setlocale(locale.LC_ALL, "")
+
+    # Read command line options
+    parser = argparse.ArgumentParser(description="Typing Wizard")
+    parser.add_argument("--fps", type=int, default=DEFAULT_FRAME_CAP,
+                        help="maximum number of screen redraws per second")
+    parser.add_argument("--passage-words", type=int, default=50,
+                        help="number of words in a prompt typed from a file")
+    parser.add_argument("--sequential", action="store_true",
+                        help="type a file in order instead of from a "
+                        "random sentence")
+    parser.add_argument("--race", default=None,
+                        help="race server to join, host:port or "
+                        "unix:/path/to/socket")
+    parser.add_argument("--name", default=None,
+                        help="name to race other players as")
+    parser.add_argument("--trace", default=None,
+                        help="file to write frame timings to, in Chrome's "
+                        "trace format")
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument("--duration", type=int, default=None,
+                        help="length of a test in seconds")
+    length.add_argument("--words", type=int, default=None,
+                        help="number of words typed in a test, untimed")
+    length.add_argument("--endless", action="store_true",
+                        help="keep typing until 'enter' is pressed")
+    args = parser.parse_args()
+
+    # Set the length of a test, it can still be changed before each test
+    test_mode = DEFAULT_TEST_MODE
+    if args.duration != None:
+        test_mode = ("time", max(1, args.duration))
+    elif args.words != None:
+        test_mode = ("words", max(1, args.words))
+    elif args.endless:
+        test_mode = ("endless", None)
+
+    # Set how prompts are picked from files
+    helpers.passage_words = max(1, args.passage_words)
+    helpers.sequential_passages = args.sequential
+
+    # Set where races are joined and the name to race as
+    helpers.race_address = args.race
+    helpers.race_name = args.name or environ.get("USER")
+
     # Checks terminal is a valid size
     if helpers.check_valid_terminal():
         # Calls the main function
-        curses.wrapper(main)
+        curses.wrapper(main, max(1, args.fps), args.trace, test_mode)
     else:
         print("Terminal must be at least 20 lines high and 80 characters wide")
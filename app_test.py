@@ -1,45 +1,45 @@
 import helpers
+import benchmark
+import corpus
+import passages
+import practice
+import race
+import replay
+import score_store
+import scoring
+import widths
+import curses
+import asyncio
+import json
+import keystats
+import history
+import http_cache
+import network
+import tempfile
+import textwrap
+import threading
+import time
 import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, path, utime
+from random import Random
+from stats import TypingStats, KeystrokeLog, BACKSPACE
+import layout as layout_module
+from layout import PromptLayout
+from render import Renderer
+from prefetch import Prefetcher
+from perf import FrameProfiler
+from score_store import ScoreStore, LeaderboardView, parse_score, sort_key
 from unittest import mock
-from unittest.mock import patch, mock_open
-
-
-class Test_save_score_to_file(unittest.TestCase):
-    @ patch("builtins.open", new_callable=mock_open, read_data="Matt 1: 77wpm, Easy mode, 84.52% consistency, 100.0% accuracy")
-    def test_file_read_write(self, mock_file):
-        result = helpers.save_score_to_file(
-            'Matt 2', 90, 100.0, 'Easy mode', 84.52)
-        assert result == [
-            'Matt 2: 90wpm, Easy mode, 84.52% consistency, 100.0% accuracy'] or result == [
-            'Matt 2: 90wpm, Easy mode, 84.52% consistency, 100.0% accuracy',
-            'Matt 1: 77wpm, Easy mode, 84.52% consistency, 100.0% accuracy']
-
-
-class Test_load_high_scores(unittest.TestCase):
-    # Test load_high_score is correctly reading the file
-    @ patch("builtins.open", new_callable=mock_open, read_data="Matt 1: 77wpm, 100.0% accuracy, 84.52% consistency, Easy mode\nMatt 2: 90wpm, Easy mode, 100.0% accuracy, 84.52% consistency")
-    def test_file_read(self, mock_file):
-        with mock.patch('os.listdir') as mocked_listdir:
-            mocked_listdir.return_value = [mock_file]
-            result = helpers.load_high_score()
-            assert result == [
-                "Matt 1: 77wpm, 100.0% accuracy, 84.52% consistency, Easy mode", "Matt 2: 90wpm, Easy mode, 100.0% accuracy, 84.52% consistency"]
-
-    # Test load_high_score is correctly responding to an empty file
-    @ patch("builtins.open", new_callable=mock_open, read_data="")
-    def test_empty_file(self, mock_file):
-        with mock.patch('os.listdir') as mocked_listdir:
-            mocked_listdir.return_value = [mock_file]
-            result = helpers.load_high_score()
-            assert result == ["No high scores."]
-
-    # Test load_high_score is correctly responding to an empty file
-    @ patch("builtins.open", new_callable=mock_open, read_data="sauhidfkashfkasdlkjrh iusaheflkasbdflkjas baksjdf")
-    def test_bad_file(self, mock_file):
-        with mock.patch('os.listdir') as mocked_listdir:
-            mocked_listdir.return_value = [mock_file]
-            result = helpers.load_high_score()
-            assert result == None
+from unittest.mock import patch
+
+
+def setUpModule():
+    # Build the width table once for every test, in a temporary
+    # folder rather than the app data folder
+    with tempfile.TemporaryDirectory() as folder:
+        widths.load_table(path.join(folder, "widths.bin"))
 
 
 class Test_consistency(unittest.TestCase):
@@ -93,69 +93,71 @@ class Test_calculate_wpm(unittest.TestCase):
         self.assertEqual(result, (0, 0, 0))
 
 
-class Test_sort_scores(unittest.TestCase):
-    # Test order function
-    def test_clean_input(self):
-        scores = ["Matt 2: 0wpm, Easy mode, 4.3% accuracy, 0% consistency",
-                  "Matt 3: 72wpm, Easy mode, 100.0% accuracy, 0% consistency",
-                  "Matt 1: 65wpm, Easy mode, 100.0% accuracy, 78.18% consistency"]
-        result = helpers.sort_scores(scores)
-        self.assertEqual(result, ['Matt 3: 72wpm, Easy mode, 100.0% accuracy, 0% consistency',
-                         'Matt 1: 65wpm, Easy mode, 100.0% accuracy, 78.18% consistency', 'Matt 2: 0wpm, Easy mode, 4.3% accuracy, 0% consistency'])
-
-    # Duplicate scores don't need to be sorted, they remain in the order they were submitted
-    def test_duplicate_input(self):
-        scores = ["Matt 1: 72wpm, Easy mode, 100.0% accuracy, 0% consistency",
-                  "Matt 2: 72wpm, Easy mode, 100.0% accuracy, 0% consistency",
-                  "Matt 3: 72wpm, Easy mode, 100.0% accuracy, 0% consistency"]
-        result = helpers.sort_scores(scores)
-        self.assertEqual(result, ["Matt 1: 72wpm, Easy mode, 100.0% accuracy, 0% consistency",
-                                  "Matt 2: 72wpm, Easy mode, 100.0% accuracy, 0% consistency",
-                                  "Matt 3: 72wpm, Easy mode, 100.0% accuracy, 0% consistency"])
-
-    # If no scores provided, return an empty list and don't crash
-    def test_no_input(self):
-        scores = []
-        result = helpers.sort_scores(scores)
-        self.assertEqual(result, [])
+class Temp_data_test(unittest.TestCase):
+    ''' Gives tests a temporary folder, used as the app data folder
+    so they never touch the real one'''
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.data = patch.dict(environ, {"TYPING_WIZARD_DATA": self.folder.name})
+        self.data.start()
+
+    def tearDown(self):
+        self.data.stop()
+        self.folder.cleanup()
+
+
+class Shared_network_test(Temp_data_test):
+    ''' Gives tests that use the app's shared network loop a fresh one,
+    with its cache in a temporary data folder'''
+
+    def setUp(self):
+        super().setUp()
+        self.network_patch = patch("network._network", None)
+        self.network_patch.start()
 
+    def tearDown(self):
+        if network._network != None:
+            network._network.close()
+        self.network_patch.stop()
+        super().tearDown()
 
-class Test_load_api(unittest.TestCase):
-    # Tests API call to random words returns 50 words
+
+class Test_load_api(Shared_network_test):
+    def setUp(self):
+        super().setUp()
+        self.server = Local_server()
+
+    def tearDown(self):
+        self.server.close()
+        corpus.set_corpus(None)
+        super().tearDown()
+
+    # Builds the corpus from a word list served by the local server
+    def load_words(self):
+        self.server.body = b"the\t100\nOf\t50\nand\t20"
+        file_path = path.join(self.folder.name, "words.bin")
+        with patch("corpus.CORPUS_URL", self.server.url):
+            corpus.set_corpus(corpus.download_corpus(file_path))
+        return corpus.sample_words(50)
+
+    # Tests random words from the downloaded corpus returns 50 words
     def test_random_words_count(self):
-        result = helpers.load_api(
-            "https://norvig.com/ngrams/count_big.txt")
+        result = self.load_words()
         self.assertEqual(len(result.split()), 50)
+        self.assertLessEqual(set(result.split()), {"the", "of", "and"})
 
-    # Tests API call to random words returns a str
+    # Tests random words from the downloaded corpus returns a str
     def test_random_words_type(self):
-        result = helpers.load_api(
-            "https://norvig.com/ngrams/count_big.txt")
+        result = self.load_words()
         self.assertEqual(type(result), type("result"))
 
     # Test API call to quote returns a str
     def test_quote_response(self):
-        result = helpers.load_api("https://api.quotable.io/random")
+        result = helpers.load_api(self.server.url, "quote")
         self.assertEqual(type(result), type("result"))
 
 
-class Test_username_unused(unittest.TestCase):
-    @ patch("builtins.open", new_callable=mock_open, read_data="Matt: 77wpm, Easy mode, 100.0% accuracy, 84.52% consistency")
-    def test_used(self, mock_file):
-        username = 'Matt'
-        self.assertEqual(helpers.username_unused(username), False)
-
-    @ patch("builtins.open", new_callable=mock_open, read_data="Dave: 77wpm, Easy mode, 100.0% accuracy, 84.52% consistency")
-    def test_unused(self, mock_file):
-        username = 'Fred'
-        self.assertEqual(helpers.username_unused(username), True)
-
-    @ patch("builtins.open", new_callable=mock_open, read_data="Dave: 77wpm, Easy mode, 100.0% accuracy, 84.52% consistency")
-    def test_empty(self, mock_file):
-        username = ''
-        self.assertEqual(helpers.username_unused(username), False)
-
-
 class Test_key_logging(unittest.TestCase):
     def test_ascii(self):
         for key in range(32, 126):
@@ -164,6 +166,10 @@ class Test_key_logging(unittest.TestCase):
     def test_esc(self):
         assert helpers.check_esc(27) == True
 
+    def test_hud_key(self):
+        assert helpers.check_hud_key(266) == True
+        assert helpers.check_hud_key(27) == False
+
     def test_check_enter_input(self):
         assert helpers.check_enter_input(
             10) == True or helpers.check_enter_input(13) == True
@@ -171,6 +177,1748 @@ class Test_key_logging(unittest.TestCase):
     def test_check_backspace(self):
         assert helpers.check_backspace(
             127) == True or helpers.check_backspace(1) == False
+        assert helpers.check_backspace(curses.KEY_BACKSPACE) == True
+
+    # get_wch characters come back as strings, control keys as codes
+    def test_get_key(self):
+        window = mock.Mock()
+        for key, expected in [("é", "é"), ("日", "日"), ("\n", 10),
+                              ("\x1b", 27), (curses.KEY_LEFT, curses.KEY_LEFT)]:
+            window.get_wch.return_value = key
+            self.assertEqual(helpers.get_key(window), expected)
+        assert helpers.check_text_input("é") == True
+        assert helpers.check_text_input(10) == False
+        window.get_wch.side_effect = curses.error("no input")
+        self.assertEqual(helpers.get_key(window), -1)
+
+
+class Test_get_input_timeout(unittest.TestCase):
+    # Before the game starts, block until a key is pressed
+    def test_not_started(self):
+        self.assertEqual(helpers.get_input_timeout(
+            None, 0, False, 60, 100.0), -1)
+
+    # Once started, wake up when the countdown ticks over
+    def test_countdown_tick(self):
+        self.assertEqual(helpers.get_input_timeout(
+            100.0, 0, False, 60, 102.75), 250)
+
+    # Never wake up faster than the frame cap allows
+    def test_frame_cap(self):
+        self.assertEqual(helpers.get_input_timeout(
+            100.0, 0, False, 10, 100.99), 100)
+
+    # A pending redraw waits out the remainder of the frame
+    def test_redraw_pending(self):
+        self.assertEqual(helpers.get_input_timeout(
+            None, 100.0, True, 10, 100.04), 60)
+        self.assertEqual(helpers.get_input_timeout(
+            None, 100.0, True, 10, 100.5), 0)
+
+    # Wake up for a played back keystroke, still within the frame cap
+    def test_next_event(self):
+        self.assertEqual(helpers.get_input_timeout(
+            None, 0, False, 60, 100.0, 40.2), 41)
+        self.assertEqual(helpers.get_input_timeout(
+            100.0, 0, False, 60, 100.5, 900), 500)
+        self.assertEqual(helpers.get_input_timeout(
+            None, 100.0, False, 10, 100.01, 5), 90)
+
+
+class Test_typing_stats(unittest.TestCase):
+    # Stats match calculate_wpm as characters are typed and deleted
+    def test_matches_calculate_wpm(self):
+        prompt = "This is a test case"
+        stats = TypingStats(prompt)
+        for char in "This is a blur":
+            stats.add_char(char)
+        stats.backspace()
+        stats.backspace()
+        for char in "st case":
+            stats.add_char(char)
+        self.assertEqual(stats.wpm(60), helpers.calculate_wpm(
+            prompt, "This is a blst case", 60))
+        self.assertTrue(stats.finished())
+
+    # Typing past the end of the prompt is ignored
+    def test_prompt_full(self):
+        stats = TypingStats("ab")
+        self.assertTrue(stats.add_char("a"))
+        self.assertTrue(stats.add_char("b"))
+        self.assertFalse(stats.add_char("c"))
+        self.assertEqual(stats.wpm(60), (0, 0, 100.0))
+
+    # Backspace with nothing typed does nothing
+    def test_empty_backspace(self):
+        stats = TypingStats("ab")
+        self.assertFalse(stats.backspace())
+        self.assertEqual(stats.wpm(60), (0, 0, 0))
+
+    # Running consistency matches measure_consistency
+    def test_matches_measure_consistency(self):
+        for samples in ([], [0, 0, 0], [65, 65, 65], [100]):
+            stats = TypingStats("")
+            for sample in samples:
+                stats.add_sample(sample)
+            self.assertEqual(stats.consistency(),
+                             helpers.measure_consistency(samples))
+        random = Random(1)
+        for _ in range(50):
+            samples = [random.randint(0, 150)
+                       for _ in range(random.randint(1, 300))]
+            stats = TypingStats("")
+            for sample in samples:
+                stats.add_sample(sample)
+            self.assertEqual(stats.consistency(),
+                             helpers.measure_consistency(samples))
+
+    # A prompt extended while typing keeps scoring like the whole text
+    def test_extend(self):
+        stats = TypingStats("This is")
+        for char in "This is":
+            stats.add_char(char)
+        self.assertTrue(stats.finished())
+        stats.extend(" a test")
+        self.assertFalse(stats.finished())
+        for char in " a tent":
+            stats.add_char(char)
+        self.assertEqual(stats.wpm(60), helpers.calculate_wpm(
+            "This is a test", "This is a tent", 60))
+
+
+class Test_test_modes(unittest.TestCase):
+    # Lengths cycle both ways, wrapping at the ends
+    def test_next_test_mode(self):
+        self.assertEqual(helpers.next_test_mode(("time", 30), -1),
+                         ("time", 15))
+        self.assertEqual(helpers.next_test_mode(("time", 15), -1),
+                         ("endless", None))
+        self.assertEqual(helpers.next_test_mode(("endless", None), 1),
+                         ("time", 15))
+        # A length from the command line is part of the cycle
+        self.assertEqual(helpers.next_test_mode(("time", 45), 1),
+                         ("time", 15))
+
+    def test_test_mode_text(self):
+        self.assertEqual(helpers.test_mode_text(("time", 60)),
+                         "60 second test")
+        self.assertEqual(helpers.test_mode_text(("words", 25)),
+                         "25 word test")
+        self.assertEqual(helpers.test_mode_text(("endless", None)),
+                         "endless test")
+
+
+class Test_keystroke_log(unittest.TestCase):
+    # Every keystroke is logged with its time, position and correctness
+    def test_logged(self):
+        stats = TypingStats("abc")
+        stats.add_char("a", 1000)
+        stats.add_char("x", 2000)
+        stats.backspace(3000)
+        self.assertEqual([list(column) for column in stats.log.columns()],
+                         [[1000, 2000, 3000], [97, 120, 127],
+                          [0, 1, 1], [1, 0, BACKSPACE]])
+
+    # A serialised log loads back the same
+    def test_round_trip(self):
+        log = KeystrokeLog()
+        log.add(2**40, 97, 0, True)
+        log.add(2**40 + 5, 127, 0, BACKSPACE)
+        loaded = KeystrokeLog.from_bytes(log.to_bytes())
+        self.assertEqual(loaded.columns(), log.columns())
+        with self.assertRaises(ValueError):
+            KeystrokeLog.from_bytes(b"not a log at all")
+
+    # Stats rebuilt from a log match the live stats
+    def test_from_log(self):
+        prompt = "The quick brown fox"
+        stats = TypingStats(prompt)
+        random = Random(2)
+        time_ns = 10**12
+        for char in "The quikc brown":
+            time_ns += random.randint(10**7, 4 * 10**8)
+            stats.add_char(char, time_ns)
+            if random.random() < 0.2:
+                stats.backspace(time_ns + 1)
+        rebuilt = TypingStats.from_log(prompt, stats.log)
+        self.assertEqual(rebuilt.wpm_at(time_ns), stats.wpm_at(time_ns))
+        self.assertEqual(rebuilt.consistency(), stats.consistency())
+
+    # Wpm uses the exact time since the first key, not whole seconds
+    def test_wpm_at(self):
+        stats = TypingStats("abcdefghij")
+        for i, char in enumerate("abcdefghij"):
+            stats.add_char(char, i * 10**8)
+        self.assertEqual(stats.elapsed(2 * 10**9), 2.0)
+        self.assertEqual(stats.wpm_at(2 * 10**9), stats.wpm(2.0))
+        self.assertEqual(stats.wpm_at(1500 * 10**6), (80, 80, 100.0))
+        # The first second counts as a whole second
+        self.assertEqual(stats.wpm_at(5 * 10**8), stats.wpm(1.0))
+
+    # A test can start at a set time, before the first keystroke
+    def test_begin(self):
+        stats = TypingStats("abcdefghij")
+        self.assertEqual(stats.start_time(), None)
+        stats.begin(10**9)
+        stats.add_char("a", 3 * 10**9)
+        self.assertEqual(stats.start_time(), 10**9)
+        self.assertEqual(stats.elapsed(4 * 10**9), 3.0)
+
+
+class Test_batch_scoring(unittest.TestCase):
+    def setUp(self):
+        random = Random(4)
+        self.sessions = []
+        for _ in range(300):
+            prompt = "".join(random.choice("ab cé")
+                             for _ in range(random.randint(0, 60)))
+            typed = "".join(random.choice("ab cé")
+                            for _ in range(random.randint(0, len(prompt))))
+            samples = [random.randint(0, 150)
+                       for _ in range(random.randint(0, 30))]
+            self.sessions.append((prompt, typed,
+                                  random.choice([1, 7.5, 30]), samples))
+
+    # Batch results match the single session functions
+    def test_matches_single_session(self):
+        results = scoring.score_sessions(self.sessions)
+        for i, (prompt, typed, seconds, samples) in enumerate(self.sessions):
+            self.assertEqual(
+                (results["gross_wpm"][i], results["net_wpm"][i],
+                 results["accuracy"][i], results["consistency"][i]),
+                (*helpers.calculate_wpm(prompt, typed, seconds),
+                 helpers.measure_consistency(samples)))
+
+    # Spreading the work over processes gives the same results
+    def test_process_pool(self):
+        single = scoring.score_sessions(self.sessions)
+        pooled = scoring.score_sessions(self.sessions, workers=2,
+                                        chunk_size=70)
+        for name in single:
+            self.assertEqual(single[name].tolist(), pooled[name].tolist())
+
+    def test_invalid(self):
+        self.assertEqual(len(scoring.score_sessions([])["net_wpm"]), 0)
+        with self.assertRaises(ValueError):
+            scoring.score_sessions([("ab", "abc", 30, [])])
+
+
+class Test_prompt_layout(unittest.TestCase):
+    prompt = "the quick brown fox jumps over the lazy dog " * 5
+
+    # Offsets index the start of each wrapped line
+    def test_offsets(self):
+        layout = PromptLayout(self.prompt, 17)
+        self.assertEqual(layout.text, self.prompt)
+        for row, line in enumerate(layout.lines):
+            start = layout.offsets[row]
+            self.assertEqual(self.prompt[start:start + len(line)], line)
+        self.assertEqual(layout.offsets[-1], len(self.prompt))
+
+    # Every character position maps back to its row and column
+    def test_locate(self):
+        layout = PromptLayout(self.prompt, 17)
+        for position in range(len(self.prompt)):
+            row, column = layout.locate(position)
+            self.assertEqual(layout.lines[row][column],
+                             self.prompt[position])
+        self.assertEqual(layout.locate(len(self.prompt)),
+                         (len(layout) - 1, len(layout.lines[-1])))
+
+    # Typed lines match the wrap_user_input mapping
+    def test_typed_line(self):
+        layout = PromptLayout(self.prompt, 17)
+        typed = self.prompt[:100]
+        self.assertEqual(
+            [layout.typed_line(typed, row) for row in range(len(layout))],
+            helpers.wrap_user_input(typed, layout.lines))
+
+    # A prompt grown piece by piece wraps the same as the whole text
+    def test_extend(self):
+        words = self.prompt.split()
+        layout = PromptLayout(" ".join(words[:3]), 17)
+        for start in range(3, len(words), 4):
+            layout.extend(" ".join(words[start:start + 4]))
+        whole = PromptLayout(" ".join(words), 17)
+        self.assertEqual(layout.text, whole.text)
+        self.assertEqual(layout.lines, whole.lines)
+        self.assertEqual(layout.offsets, whole.offsets)
+        # Words left are kept up to date as the prompt grows
+        for position in range(len(layout.text) + 1):
+            self.assertEqual(layout.words_left(position),
+                             len(layout.text[position:].split()))
+
+    # Text is only taken from the generator when it is needed
+    def test_fill(self):
+        more = iter(["one two", "three four", "five six"])
+        layout = PromptLayout("zero", 17, more)
+        self.assertEqual(layout.fill(0, 10), " one two")
+        self.assertEqual(layout.fill(0, 10), "")
+        self.assertEqual(layout.fill(5, 10), " three four")
+        self.assertEqual(layout.fill(20, 10), " five six")
+        self.assertFalse(layout.complete())
+        self.assertEqual(layout.fill(30, 10), "")
+        self.assertTrue(layout.complete())
+
+    # A word limit cuts the prompt and stops it growing
+    def test_word_limit(self):
+        more = iter(["three four five", "six"])
+        layout = PromptLayout("one two", 17, more, word_limit=4)
+        self.assertEqual(layout.fill(0, 100), " three four")
+        self.assertEqual(layout.text, "one two three four")
+        self.assertTrue(layout.complete())
+        self.assertEqual(layout.words_left(5), 3)
+        layout = PromptLayout("one two three", 17).limit_words(2)
+        self.assertEqual(layout.text, "one two")
+        self.assertTrue(layout.complete())
+
+    # Scrolling keeps the row being typed on screen and drops rows
+    # far above it, positions still map to the same rows
+    def test_scroll(self):
+        layout = PromptLayout(self.prompt, 17)
+        whole = PromptLayout(self.prompt, 17)
+        layout.set_rows(4)
+        self.assertEqual(layout.visible_rows(), range(0, 4))
+        self.assertFalse(layout.scroll_to(0))
+        position = whole.offsets[8] + 2
+        self.assertTrue(layout.scroll_to(position))
+        self.assertEqual(layout.visible_rows(), range(7, 11))
+        self.assertEqual(layout.first_row, 7 - layout_module.KEPT_ROWS)
+        self.assertEqual(layout.start(), whole.offsets[layout.first_row])
+        for position in range(layout.start(), len(self.prompt)):
+            self.assertEqual(layout.locate(position), whole.locate(position))
+        for row in layout.visible_rows():
+            self.assertEqual(layout.line(row), whole.lines[row])
+
+
+class Test_layout_cache(unittest.TestCase):
+    prompt = "the quick brown fox jumps over the lazy dog " * 20
+
+    # Wrapping the same prompt to the same width again is a lookup
+    def test_hit(self):
+        cache = layout_module.LayoutCache()
+        first = cache.wrap(self.prompt, 30)
+        self.assertIs(cache.wrap(self.prompt, 30), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(first, layout_module.wrap_offsets(self.prompt, 30))
+        cache.wrap(self.prompt, 31)
+        self.assertEqual(cache.misses, 2)
+
+    # Once over budget the least recently used layouts are dropped
+    def test_budget(self):
+        size = layout_module.layout_size(
+            *layout_module.wrap_offsets(self.prompt, 30))
+        cache = layout_module.LayoutCache(budget=size * 2.5)
+        cache.wrap(self.prompt, 30)
+        cache.wrap(self.prompt + "a", 30)
+        cache.wrap(self.prompt, 30)
+        cache.wrap(self.prompt + "b", 30)
+        self.assertLessEqual(cache.size, cache.budget)
+        self.assertEqual(len(cache.layouts), 2)
+        cache.wrap(self.prompt, 30)
+        cache.wrap(self.prompt + "a", 30)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    # Layouts worked out in the background are ready for a resize,
+    # which wraps the same as a new prompt at that width
+    def test_precompute(self):
+        layout = PromptLayout(self.prompt, 40)
+        layout.precompute([23, 47])
+        layout_module.layout_cache.wait()
+        hits = layout_module.layout_cache.hits
+        for width in [23, 47]:
+            resized = layout.reflow(width)
+            whole = PromptLayout(self.prompt, width)
+            self.assertEqual(resized.lines, whole.lines)
+            self.assertEqual(resized.offsets, whole.offsets)
+        self.assertEqual(layout_module.layout_cache.hits, hits + 4)
+
+        # Changing the layout doesn't change what is cached
+        resized.extend("more words")
+        self.assertEqual(PromptLayout(self.prompt, 47).text, self.prompt)
+
+
+class Test_renderer(unittest.TestCase):
+    # Unchanged rows aren't redrawn
+    def test_unchanged_row(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        renderer.draw(0, 0, "hello", 1)
+        renderer.draw(0, 0, "hello", 1)
+        window.addstr.assert_called_once_with(0, 0, "hello", 1)
+
+    # Only the changed end of a row is redrawn
+    def test_changed_cells(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        renderer.draw_row(0, ((0, "he", 1), (2, "llo", 0)))
+        window.reset_mock()
+        renderer.draw_row(0, ((0, "hel", 1), (3, "lo", 0)))
+        window.move.assert_called_once_with(0, 2)
+        self.assertEqual(window.addstr.call_args_list,
+                         [mock.call(0, 2, "l", 1), mock.call(0, 3, "lo", 0)])
+
+    # Typed characters of the same colour are drawn in one call
+    def test_runs_batched(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        layout = PromptLayout("abcdef", 80)
+        with patch("curses.color_pair", side_effect=lambda n: n):
+            helpers.print_typing_text(renderer, layout, "abxd", 0, 5)
+        self.assertEqual(window.addstr.call_args_list,
+                         [mock.call(5, 0, "ab", 77), mock.call(5, 2, "x", 160),
+                          mock.call(5, 3, "d", 77), mock.call(5, 4, "ef", 0)])
+
+    # The ghost cursor is highlighted, and moving it redraws only its rows
+    def test_ghost(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        layout = PromptLayout("abc def ghi", 4)
+        ghost = 208 | curses.A_REVERSE
+        with patch("curses.color_pair", side_effect=lambda n: n):
+            helpers.print_typing_text(renderer, layout, "ab", 0, 5, None, 1)
+            self.assertEqual(renderer.rows[5],
+                             ((0, "a", 77), (1, "b", 77 | ghost),
+                              (2, "c ", 0)))
+            window.reset_mock()
+            helpers.print_typing_text(renderer, layout, "ab", 0, 5, 2, 9, 1)
+        self.assertEqual(renderer.rows[5], ((0, "ab", 77), (2, "c ", 0)))
+        self.assertEqual(renderer.rows[7], ((0, "g", 0), (1, "h", ghost),
+                                            (2, "i", 0)))
+        self.assertEqual(sorted({call.args[0] for call
+                                 in window.addstr.call_args_list}), [5, 7])
+
+
+    # Wide characters take two columns and accents stay on their letter
+    def test_wide_characters(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        layout = PromptLayout("日本e\u0301a", 80)
+        with patch("curses.color_pair", side_effect=lambda n: n):
+            helpers.print_typing_text(renderer, layout, "日x", 0, 5)
+            # A mistake of a different width shows the prompt character
+            self.assertEqual(renderer.rows[5],
+                             ((0, "日", 77), (2, "本", 160), (4, "éa", 0)))
+            helpers.print_typing_text(renderer, layout, "日本éx", 0, 5, 2)
+            self.assertEqual(renderer.rows[5],
+                             ((0, "日本é", 77), (5, "x", 160)))
+        self.assertEqual(layout.display_column(*layout.locate(3)), 5)
+
+    # Redrawing part of a row never splits a letter from its accent
+    def test_changed_graphemes(self):
+        window = mock.Mock()
+        renderer = Renderer(window)
+        renderer.draw(0, 0, "日本e", 1)
+        window.reset_mock()
+        renderer.draw(0, 0, "日本e\u0301", 1)
+        window.move.assert_called_once_with(0, 4)
+        window.addstr.assert_called_once_with(0, 4, "e\u0301", 1)
+
+
+class Test_widths(unittest.TestCase):
+    # Widths come from a table built once and then read from a file
+    def test_table(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = path.join(folder, "widths.bin")
+            table = widths.load_table(file_path)
+            self.assertTrue(path.isfile(file_path))
+            # Once saved, the table is read back rather than built again
+            with patch("widths.build_table") as build_table:
+                self.assertEqual(widths.load_table(file_path), table)
+            build_table.assert_not_called()
+        self.assertEqual(table[ord("a")], 1)
+        self.assertEqual(table[ord("日")], 2)
+        self.assertEqual(table[0x301], widths.EXTEND)
+
+    # The table is loaded in the background, once, from the data folder
+    def test_preload(self):
+        table = widths.load_table()
+        with tempfile.TemporaryDirectory() as folder:
+            with open(path.join(folder, "widths.bin"), "wb") as f:
+                f.write(widths.HEADER.pack(widths.MAGIC, widths.VERSION))
+                f.write(zlib.compress(table))
+            with patch.dict(environ, {"TYPING_WIZARD_DATA": folder}), \
+                    patch("widths._table", None), \
+                    patch("widths.build_table") as build_table:
+                widths.preload().join(5)
+                self.assertEqual(widths._table, table)
+                self.assertIs(widths.load_table(), widths._table)
+        build_table.assert_not_called()
+
+    def test_graphemes(self):
+        self.assertEqual(widths.cluster_bounds("abc"), range(4))
+        self.assertEqual(widths.cluster_bounds("e\u0301x"), (0, 2, 3))
+        self.assertEqual(widths.columns("e\u0301x"), (0, 0, 1, 2))
+        self.assertEqual(widths.columns("日本"), (0, 2, 4))
+        # Flags and emoji joined together are one grapheme
+        self.assertEqual(widths.cluster_bounds("\U0001F1EC\U0001F1E7a"),
+                         (0, 2, 3))
+        self.assertEqual(widths.text_width("\U0001F468\u200d\U0001F469"), 2)
+        self.assertEqual(widths.grapheme_start("ae\u0301", 2), 1)
+
+    # Accents typed after their letter are combined with it
+    def test_compose(self):
+        self.assertEqual(widths.normalize("e\u0301"), "é")
+        self.assertEqual(widths.compose("e", "\u0301"), "é")
+        self.assertEqual(widths.compose("x", "\u0301"), None)
+        self.assertEqual(widths.compose("e", "a"), None)
+
+    # ASCII wraps exactly as textwrap does
+    def test_wrap_ascii(self):
+        random = Random(2)
+        for _ in range(500):
+            text = "".join(random.choice("ab -cd\tef") for _
+                           in range(random.randint(0, 60)))
+            width = random.randint(1, 15)
+            self.assertEqual(widths.wrap_columns(text, width),
+                             textwrap.wrap(text, width, drop_whitespace=False))
+
+    # Wide text fits its width without splitting graphemes
+    def test_wrap_wide(self):
+        text = "日本語の文章です。 Cafe\u0301 naïve 한국어 텍스트"
+        for width in range(2, 20):
+            lines = widths.wrap(text, width)
+            self.assertEqual("".join(lines), text)
+            for line in lines:
+                self.assertLessEqual(widths.text_width(line), width)
+                self.assertFalse(line.startswith("\u0301"))
+
+
+class Test_race_board(unittest.TestCase):
+    # Each racer gets a progress bar, the user in their own colour
+    def test_board(self):
+        renderer = Renderer(mock.Mock())
+        standings = [["ann", 50, 80, True], ["me", 25, 40, False],
+                     ["bob", 0, 0, False]]
+        with patch("curses.color_pair", side_effect=lambda n: n):
+            helpers.print_race_board(renderer, standings, 100, "me",
+                                     2, 10, 2)
+        self.assertEqual(renderer.rows, {
+            10: ((2, "ann          [##########          ]  80wpm done", 39),),
+            11: ((2, "me           [#####               ]  40wpm", 208),)})
+
+
+class Test_frame_profiler(unittest.TestCase):
+    # Each frame's render time, key latency and counts are kept for the HUD
+    def test_frames(self):
+        profiler = FrameProfiler()
+        profiler.key(1000)
+        profiler.key(2000)
+        profiler.start_frame(5000)
+        profiler.add_stats_time(300)
+        profiler.end_frame(9000, 12)
+        self.assertEqual((profiler.render_ns, profiler.latency_ns,
+                          profiler.last_stats_ns, profiler.calls),
+                         (4000, 8000, 300, 12))
+        # A frame without a key keeps the last latency
+        profiler.start_frame(10**9)
+        profiler.end_frame(10**9 + 500, 3)
+        self.assertEqual(profiler.latency_ns, 8000)
+        self.assertEqual(profiler.fps(), 2)
+        profiler.start_frame(2 * 10**9 + 1000)
+        profiler.end_frame(2 * 10**9 + 1000, 3)
+        self.assertEqual(profiler.fps(), 1)
+        self.assertIn("addstr 3", profiler.hud_text())
+
+    # Frames are written as Chrome trace events
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as folder:
+            trace_file = path.join(folder, "trace.json")
+            profiler = FrameProfiler(trace_file)
+            profiler.key(1000)
+            profiler.start_frame(2000)
+            profiler.end_frame(6000, 5)
+            profiler.close()
+            with open(trace_file) as f:
+                events = json.loads(f.read().rstrip().rstrip(",") + "]")
+        self.assertEqual([(event["name"], event["ph"]) for event in events],
+                         [("frame", "X"), ("frame", "C"),
+                          ("key to screen", "X")])
+        self.assertEqual(events[0]["dur"], 4)
+        self.assertEqual(events[2]["dur"], 5)
+
+
+class Test_terminal_size_cache(unittest.TestCase):
+    # Terminal size is only read again after a resize event
+    @ patch("helpers.get_terminal_size", return_value=(100, 30))
+    def test_cached_until_resize(self, mock_size):
+        helpers.check_resize(helpers.curses.KEY_RESIZE)
+        self.assertEqual(helpers.get_window_sizes(), [76, 12, 9])
+        self.assertTrue(helpers.check_valid_terminal())
+        self.assertEqual(mock_size.call_count, 1)
+        mock_size.return_value = (60, 30)
+        self.assertTrue(helpers.check_valid_terminal())
+        self.assertTrue(helpers.check_resize(helpers.curses.KEY_RESIZE))
+        self.assertFalse(helpers.check_valid_terminal())
+        self.assertEqual(mock_size.call_count, 2)
+        helpers.check_resize(helpers.curses.KEY_RESIZE)
+
+    # Other keys aren't resize events
+    def test_not_resize(self):
+        self.assertFalse(helpers.check_resize(97))
+        self.assertFalse(helpers.check_resize(-1))
+
+    # Reflowing a prompt keeps every character position
+    def test_reflow(self):
+        layout = PromptLayout("the quick brown fox jumps over the dog", 20)
+        narrow = layout.reflow(10)
+        self.assertEqual(narrow.text, layout.text)
+        self.assertGreater(len(narrow), len(layout))
+        self.assertIs(layout.reflow(20), layout)
+
+
+class Test_word_corpus(unittest.TestCase):
+    counts = "the\t80000\nThe\t20000\nof\t40000\nrare\t1\n\n"
+
+    # Corpus file round trips words and merges words that differ by case
+    def test_build_and_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = path.join(folder, "words.bin")
+            built = corpus.build_corpus(self.counts, file_path)
+            loaded = corpus.WordCorpus.load(file_path)
+        self.assertEqual([loaded.word(i) for i in range(len(loaded))],
+                         ["the", "of", "rare"])
+        self.assertEqual(list(loaded.cumulative), [100000, 140000, 140001])
+        self.assertEqual(list(built.offsets), list(loaded.offsets))
+
+    # Samples are weighted by count and repeatable with a seed
+    def test_weighted_sample(self):
+        with tempfile.TemporaryDirectory() as folder:
+            words = corpus.build_corpus(
+                self.counts, path.join(folder, "words.bin"))
+        sample = words.sample(1000, seed=1)
+        self.assertEqual(sample, words.sample(1000, seed=1))
+        self.assertGreater(sample.count("the"), sample.count("of"))
+        self.assertLess(sample.count("rare"), 5)
+
+    # sample_words returns a string of words, or None with no corpus
+    def test_sample_words(self):
+        with tempfile.TemporaryDirectory() as folder:
+            corpus.set_corpus(corpus.build_corpus(
+                self.counts, path.join(folder, "words.bin")))
+            self.assertEqual(len(corpus.sample_words(50).split()), 50)
+            corpus.set_corpus(corpus.build_corpus(
+                "", path.join(folder, "empty.bin")))
+            self.assertEqual(corpus.sample_words(50), None)
+        corpus.set_corpus(None)
+
+    # Callers that need the corpus at the same time share one download
+    def test_shared_download(self):
+        from concurrent.futures import Future
+
+        with patch("network.get_network") as get_network, \
+                patch.dict(corpus._downloads, clear=True):
+            get_network.return_value.start.side_effect = (
+                lambda *args: Future())
+            first = corpus.start_download("words.bin")
+            self.assertIs(corpus.start_download("words.bin"), first)
+            self.assertEqual(get_network.return_value.start.call_count, 1)
+            # Once it is done, asking again downloads again
+            first.set_result(None)
+            self.assertIsNot(corpus.start_download("words.bin"), first)
+
+
+class Local_server:
+    ''' Local stand-in for the quote API, counts requests and
+    connections, and can be told to fail, to fail the next few
+    requests, to answer slowly or to send a different body. With an
+    etag it answers 304 to requests that already have the body'''
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.fail = False
+        self.failures = 0
+        self.status = 500
+        self.delay = 0
+        self.body = None
+        self.etag = None
+        self.cache_control = None
+        self.not_modified = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps connections open between requests
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                server.connections += 1
+                super().setup()
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.delay)
+                if server.fail or server.failures > 0:
+                    server.failures -= 1
+                    self.send_response(server.status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if (server.etag != None
+                        and self.headers.get("If-None-Match") == server.etag):
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = server.body or json.dumps(
+                    {"content": f"Quote {server.requests}",
+                     "author": "Tester"}).encode()
+                self.send_response(200)
+                if server.etag != None:
+                    self.send_header("ETag", server.etag)
+                if server.cache_control != None:
+                    self.send_header("Cache-Control", server.cache_control)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/quotable/random"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Test_prefetcher(Shared_network_test):
+    def setUp(self):
+        super().setUp()
+        self.server = Local_server()
+
+    def tearDown(self):
+        self.server.close()
+        super().tearDown()
+
+    # Prompts are loaded in the background and taken from the queue
+    def test_takes_prefetched_prompts(self):
+        pool = Prefetcher({"quote": lambda: helpers.load_api(
+            self.server.url, "quote")}, size=2)
+        first = pool.get("quote", timeout=5)
+        second = pool.get("quote", timeout=5)
+        pool.stop()
+        self.assertTrue(first.startswith("Quote "))
+        self.assertTrue(second.endswith(" - Tester"))
+        self.assertNotEqual(first, second)
+
+    # The queue is bounded, so only a few prompts are loaded ahead
+    def test_bounded_queue(self):
+        pool = Prefetcher({"quote": lambda: helpers.load_api(
+            self.server.url, "quote")}, size=2)
+        pool.get("quote", timeout=5)
+        threading.Event().wait(0.5)
+        pool.stop()
+        self.assertLessEqual(self.server.requests, 4)
+
+    # A failing source leaves the queue empty instead of blocking
+    def test_failing_source(self):
+        self.server.fail = True
+        pool = Prefetcher({"quote": lambda: helpers.load_api(
+            self.server.url, "quote")}, retry_delay=0.1)
+        self.assertEqual(pool.get("quote", timeout=0.3), None)
+        self.server.fail = False
+        self.assertTrue(pool.get("quote", timeout=5).startswith("Quote "))
+        pool.stop()
+
+
+class Test_network(Shared_network_test):
+    def setUp(self):
+        super().setUp()
+        self.server = Local_server()
+        self.network = network.Network(backoff=0.01)
+
+    def tearDown(self):
+        self.network.close()
+        self.server.close()
+        super().tearDown()
+
+    def fetch(self, **kwargs):
+        return network.wait(self.network.start(self.server.url, **kwargs))
+
+    # Requests share one kept-alive connection
+    def test_reuses_connections(self):
+        for _ in range(3):
+            self.assertTrue(self.fetch().startswith('{"content"'))
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 1)
+
+    # Server errors are retried until one attempt succeeds
+    def test_retries(self):
+        self.server.failures = 2
+        result = self.fetch(parse=helpers.parse_quote, retries=2)
+        self.assertEqual(result, "Quote 3 - Tester")
+
+    # Once the retries run out, the last failure is raised
+    def test_server_error(self):
+        self.server.fail = True
+        with self.assertRaises(network.ServerError) as error:
+            self.fetch(retries=1)
+        self.assertEqual(error.exception.status, 500)
+        self.assertEqual(self.server.requests, 2)
+
+    # A missing page won't appear by asking again
+    def test_not_retried(self):
+        self.server.fail = True
+        self.server.status = 404
+        with self.assertRaises(network.ServerError):
+            self.fetch(retries=2)
+        self.assertEqual(self.server.requests, 1)
+
+    # A slow server times out each attempt
+    def test_timeout(self):
+        self.server.delay = 1
+        start = time.perf_counter()
+        with self.assertRaises(network.RequestTimeout):
+            self.fetch(timeout=0.2, retries=1)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(self.server.requests, 2)
+
+    # Cancelling stops waiting straight away
+    def test_cancel(self):
+        self.server.delay = 1
+        future = self.network.start(self.server.url)
+        time.sleep(0.1)
+        start = time.perf_counter()
+        future.cancel()
+        with self.assertRaises(network.Cancelled):
+            network.wait(future)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    # An answer that can't be parsed is a bad response, not a crash
+    def test_bad_response(self):
+        self.server.body = b"<html>Not a quote</html>"
+        with self.assertRaises(network.BadResponse):
+            self.fetch(parse=helpers.parse_quote)
+        self.assertEqual(self.server.requests, 1)
+
+    # Nothing listening on the port is a connection failure
+    def test_connection_failed(self):
+        url = self.server.url
+        self.server.close()
+        with self.assertRaises(network.ConnectionFailed):
+            network.wait(self.network.start(url, retries=0))
+
+    # load_api raises its errors instead of returning 0
+    def test_load_api(self):
+        self.assertEqual(helpers.load_api(self.server.url, "quote"),
+                         "Quote 1 - Tester")
+        self.server.fail = True
+        self.server.status = 404
+        with self.assertRaises(network.ServerError):
+            helpers.load_api(self.server.url, "quote")
+
+    # The source given picks the parser, not what the url looks like
+    def test_load_api_source(self):
+        with patch.dict(helpers.API_PARSERS, {"other": lambda text: "Other"}):
+            self.assertEqual(helpers.load_api(self.server.url, "other"),
+                             "Other")
+
+
+class Test_http_cache(Temp_data_test):
+    def setUp(self):
+        super().setUp()
+        self.server = Local_server()
+        self.cache = http_cache.HttpCache(self.folder.name)
+        self.network = network.Network(backoff=0.01, cache=self.cache)
+
+    def tearDown(self):
+        self.network.close()
+        self.server.close()
+        super().tearDown()
+
+    def fetch(self, source, **kwargs):
+        return network.wait(self.network.start(self.server.url, source,
+                                               **kwargs))
+
+    # A fresh cached response is used without asking the server
+    def test_fresh(self):
+        first = self.fetch("corpus")
+        self.assertEqual(self.fetch("corpus"), first)
+        self.assertEqual(self.server.requests, 1)
+
+    # A stale response is checked with its ETag, 304 keeps the cached body
+    def test_revalidate(self):
+        self.server.etag = '"v1"'
+        first = self.fetch("quote")
+        self.assertEqual(self.fetch("quote"), first)
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.server.not_modified, 1)
+
+        # A changed body is downloaded again
+        self.server.etag = '"v2"'
+        self.assertNotEqual(self.fetch("quote"), first)
+
+    # Offline, a stale response is better than nothing
+    def test_stale_when_offline(self):
+        first = self.fetch("quote")
+        self.server.fail = True
+        self.assertEqual(self.fetch("quote", retries=0), first)
+
+        # Errors that won't pass aren't hidden
+        self.server.status = 404
+        with self.assertRaises(network.ServerError):
+            self.fetch("quote", retries=0)
+
+    # Sources without a ttl and no-store responses aren't cached
+    def test_not_stored(self):
+        self.fetch(None)
+        self.server.cache_control = "no-store"
+        self.fetch("corpus")
+        self.fetch("corpus")
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_response_ttl(self):
+        self.assertEqual(http_cache.response_ttl({}, 60), 60)
+        self.assertEqual(http_cache.response_ttl(
+            {"Cache-Control": "public, max-age=300"}, 60), 300)
+        self.assertEqual(http_cache.response_ttl(
+            {"Cache-Control": "no-cache"}, 60), 0)
+        self.assertEqual(http_cache.response_ttl(
+            {"Cache-Control": "no-store"}, 60), None)
+
+    # The least recently used entries are removed when the cache is full
+    def test_lru_eviction(self):
+        body = Random(1).randbytes(1000)
+        cache = http_cache.HttpCache(self.folder.name, max_bytes=2500)
+        for i, url in enumerate(["a", "b"]):
+            cache.store(http_cache.CacheEntry(url, body))
+            # Older entries were last used longer ago
+            utime(cache.entry_path(url), (1000 + i, 1000 + i))
+        self.assertEqual(cache.lookup("a").body, body)
+        cache.store(http_cache.CacheEntry("c", body))
+        self.assertEqual(cache.lookup("b"), None)
+        self.assertEqual(cache.lookup("a").body, body)
+        self.assertEqual(cache.lookup("c").body, body)
+        self.assertLessEqual(cache.size(), 2500)
+
+    # A damaged entry is treated as missing
+    def test_damaged_entry(self):
+        self.cache.store(http_cache.CacheEntry("a", b"body"))
+        with open(self.cache.entry_path("a"), "r+b") as f:
+            f.write(b"garbage!")
+        self.assertEqual(self.cache.lookup("a"), None)
+
+
+class Test_history(Temp_data_test):
+    def setUp(self):
+        super().setUp()
+        self.history = history.History(path.join(self.folder.name, "h.db"))
+
+    def tearDown(self):
+        self.history.close()
+        super().tearDown()
+
+    # Totals kept as sessions are added match working them out from
+    # every session
+    def test_totals(self):
+        rng = Random(3)
+        sessions = [(rng.randint(20, 120), round(rng.uniform(80, 100), 1))
+                    for _ in range(25)]
+        for i, (wpm, accuracy) in enumerate(sessions):
+            self.history.add("words", 30, "Easy mode", ("time", 30), wpm,
+                             accuracy, 90.0, [wpm], timestamp=1e9 + i)
+            totals = self.history.totals()
+            done = sessions[:i + 1]
+            recent = done[-history.ROLLING_SESSIONS:]
+            self.assertEqual(totals["sessions"], i + 1)
+            self.assertAlmostEqual(totals["wpm"],
+                                   sum(w for w, _ in done) / len(done))
+            self.assertAlmostEqual(totals["rolling_wpm"],
+                                   sum(w for w, _ in recent) / len(recent))
+            self.assertAlmostEqual(totals["rolling_accuracy"],
+                                   sum(a for _, a in recent) / len(recent))
+        self.assertEqual(self.history.totals()["seconds"], 25 * 30)
+        self.assertEqual(self.history.recent(3),
+                         [wpm for wpm, _ in sessions[-3:]])
+
+    # Sessions are grouped into weeks starting on Monday
+    def test_weeks(self):
+        monday = time.mktime((2026, 10, 5, 9, 0, 0, 0, 0, -1))
+        for days, wpm in [(0, 40), (6, 60), (7, 80), (21, 50)]:
+            self.history.add("quote", 20, "Easy mode", ("words", 25), wpm,
+                             95.0, 90.0, [], timestamp=monday + days * 86400)
+        weeks = self.history.weeks(10)
+        self.assertEqual([(count, average, best)
+                          for _, count, _, average, best in weeks],
+                         [(2, 50, 60), (1, 80, 80), (1, 50, 50)])
+        self.assertEqual(str(history.week_start(weeks[0][0])), "2026-10-05")
+        self.assertEqual(len(self.history.weeks(2)), 2)
+        self.assertEqual(self.history.weeks(2)[-1], weeks[-1])
+
+    # A personal best only changes when it is beaten
+    def test_bests(self):
+        for wpm in [50, 70, 60]:
+            self.history.add("words", 30, "Hard mode", ("time", 30), wpm,
+                             99.0, 90.0, [], timestamp=1e9)
+        self.history.add("words", 0, "Hard mode", ("endless", None), 40,
+                         99.0, 90.0, [], timestamp=1e9)
+        self.assertEqual([(mode, wpm) for _, mode, wpm, _, _
+                          in self.history.bests()],
+                         [("time 30", 70), ("endless", 40)])
+        self.assertEqual(history.parse_mode("endless"), ("endless", None))
+        self.assertEqual(history.parse_mode("words 25"), ("words", 25))
+
+    # The wpm series of a session is stored with it
+    def test_series(self):
+        stats = TypingStats("the quick brown fox jumps over the lazy dog")
+        start = 10**12
+        for i, char in enumerate("the quick brxwn fox jumps"):
+            stats.add_char(char, start + i * 200_000_000)
+        stats.backspace(start + 26 * 200_000_000)
+        end = start + 27 * 200_000_000
+        series = stats.wpm_series(end)
+        self.assertEqual(len(series), 6)
+        self.assertEqual(series[-1], stats.wpm_at(end)[1])
+        # Six characters in the first second
+        self.assertEqual(series[0], 72)
+
+        with patch("history.get_history", return_value=self.history):
+            history.record_session(stats, end, "words", False, ("time", 30))
+        self.assertEqual(self.history.last_series(), series)
+        self.assertEqual(self.history.totals()["seconds"], 5.4)
+
+    def test_chart_rows(self):
+        self.assertEqual(history.chart_rows([0, 5, 10, 15, 20], 2),
+                         ["   :#", " :###"])
+        self.assertEqual(history.chart_rows([], 2), ["", ""])
+
+
+class Test_startup(unittest.TestCase):
+    # Reaching the menu doesn't load the slow, rarely used modules
+    def test_lazy_imports(self):
+        result = benchmark.measure_startup(runs=1)[0]
+        self.assertNotIn("numpy", result["modules"])
+        self.assertNotIn("requests", result["modules"])
+
+    # Time to menu stays well inside the startup budget. Timings
+    # depend on the machine, so this only runs when asked for
+    @ unittest.skipUnless(environ.get("TYPING_WIZARD_BENCHMARKS"),
+                          "set TYPING_WIZARD_BENCHMARKS=1 to run timings")
+    def test_time_to_menu(self):
+        report = benchmark.startup_report(benchmark.measure_startup(runs=3))
+        self.assertLess(report["time_to_menu_median_ms"], 500)
+
+
+class Test_game_benchmark(unittest.TestCase):
+    # A scripted session runs through the menu, game and results screen
+    def test_session(self):
+        prompt = benchmark.make_prompt(40)
+        self.assertEqual(len(prompt), 40)
+        script = benchmark.typing_script(prompt, 300)
+        window = benchmark.run_session(script, prompt)
+        # Every key is used: menu choice, the prompt and esc
+        self.assertEqual(window.keys_sent, 42)
+        self.assertEqual(len(window.latencies), 42)
+        self.assertGreater(len(window.frame_times), 40)
+
+    # Setup before the first key, like building the width table,
+    # isn't counted as keystroke latency
+    def test_cold_start(self):
+        table = widths.load_table()
+
+        def slow_build():
+            time.sleep(0.3)
+            return table
+
+        prompt = benchmark.make_prompt(40, letters=benchmark.WIDE_LETTERS)
+        script = benchmark.typing_script(prompt, 300)
+        with patch("widths._table", None), \
+                patch("widths.build_table", slow_build):
+            window = benchmark.run_session(script, prompt)
+        self.assertLess(max(window.latencies), 0.2)
+
+    # An endless session grows the prompt until enter ends it
+    def test_endless_session(self):
+        prompt = benchmark.make_prompt(40)
+        chunks = [benchmark.make_prompt(40, seed) for seed in range(1, 5)]
+        # The last chunk is left untyped, so only enter can end the test
+        text = benchmark.endless_prompt(prompt, chunks[:-1])
+        script = benchmark.typing_script(text, 300, duration=600,
+                                         endless=True)
+        window = benchmark.run_session(script, prompt, chunks=chunks)
+        # Menu choice, two length changes, the prompt, enter and esc
+        self.assertEqual(window.keys_sent, len(text) + 5)
+        stats, _, _, _, test_mode = window.recorded.call_args[0]
+        self.assertEqual(test_mode, ("endless", None))
+        self.assertEqual(stats.typed, len(text))
+        self.assertFalse(stats.finished())
+        self.assertEqual(stats.prompt, benchmark.endless_prompt(prompt, chunks))
+
+    # Keys are only delivered once the app waits long enough for them
+    def test_scripted_timeout(self):
+        clock = benchmark.VirtualClock()
+        window = benchmark.ScriptedWindow([(5, 97)], clock)
+        window.timeout(1000)
+        self.assertEqual(window.getch(), -1)
+        window.timeout(-1)
+        self.assertEqual(window.getch(), 97)
+        self.assertGreaterEqual(clock.monotonic() - window.start, 5)
+
+    # Results that got worse than the baseline are reported
+    def test_compare(self):
+        baseline = {"a": {"frame_time_ms": {"p50": 1.0},
+                          "latency_ms": {"p50": 1.0},
+                          "calls_per_frame": 10, "chars_per_frame": 40,
+                          "peak_memory_kb": 100}}
+        report = {"a": {"frame_time_ms": {"p50": 2.0},
+                        "latency_ms": {"p50": 1.1},
+                        "calls_per_frame": 10, "chars_per_frame": 40,
+                        "peak_memory_kb": 200}}
+        self.assertEqual(benchmark.compare_reports(baseline, report),
+                         ["a frame_time_ms p50: 1.0 -> 2.0",
+                          "a peak_memory_kb: 100 -> 200"])
+        self.assertEqual(benchmark.percentiles([0.001, 0.002, 0.003]),
+                         {"p50": 2.0, "p95": 3.0, "p99": 3.0, "max": 3.0})
+
+
+class Test_score_store(Temp_data_test):
+    def setUp(self):
+        super().setUp()
+        self.store = ScoreStore(path.join(self.folder.name, "scores.db"))
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    # Scores are ranked by wpm as a number, then difficulty
+    def test_rank_order(self):
+        self.store.add("Matt 1", 72, 100.0, "Easy mode", 0)
+        self.store.add("Matt 2", 100, 90.0, "Easy mode", 50.5)
+        self.store.add("Matt 3", 72, 100.0, "Hard mode", 0)
+        self.assertEqual([row[:5] for row in self.store.page(10)], [
+            ("Matt 2", 100, "Easy mode", 50.5, 90.0),
+            ("Matt 3", 72, "Hard mode", 0.0, 100.0),
+            ("Matt 1", 72, "Easy mode", 0.0, 100.0)])
+
+    # Usernames can only be used once
+    def test_unique_username(self):
+        self.assertTrue(self.store.add("Matt", 72, 100.0, "Easy mode", 0))
+        self.assertFalse(self.store.add("Matt", 90, 100.0, "Easy mode", 0))
+        self.assertEqual(self.store.find("Matt")[1], 72)
+        self.assertFalse(self.store.add("", 90, 100.0, "Easy mode", 0))
+        self.assertEqual(self.store.count(), 1)
+
+    # Enter before a username is typed waits for one, rather than
+    # saying the name can't be used
+    def test_final_screen_empty_username(self):
+        window = benchmark.FakeWindow([10, " ", 10, "M", "a", "t", "t", 10])
+        with benchmark.fake_curses() as stack:
+            stack.enter_context(patch("helpers.get_terminal_size",
+                                      return_value=(100, 30)))
+            stack.enter_context(patch("helpers._terminal_size", None))
+            stack.enter_context(patch("score_store._store", self.store))
+            sleep = stack.enter_context(patch("helpers.sleep"))
+            self.assertEqual(helpers.final_screen(window, 50.0, 72, 100.0,
+                                                  False, 0, 0), 1)
+        sleep.assert_not_called()
+        self.assertEqual(self.store.find("Matt")[:3], ("Matt", 72, "Easy mode"))
+
+    # Old scores.txt files are imported, skipping bad lines
+    def test_import_legacy_scores(self):
+        file_path = path.join(self.folder.name, "scores.txt")
+        with open(file_path, "w") as f:
+            f.write("Matt 1: 77wpm, Easy mode, 84.52% consistency, 100.0% accuracy\n"
+                    "Matt 2: 90wpm, 100.0% accuracy, 84.52% consistency, Hard mode\n"
+                    "not a score\n"
+                    "Matt 1: 10wpm, Easy mode, 1.0% consistency, 1.0% accuracy\n")
+        self.assertEqual(self.store.import_legacy_scores(file_path), 2)
+        self.assertEqual(self.store.import_legacy_scores(file_path), 0)
+        # Imported scores are counted, the skipped duplicate isn't
+        self.assertEqual(self.store.count(), 2)
+        self.assertEqual(self.store.count("Easy mode"), 1)
+        self.assertEqual(self.store.page(1)[0][:5],
+                         ("Matt 2", 90, "Hard mode", 84.52, 100.0))
+
+    # The old scores.txt file is only looked for when the database is made
+    def test_import_on_create(self):
+        data = path.join(self.folder.name, "data")
+        with patch.dict(environ, {"TYPING_WIZARD_DATA": data}), \
+                patch("score_store.ScoreStore.import_legacy_scores") as imported:
+            for _ in range(2):
+                with patch("score_store._store", None):
+                    score_store.get_store().close()
+        imported.assert_called_once_with()
+
+    def add_scores(self, count):
+        # Speeds count down, every third score is hard mode
+        for i in range(count):
+            self.store.add(f"user{i:02}", 100 - i, 90.0 + i / 10,
+                           "Hard mode" if i % 3 == 0 else "Easy mode",
+                           float(i % 7))
+
+    # Pages start, follow or come before a row in any sort and filter
+    def test_page(self):
+        self.add_scores(30)
+        names = [row[0] for row in self.store.page(100)]
+        self.assertEqual(names[:3], ["user00", "user01", "user02"])
+        row = self.store.find("user10")
+        key = sort_key(row, "wpm")
+        self.assertEqual([r[0] for r in self.store.page(2, after=key)],
+                         ["user11", "user12"])
+        self.assertEqual([r[0] for r in self.store.page(2, before=key)],
+                         ["user08", "user09"])
+        self.assertEqual([r[0] for r in self.store.page(1, start=key)],
+                         ["user10"])
+        hard = self.store.page(100, difficulty="Hard mode")
+        self.assertEqual(len(hard), 10)
+        self.assertEqual(self.store.count("Hard mode"), 10)
+        self.assertEqual(self.store.count(), 30)
+        self.assertEqual([r[0] for r in self.store.page(3, "accuracy", True)],
+                         ["user00", "user01", "user02"])
+        self.assertEqual([r[0] for r in self.store.page(2, "username", True)],
+                         ["user29", "user28"])
+        # Ties put the newest score first
+        self.assertEqual([r[0] for r in self.store.page(3, "consistency")],
+                         ["user27", "user20", "user13"])
+        self.assertEqual(self.store.rank(row), 10)
+        self.assertEqual(self.store.rank(row, difficulty="Easy mode"), 6)
+        self.assertEqual(self.store.find("nobody"), None)
+
+        # Removed scores are counted out
+        self.store.connection.execute("DELETE FROM scores WHERE id = 1")
+        self.assertEqual(self.store.count("Hard mode"), 9)
+
+    # The view scrolls a page at a time, keeping the rank of its first row
+    def test_leaderboard_view(self):
+        self.add_scores(30)
+        view = LeaderboardView(self.store, 5)
+        self.assertEqual(view.visible[0][0], "user00")
+        self.assertTrue(view.more)
+        view.scroll(7)
+        self.assertEqual((view.first_rank, view.visible[0][0]), (7, "user07"))
+        view.scroll(-3)
+        self.assertEqual((view.first_rank, view.visible[0][0]), (4, "user04"))
+        view.scroll(-10)
+        self.assertEqual((view.first_rank, view.visible[0][0]), (0, "user00"))
+        # Scrolling stops once the last row is on screen
+        view.scroll(100)
+        self.assertEqual((view.first_rank, view.visible[-1][0]), (25, "user29"))
+        self.assertFalse(view.more)
+        view.home()
+        view.end()
+        self.assertEqual((view.first_rank, view.visible[0][0]), (25, "user25"))
+        view.set_sort("wpm")
+        self.assertEqual(view.visible[0][0], "user29")
+        view.next_difficulty()
+        self.assertEqual([row[2] for row in view.visible], ["Hard mode"] * 5)
+        self.assertTrue(view.jump_to("user15"))
+        self.assertEqual(view.first_rank, 2)
+        self.assertEqual([row[0] for row in view.visible],
+                         ["user21", "user18", "user15", "user12", "user09"])
+        self.assertFalse(view.jump_to("user01"))
+        self.assertEqual(self.store.last_username(), None)
+        self.store.remember_username("user15")
+        self.assertEqual(self.store.last_username(), "user15")
+
+    # Lines of scores.txt are parsed whatever order the results are in
+    def test_parse_score(self):
+        self.assertEqual(parse_score("A: b: 5wpm, Easy mode, 1.5% consistency, 2.0% accuracy"),
+                         ("A: b", 5, "Easy mode", 1.5, 2.0))
+        self.assertEqual(parse_score("sauhidfkashfkasdlkjrh"), None)
+        self.assertEqual(parse_score("A: 5wpm, Easy mode, 1.5% consistency"), None)
+
+
+class Test_replay(Temp_data_test):
+    def setUp(self):
+        super().setUp()
+
+        # "abd", backspace, "c" typed a second apart
+        self.stats = TypingStats("abc")
+        for i, char in enumerate("abd"):
+            self.stats.add_char(char, (i + 1) * 10**9)
+        self.stats.backspace(4 * 10**9)
+        self.stats.add_char("c", 5 * 10**9)
+
+    # Sessions are saved and listed newest first, with the best found
+    def test_save_and_list(self):
+        first = replay.save_session("abc", self.stats.log, 40, 100.0, 90, False)
+        second = replay.save_session("abc", self.stats.log, 30, 90.0, 80, True)
+        sessions = replay.list_sessions()
+        self.assertEqual([session[0] for session in sessions],
+                         [second, first])
+        self.assertEqual(replay.best_session(sessions)[0], first)
+        details, log = replay.load_session(first)
+        self.assertEqual(details["wpm"], 40)
+        self.assertEqual(log.columns(), self.stats.log.columns())
+
+    # A ghost or replay is as long as the session was, sessions saved
+    # before the length could be chosen were 30 seconds
+    def test_session_test_mode(self):
+        import app
+
+        saved = replay.save_session("abc", self.stats.log, 40, 100.0, 90,
+                                    False, ("words", 25))
+        test_mode = replay.session_test_mode(replay.load_session(saved)[0])
+        self.assertEqual(test_mode, ("words", 25))
+        self.assertEqual(replay.session_test_mode({}), ("time", 30))
+        ghost = replay.Playback("abc", self.stats.log, "ghost",
+                                test_mode=test_mode)
+        self.assertEqual(app.game_mode(ghost, ("time", 15)), ("words", 25))
+
+    # Old sessions are removed, apart from the best
+    def test_prune(self):
+        with patch("replay.MAX_SESSIONS", 2):
+            best = replay.save_session("abc", self.stats.log, 90, 100.0, 90,
+                                       False)
+            for wpm in [10, 20, 30]:
+                replay.save_session("abc", self.stats.log, wpm, 100.0, 90,
+                                    False)
+            sessions = replay.list_sessions()
+        self.assertEqual([session[1]["wpm"] for session in sessions],
+                         [30, 20, 90])
+        self.assertEqual(replay.best_session(sessions)[0], best)
+
+    # Seeking plays keystrokes up to a time, backwards as well
+    def test_seek(self):
+        playback = replay.Playback("abc", self.stats.log)
+        # Times are from the first keystroke
+        self.assertEqual(playback.position_at(2 * 10**9), 3)
+        self.assertEqual(playback.position_at(35 * 10**8), 2)
+        playback.seek(25 * 10**8)
+        self.assertEqual(playback.typed_text(), "abd")
+        playback.seek(3 * 10**9)
+        self.assertEqual(playback.typed_text(), "ab")
+        playback.seek(0)
+        self.assertEqual(playback.typed_text(), "a")
+        playback.seek(10 * 10**9)
+        self.assertEqual(playback.typed_text(), "abc")
+        self.assertTrue(playback.finished())
+        self.assertEqual(playback.wpm(10 * 10**9),
+                         self.stats.wpm_at(5 * 10**9))
+
+    # Playback follows the clock at its speed, which can change midway
+    def test_speed(self):
+        playback = replay.Playback("abc", self.stats.log, speed=2)
+        self.assertEqual(playback.next_event_ms(0), None)
+        playback.start(100 * 10**9)
+        self.assertEqual(playback.next_event_ms(100 * 10**9), 0)
+        playback.seek(playback.log_time(100 * 10**9))
+        self.assertEqual(playback.next_event_ms(100 * 10**9), 500)
+        playback.set_speed(0.5, 1001 * 10**8)
+        self.assertEqual(playback.log_time(1001 * 10**8), 2 * 10**8)
+        self.assertEqual(playback.log_time(1021 * 10**8), 12 * 10**8)
+
+    # Resizing and the HUD key still work while watching a replay
+    def test_replay_keys(self):
+        import app
+
+        playback = replay.Playback("abc", self.stats.log)
+        window = benchmark.FakeWindow([curses.KEY_RESIZE, curses.KEY_F2, "x"])
+        with benchmark.fake_curses() as stack:
+            stack.enter_context(patch("helpers.get_terminal_size",
+                                      return_value=(100, 30)))
+            stack.enter_context(patch("helpers.menu", return_value=(
+                PromptLayout("abc", 76), playback)))
+            reflow = stack.enter_context(patch.object(
+                PromptLayout, "reflow", autospec=True,
+                side_effect=PromptLayout.reflow))
+            toggle = stack.enter_context(patch(
+                "perf.FrameProfiler.toggle", autospec=True))
+            with self.assertRaises(benchmark.StopBenchmark):
+                app.main(window)
+        self.assertEqual(reflow.call_count, 1)
+        self.assertEqual(toggle.call_count, 1)
+
+
+class Test_race(unittest.TestCase):
+    def setUp(self):
+        # Run the server on its own event loop thread, like a real one
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self.server = race.RaceServer(lambda: "the same prompt", players=3,
+                                      countdown=0, duration=2, tick=0.02)
+        listener = self.call(self.server.serve("localhost:0"))
+        self.address = f"localhost:{listener.sockets[0].getsockname()[1]}"
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(5)
+
+    def wait_for(self, condition):
+        end = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), end)
+            time.sleep(0.01)
+
+    # Everyone gets the same prompt, and sees each other's progress
+    def test_race(self):
+        clients = [race.RaceClient(self.address, "ann", tick=0.02)
+                   for _ in range(3)]
+        for client in clients:
+            client.connect()
+        self.wait_for(lambda: all(client.status == "racing"
+                                  for client in clients))
+        self.assertEqual({client.prompt for client in clients},
+                         {"the same prompt"})
+        # Names are made unique
+        self.assertEqual(sorted(client.name for client in clients),
+                         ["ann", "ann2", "ann3"])
+
+        for typed, client in enumerate(clients):
+            client.send_progress(typed, 10 * typed)
+        self.wait_for(lambda: [state[1] for state in clients[0].standings()]
+                      == [2, 1, 0])
+        for client in clients:
+            client.send_progress(5, 50, True)
+        self.wait_for(lambda: all(client.status == "finished"
+                                  for client in clients))
+        for client in clients:
+            client.close()
+
+    # Progress from 100+ clients is merged into one message a tick
+    def test_many_clients(self):
+        self.server.players = 120
+
+        async def player(number):
+            reader, writer = await asyncio.open_connection(
+                *race.parse_address(self.address))
+            writer.write(race.encode({"type": "join", "name": number}))
+            while json.loads(await reader.readline())["type"] != "start":
+                pass
+            for typed in range(1, 6):
+                writer.write(race.encode({"type": "progress", "typed": typed,
+                                          "wpm": 60, "done": typed == 5}))
+            board = {}
+            messages = 0
+            while True:
+                message = json.loads(await reader.readline())
+                if message["type"] == "results":
+                    break
+                messages += 1
+                for state in message["players"]:
+                    board[state[0]] = state
+            writer.close()
+            return board, messages
+
+        async def race_all():
+            return await asyncio.gather(*[player(i) for i in range(120)])
+
+        results = self.call(race_all())
+        for board, messages in results:
+            self.assertEqual(len(board), 120)
+            self.assertTrue(all(state[1] == 5 for state in board.values()))
+            # Far fewer messages than the 600 progress updates sent
+            self.assertLess(messages, 20)
+
+    # Progress must be counts and a boolean
+    def test_read_progress(self):
+        self.assertEqual(race.read_progress(
+            {"typed": 5, "wpm": 60, "done": False}), (5, 60, False))
+        for bad in [{"typed": "5", "wpm": 60, "done": False},
+                    {"typed": True, "wpm": 60, "done": False},
+                    {"typed": 5, "wpm": -1, "done": False},
+                    {"typed": 5, "wpm": 60, "done": 1}]:
+            with self.assertRaises(ValueError):
+                race.read_progress(bad)
+        with self.assertRaises(KeyError):
+            race.read_progress({"typed": 5})
+        self.assertEqual(race.read_states([["ann", 5, 60, True]]),
+                         [["ann", 5, 60, True]])
+        for bad in [None, [["ann", 5, 60]], [[1, 5, 60, True]]]:
+            with self.assertRaises(ValueError):
+                race.read_states(bad)
+
+    # A message that can't be read disconnects its sender, who is
+    # taken out of the race
+    def test_bad_message(self):
+        self.server.players = 1
+
+        async def player(message):
+            reader, writer = await asyncio.open_connection(
+                *race.parse_address(self.address))
+            writer.write(race.encode({"type": "join", "name": "ann"}))
+            while json.loads(await reader.readline())["type"] != "start":
+                pass
+            writer.write(message)
+            # The server closes the connection rather than racing on
+            rest = await reader.read()
+            writer.close()
+            return rest
+
+        for message in [b"5\n", b"[]\n", b'{"name": "ann"}\n', b"{\n",
+                        race.encode({"type": "progress", "typed": "5",
+                                     "wpm": 60, "done": False}),
+                        race.encode({"type": "progress", "typed": None,
+                                     "wpm": 60, "done": False})]:
+            self.assertNotIn(b'"results"', self.call(player(message)))
+            self.wait_for(lambda: self.server.race == None)
+            self.assertEqual(self.server.lobby + self.server.racers, [])
+
+    # A message the client can't use ends its race with an error,
+    # rather than leaving it waiting
+    def test_client_bad_message(self):
+        lines = [b"5\n", b'{"type": "start"}\n',
+                 race.encode({"type": "lobby", "players": "2",
+                              "needed": 3}),
+                 race.encode({"type": "start", "prompt": "the", "start_in": 0,
+                              "duration": 30, "players": [["ann", 1]]})]
+        for line in lines:
+            async def send_line(reader, writer):
+                await reader.readline()
+                writer.write(line)
+
+            listener = self.call(asyncio.start_server(send_line,
+                                                      "localhost", 0))
+            client = race.RaceClient(
+                f"localhost:{listener.sockets[0].getsockname()[1]}", "ann")
+            client.connect()
+            self.wait_for(lambda: client.status == "error")
+            self.assertIn("race server", client.error)
+            listener.close()
+
+    # With no prompt to race on, the players are told and sent away
+    def test_no_prompt(self):
+        self.server.prompt_source = lambda: None
+        self.server.players = 1
+        client = race.RaceClient(self.address, "ann", tick=0.02)
+        client.connect()
+        self.wait_for(lambda: client.status == "error")
+        self.assertIn("no prompt", client.error)
+        self.wait_for(lambda: self.server.race == None)
+        self.assertEqual(self.server.lobby + self.server.racers, [])
+
+    # A slow client misses progress, but not the start or results, and
+    # is sent everyone's progress once it catches up
+    def test_slow_client(self):
+        racers = [race.Player(name, mock.Mock()) for name in ["ann", "bob"]]
+        slow = racers[1].writer.transport
+        slow.is_closing.return_value = False
+        slow.get_write_buffer_size.return_value = race.WRITE_LIMIT + 1
+        racers[0].writer.transport.is_closing.return_value = False
+        racers[0].writer.transport.get_write_buffer_size.return_value = 0
+        self.server.racers = racers
+
+        racers[0].typed = 3
+        self.server.changed = {"ann": racers[0]}
+        self.server.broadcast_progress()
+        racers[1].writer.write.assert_not_called()
+        self.assertTrue(racers[1].behind)
+        self.server.send(racers, race.encode({"type": "results"}))
+        racers[1].writer.write.assert_called_once()
+
+        slow.get_write_buffer_size.return_value = 0
+        racers[1].writer.write.reset_mock()
+        self.server.broadcast_progress()
+        message = json.loads(racers[1].writer.write.call_args[0][0])
+        self.assertEqual(message["players"], [["ann", 3, 0, False],
+                                              ["bob", 0, 0, False]])
+        self.assertFalse(racers[1].behind)
+        # ann was up to date, so isn't sent the same progress again
+        self.assertEqual(racers[0].writer.write.call_count, 2)
+        self.server.racers = []
+
+
+class Test_keystats(Temp_data_test):
+    def setUp(self):
+        super().setUp()
+        self.file_path = path.join(self.folder.name, "keystats.npy")
+
+        # "thE" with the E fixed, then " t" after a long pause
+        self.stats = TypingStats("the the")
+        for char, time_ms in [("t", 0), ("h", 100), ("E", 250)]:
+            self.stats.add_char(char, time_ms * 10**6)
+        self.stats.backspace(400 * 10**6)
+        for char, time_ms in [("e", 500), (" ", 600), ("t", 5000)]:
+            self.stats.add_char(char, time_ms * 10**6)
+
+    def index(self, char):
+        return ord(char) - 31
+
+    # Each keystroke counts against the prompt character and the one before
+    def test_record(self):
+        keystats.record_session("the the", self.stats.log, self.file_path)
+        data = keystats.open_stats(self.file_path, "r")
+        t, h, e = self.index("t"), self.index("h"), self.index("e")
+        space = self.index(" ")
+        self.assertEqual(data[keystats.ATTEMPTS].sum(), 6)
+        self.assertEqual(data[keystats.ATTEMPTS, h, e], 2)
+        self.assertEqual(data[keystats.ERRORS, h, e], 1)
+        # No gap before the first key, after a backspace or over a pause
+        self.assertEqual(data[keystats.TIMED].sum(), 3)
+        self.assertEqual(data[keystats.TOTAL_MS, t, h], 100)
+        self.assertEqual(data[keystats.TOTAL_MS, h, e], 150)
+        self.assertEqual(data[keystats.ATTEMPTS, space, t], 1)
+        self.assertEqual(data[keystats.TIMED, space, t], 0)
+        self.assertEqual(data[keystats.ATTEMPTS, 0, t], 1)
+
+    # Sessions add up, and the summary merges shifted keys with their key
+    def test_summary(self):
+        for _ in range(3):
+            keystats.record_session("the the", self.stats.log, self.file_path)
+        data = keystats.open_stats(self.file_path, "r")
+        summary = keystats.key_summary(data)
+        self.assertEqual(summary["e"], (150.0, 0.5, 6))
+        self.assertEqual(summary["t"], (None, 0.0, 6))
+        self.assertEqual(summary["q"], (None, 0.0, 0))
+        self.assertEqual(keystats.slowest_bigrams(data),
+                         [("he", 150.0), ("e ", 100.0), ("th", 100.0)])
+
+    # Another process can't lock the statistics while a session is added
+    @unittest.skipIf(keystats.fcntl == None, "needs fcntl")
+    def test_record_locked(self):
+        open_stats = keystats.open_stats
+        held = []
+
+        def check_lock(file_path):
+            with open(file_path + ".lock", "a") as lock:
+                try:
+                    keystats.fcntl.flock(lock, keystats.fcntl.LOCK_EX
+                                         | keystats.fcntl.LOCK_NB)
+                    held.append(False)
+                except BlockingIOError:
+                    held.append(True)
+            return open_stats(file_path)
+
+        with patch("keystats.open_stats", check_lock):
+            keystats.record_session("the the", self.stats.log, self.file_path)
+        self.assertEqual(held, [True])
+        data = keystats.open_stats(self.file_path, "r")
+        self.assertEqual(data[keystats.ATTEMPTS].sum(), 6)
+
+
+class Test_practice(Temp_data_test):
+    counts = "the\t100\nthen\t50\nhat\t20\nquiz\t5\ncafé\t5\nthe\t10\n"
+
+    def setUp(self):
+        super().setUp()
+        self.corpus = corpus.build_corpus(self.counts)
+        corpus.set_corpus(self.corpus)
+        practice._index = None
+
+    def tearDown(self):
+        corpus.set_corpus(None)
+        practice._index = None
+        super().tearDown()
+
+    def words(self, index, pair):
+        return [self.corpus.word(i) for i in index.words_with(pair)]
+
+    # Pairs map to their words most common first, spaces count at each end
+    def test_index(self):
+        index = practice.build_index(self.corpus)
+        self.assertEqual(self.words(index, "th"), ["the", "then"])
+        self.assertEqual(self.words(index, "he"), ["the", "then"])
+        self.assertEqual(self.words(index, "at"), ["hat"])
+        self.assertEqual(self.words(index, " q"), ["quiz"])
+        self.assertEqual(self.words(index, "e "), ["the"])
+        self.assertEqual(self.words(index, "zz"), [])
+        self.assertEqual(self.words(index, "fé"), [])
+        self.assertEqual(self.words(index, "af"), ["café"])
+
+    # The index is saved once and rebuilt when the word list changes
+    def test_load_index(self):
+        index = practice.load_index(self.corpus)
+        self.assertTrue(path.isfile(path.join(self.folder.name,
+                                              practice.INDEX_FILE)))
+        practice._index = None
+        self.assertTrue(practice.load_index(self.corpus).matches(self.corpus))
+        changed = corpus.build_corpus(self.counts + "zoo\t1\n")
+        self.assertFalse(index.matches(changed))
+        index = practice.load_index(changed)
+        self.assertEqual([changed.word(i) for i in index.words_with("oo")],
+                         ["zoo"])
+
+    # Every word picked has one of the target pairs
+    def test_words(self):
+        index = practice.build_index(self.corpus)
+        words = practice.practice_words(self.corpus, index,
+                                        [("qu", 1), ("at", 3), ("xx", 5)],
+                                        count=20, seed=1)
+        self.assertEqual(len(words), 20)
+        self.assertEqual(set(words), {"quiz", "hat"})
+        self.assertEqual(practice.practice_words(self.corpus, index,
+                                                 [("xx", 1)]), [])
+
+    # Slow and mistyped pairs from finished games make the prompt
+    def test_prompt(self):
+        self.assertEqual(practice.practice_prompt(), None)
+        stats = TypingStats("hat Hat")
+        for i, char in enumerate("hat Hat"):
+            stats.add_char(char, i * 100 * 10**6)
+        for _ in range(3):
+            keystats.record_session("hat Hat", stats.log)
+        self.assertEqual(practice.target_pairs([("Ha", 300.0), ("ha", 200.0)]),
+                         [("ha", 300.0)])
+        words = practice.practice_prompt(10, seed=2).split(" ")
+        self.assertEqual(len(words), 10)
+        self.assertTrue(set(words) <= {"the", "hat"})
+
+
+class Test_passages(Temp_data_test):
+    text = ("One two three. Four five six!  Seven eight nine?\n\n"
+            "Ten eleven twelve. Thirteen fourteen.\n")
+
+    def setUp(self):
+        super().setUp()
+        self.file_path = path.join(self.folder.name, "book.txt")
+        with open(self.file_path, "w") as f:
+            f.write(self.text)
+
+    # The index holds the byte offset of every sentence
+    def test_index(self):
+        index_file = passages.index_path(self.file_path)
+        self.assertEqual(passages.build_index(self.file_path, index_file), 5)
+        index, header = passages.open_index(self.file_path)
+        with index:
+            offsets = index.read()
+        starts = [self.text.encode()[offset:offset + 3] for offset in
+                  passages.array("Q", offsets)]
+        self.assertEqual(starts, [b"One", b"Fou", b"Sev", b"Ten", b"Thi"])
+
+    # Sentence endings split across read chunks are still found
+    @ patch("passages.READ_SIZE", 3)
+    def test_index_chunks(self):
+        index_file = passages.index_path(self.file_path)
+        self.assertEqual(passages.build_index(self.file_path, index_file), 5)
+        with open(index_file, "rb") as f:
+            offsets = passages.array("Q", f.read()[passages.HEADER.size:])
+        self.assertEqual(list(offsets), [0, 15, 31, 50, 69])
+
+    # Random passages start at a sentence and are limited in length
+    def test_random_passage(self):
+        passage = passages.load_passage(self.file_path, 4, seed=3)
+        self.assertEqual(len(passage.split()), min(4, len(passage.split())))
+        self.assertIn(passage.split()[0],
+                      ["One", "Four", "Seven", "Ten", "Thirteen"])
+        self.assertEqual(passages.load_passage(self.file_path, 50, 10,
+                                               seed=0)[:10],
+                         passages.load_passage(self.file_path, 50, 10,
+                                               seed=0))
+
+    # Sequential passages follow on from each other, wrapping at the end
+    def test_sequential_passages(self):
+        read = [passages.load_passage(self.file_path, 4, sequential=True)
+                for _ in range(4)]
+        self.assertEqual(read, ["One two three. Four",
+                                "Seven eight nine? Ten",
+                                "Thirteen fourteen.",
+                                "One two three. Four"])
+
+    # The index is rebuilt when the file changes
+    def test_changed_file(self):
+        passages.load_passage(self.file_path)
+        with open(self.file_path, "w") as f:
+            f.write("Completely new text here.")
+        self.assertEqual(passages.load_passage(self.file_path),
+                         "Completely new text here.")
+
+    # Empty and whitespace-only files have no passages
+    def test_empty_file(self):
+        for text in ["", "  \n\n "]:
+            with open(self.file_path, "w") as f:
+                f.write(text)
+            self.assertEqual(passages.load_passage(self.file_path), None)
 
 
 if __name__ == "__main__":
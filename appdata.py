@@ -0,0 +1,17 @@
+from os import environ, getcwd, makedirs, path
+
+
+# Folder the app keeps its data files in, relative to where it is run
+# like scores.txt, can be moved with the TYPING_WIZARD_DATA variable
+DATA_FOLDER = ".typing_wizard"
+
+
+def data_path(file_name):
+    ''' Returns the path of a file in the app data
+    folder, creating its folder if it doesn't exist'''
+
+    folder = environ.get("TYPING_WIZARD_DATA",
+                         path.join(getcwd(), DATA_FOLDER))
+    file_path = path.join(folder, file_name)
+    makedirs(path.dirname(file_path), exist_ok=True)
+    return file_path
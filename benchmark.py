@@ -0,0 +1,546 @@
+import sys
+import time
+from math import ceil
+from random import Random
+from unittest import mock
+
+
+class StopBenchmark(Exception):
+    ''' Raised by FakeWindow when it runs out of scripted keys'''
+
+
+class FakeWindow:
+    ''' Stands in for a curses window so the app can run without a
+    terminal, keys are taken from a script and draw calls are counted'''
+
+    def __init__(self, keys=(), on_refresh=None):
+        self.keys = list(keys)
+        self.on_refresh = on_refresh
+        self.addstr_calls = 0
+        self.refreshes = 0
+
+    def getch(self):
+        if len(self.keys) == 0:
+            raise StopBenchmark()
+        return self.keys.pop(0)
+
+    def get_wch(self):
+        ''' Like getch, but returns characters as strings and raises
+        curses.error on a timeout, as curses does'''
+
+        import curses
+
+        key = self.getch()
+        if key == -1:
+            raise curses.error("no input")
+        # Scripts give typed characters as strings, and keys
+        # below the curses KEY_ codes as their character codes
+        if isinstance(key, int) and key < curses.KEY_MIN:
+            return chr(key)
+        return key
+
+    def addstr(self, *args):
+        self.addstr_calls += 1
+
+    def refresh(self):
+        self.refreshes += 1
+        if self.on_refresh:
+            self.on_refresh(self)
+
+    def noutrefresh(self):
+        self.refresh()
+
+    def erase(self):
+        pass
+
+    def move(self, y, x):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def nodelay(self, flag):
+        pass
+
+    def timeout(self, delay):
+        pass
+
+
+def fake_curses(width=100, height=30):
+    ''' Returns patches that replace the curses calls needing a
+    real terminal, and the terminal size, for use in a with block'''
+
+    from contextlib import ExitStack
+
+    stack = ExitStack()
+    for name in ["start_color", "use_default_colors", "init_pair"]:
+        stack.enter_context(mock.patch(f"curses.{name}"))
+    # Calls made every frame are plain functions, as mocks remember
+    # each call and would grow the peak memory of long sessions
+    stack.enter_context(mock.patch("curses.curs_set", lambda visibility: 0))
+    stack.enter_context(mock.patch("curses.doupdate", lambda: None))
+    stack.enter_context(mock.patch("curses.color_pair", lambda n: n << 8))
+    stack.enter_context(mock.patch("curses.COLORS", 256, create=True))
+    stack.enter_context(mock.patch("curses.COLOR_PAIRS", 65536, create=True))
+    stack.enter_context(mock.patch("os.get_terminal_size",
+                                   return_value=(width, height)))
+    return stack
+
+
+class VirtualClock:
+    ''' Stands in for time.monotonic in the app: real time plus the time
+    a ScriptedWindow skipped instead of waiting for the next key, so
+    scripted sessions run as fast as the app can process them'''
+
+    def __init__(self):
+        self.skipped = 0.0
+
+    def monotonic(self):
+        return time.perf_counter() + self.skipped
+
+    def monotonic_ns(self):
+        return int(self.monotonic() * 1e9)
+
+    def skip(self, seconds):
+        if seconds > 0:
+            self.skipped += seconds
+
+
+class ScriptedWindow(FakeWindow):
+    ''' FakeWindow that delivers keys at scripted times on a virtual
+    clock, honouring the app's input timeouts, and records the frame
+    time, keystroke to render latency and curses calls of each frame'''
+
+    def __init__(self, script, clock):
+        # script is a list of (seconds from the start, key code or
+        # typed character)
+        super().__init__()
+        self.script = list(script)
+        self.clock = clock
+        self.start = clock.monotonic()
+
+        # Milliseconds getch waits for a key, -1 to wait forever
+        self.delay = -1
+
+        # Times the keys drawn in the next frame were due
+        self.pending = []
+        # Real time the last getch returned
+        self.woke = time.perf_counter()
+
+        # Curses calls and characters written since the last frame
+        self.calls = 0
+        self.chars = 0
+
+        self.keys_sent = 0
+        self.frame_times = []
+        self.latencies = []
+        self.frame_calls = []
+        self.frame_chars = []
+
+    def getch(self):
+        if len(self.script) == 0:
+            raise StopBenchmark()
+        due = self.start + self.script[0][0]
+        wait = due - self.clock.monotonic()
+
+        # Time out if the next key isn't due before the delay is up
+        if wait > 0:
+            if self.delay >= 0 and self.delay / 1000 < wait:
+                self.clock.skip(self.delay / 1000)
+                self.woke = time.perf_counter()
+                return -1
+            self.clock.skip(wait)
+
+        self.keys_sent += 1
+        self.pending.append(due)
+        self.woke = time.perf_counter()
+        return self.script.pop(0)[1]
+
+    def addstr(self, *args):
+        self.calls += 1
+        self.chars += len(args[2] if isinstance(args[0], int) else args[0])
+
+    def move(self, y, x):
+        self.calls += 1
+
+    def clrtoeol(self):
+        self.calls += 1
+
+    def erase(self):
+        self.calls += 1
+
+    def noutrefresh(self):
+        self.calls += 1
+
+    def refresh(self):
+        self.calls += 1
+        self.doupdate()
+
+    def nodelay(self, flag):
+        self.delay = 0 if flag else -1
+
+    def timeout(self, delay):
+        self.delay = delay
+
+    def doupdate(self):
+        ''' Ends a frame, everything drawn since the last one is sent'''
+
+        self.frame_times.append(time.perf_counter() - self.woke)
+        now = self.clock.monotonic()
+        self.latencies.extend(now - due for due in self.pending)
+        self.pending = []
+        self.frame_calls.append(self.calls + 1)
+        self.frame_chars.append(self.chars)
+        self.calls = 0
+        self.chars = 0
+
+
+# Letters of a prompt mixing accented letters with Chinese, Japanese
+# and Korean characters, which take two screen columns
+WIDE_LETTERS = "etaoinséèüñç中文字日本語のかな한국어"
+
+# Game benchmark scenarios: typing speed, prompt length, fraction of
+# keys typed wrong and corrected, keys typed in each burst before a
+# pause of the given seconds, seconds of an endless test, which adds
+# prompt_chars more characters to the prompt whenever it runs low, and
+# the letters the prompt's words are made of
+SCENARIOS = {
+    "steady-80wpm": {"wpm": 80, "prompt_chars": 300},
+    "burst-200wpm": {"wpm": 200, "prompt_chars": 600,
+                     "burst": 25, "pause": 1.0},
+    "errors-120wpm": {"wpm": 120, "prompt_chars": 400, "error_rate": 0.1},
+    "long-prompt": {"wpm": 200, "prompt_chars": 5000},
+    "endless-30min": {"wpm": 80, "prompt_chars": 300, "endless": 30 * 60},
+    "wide-chars-80wpm": {"wpm": 80, "prompt_chars": 300,
+                         "error_rate": 0.1, "letters": WIDE_LETTERS},
+}
+
+
+def make_prompt(chars, seed=0, letters="etaoinshrdlucmfwypvbgkjqxz"):
+    ''' Returns a prompt of random words, chars long'''
+
+    random = Random(seed)
+    words = []
+    length = -1
+    while length < chars:
+        word = "".join(random.choice(letters)
+                       for _ in range(random.randint(2, 8)))
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:chars]
+
+
+def typing_script(prompt, wpm, error_rate=0.0, burst=0, pause=0.0,
+                  duration=30, seed=0, endless=False):
+    ''' Returns the (seconds, key) script for a session: choosing random
+    words from the menu, typing the prompt at wpm for up to duration
+    seconds, then leaving the results screen with esc. An endless test
+    is chosen before typing and ended with enter'''
+
+    import curses
+
+    random = Random(seed)
+    interval = 60 / (wpm * 5)
+
+    # Choose option 2 from the menu, then endless from the 30 second test
+    script = [(0.0, ord("2"))]
+    t = 0.5
+    if endless:
+        script += [(0.2, curses.KEY_LEFT), (0.3, curses.KEY_LEFT)]
+    typing_start = None
+    for i, char in enumerate(prompt):
+        # Stop before the test runs out so no key lands on the results screen
+        if typing_start != None and t - typing_start >= duration - 1:
+            break
+        if burst and i and i % burst == 0:
+            t += pause
+        if random.random() < error_rate:
+            script.append((t, "#"))
+            script.append((t + interval, 127))
+            t += interval * 2
+        script.append((t, char))
+        if typing_start == None:
+            typing_start = t
+        t += interval
+
+    # Wait for the test to end, then go back to the menu
+    if endless:
+        script.append((t, 10))
+        t += 1
+    else:
+        t = typing_start + duration + 1
+    script.append((t, 27))
+    return script
+
+
+def percentiles(values, points=(50, 95, 99)):
+    ''' Returns the nearest-rank percentiles and maximum of a list of
+    seconds, in milliseconds'''
+
+    values = sorted(values)
+    if len(values) == 0:
+        return {}
+    result = {}
+    for point in points:
+        rank = max(0, ceil(point / 100 * len(values)) - 1)
+        result[f"p{point}"] = round(values[rank] * 1000, 3)
+    result["max"] = round(values[-1] * 1000, 3)
+    return result
+
+
+def endless_prompt(prompt, chunks):
+    ''' Returns the text an endless prompt grows to as each chunk is
+    added, the same way layout.PromptLayout joins them'''
+
+    text = prompt
+    for chunk in chunks:
+        if text and not text[-1].isspace():
+            text += " "
+        text += chunk
+    return text
+
+
+def run_session(script, prompt, width=100, height=30, chunks=()):
+    ''' Runs app.main from the menu to the results screen on a
+    ScriptedWindow, returns the window with its measurements.
+    chunks are the words a growing prompt is given after prompt.
+    Data files go in a temporary folder, never the user's, and the
+    window's recorded mock holds the session added to the history'''
+
+    import os
+    import tempfile
+    import app
+    import helpers
+    import widths
+
+    more = iter(chunks)
+    clock = VirtualClock()
+    window = ScriptedWindow(script, clock)
+    with fake_curses(width, height) as stack:
+        folder = stack.enter_context(tempfile.TemporaryDirectory())
+        stack.enter_context(mock.patch.dict(
+            os.environ, {"TYPING_WIZARD_DATA": folder}))
+        stack.enter_context(mock.patch("score_store._store", None))
+        stack.enter_context(mock.patch("history._history", None))
+        stack.enter_context(mock.patch("curses.doupdate", window.doupdate))
+        stack.enter_context(mock.patch("helpers.get_terminal_size",
+                                       return_value=(width, height)))
+        stack.enter_context(mock.patch("helpers._terminal_size", None))
+        stack.enter_context(mock.patch("helpers.start_prefetch"))
+        stack.enter_context(mock.patch("replay.save_session"))
+        stack.enter_context(mock.patch("keystats.record_session"))
+        window.recorded = stack.enter_context(
+            mock.patch("history.record_session"))
+        stack.enter_context(mock.patch("helpers.take_prompt",
+                                       return_value=prompt))
+        stack.enter_context(mock.patch(
+            "corpus.sample_words",
+            side_effect=lambda count=50, seed=None: next(more, None)))
+        stack.enter_context(mock.patch("app.monotonic", clock.monotonic))
+        stack.enter_context(mock.patch("app.monotonic_ns",
+                                       clock.monotonic_ns))
+        # The app loads the width table while the menu is showing, in
+        # start_prefetch, so it is loaded here before any key is timed
+        widths.load_table()
+        # Keys are due from now, so the setup above isn't counted as
+        # keystroke latency
+        window.start = clock.monotonic()
+        window.woke = time.perf_counter()
+        try:
+            app.main(window)
+        except StopBenchmark:
+            pass
+    return window
+
+
+def run_scenario(wpm, prompt_chars, error_rate=0.0, burst=0, pause=0.0,
+                 endless=0, letters="etaoinshrdlucmfwypvbgkjqxz", seed=0):
+    ''' Plays a scripted session through the game and reports its frame
+    times, keystroke to render latency, curses calls and characters
+    written per frame, and peak memory. Frame times of the last tenth
+    of the frames show whether a long session slows down'''
+
+    import tracemalloc
+    from statistics import mean
+
+    prompt = make_prompt(prompt_chars, seed, letters)
+    chunks = []
+    if endless:
+        # Enough text for the whole test, a prompt's worth at a time
+        needed = ceil(endless * wpm * 5 / prompt_chars) + 2
+        chunks = [make_prompt(prompt_chars, seed + i + 1, letters)
+                  for i in range(needed)]
+        script = typing_script(endless_prompt(prompt, chunks), wpm,
+                               error_rate, burst, pause, endless, seed, True)
+    else:
+        script = typing_script(prompt, wpm, error_rate, burst, pause,
+                               seed=seed)
+    window = run_session(script, prompt, chunks=chunks)
+
+    # Memory is traced in a second run, tracing slows everything down
+    tracemalloc.start()
+    run_session(script, prompt, chunks=chunks)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    late = window.frame_times[-max(1, len(window.frame_times) // 10):]
+    return {"keys": window.keys_sent,
+            "frames": len(window.frame_times),
+            "frame_time_ms": percentiles(window.frame_times),
+            "late_frame_time_ms": percentiles(late),
+            "latency_ms": percentiles(window.latencies),
+            "calls_per_frame": round(mean(window.frame_calls), 2),
+            "chars_per_frame": round(mean(window.frame_chars), 2),
+            "peak_memory_kb": round(peak / 1024, 1)}
+
+
+def game_report(names):
+    ''' Runs the named scenarios, returns their results by name'''
+
+    return {name: run_scenario(**SCENARIOS[name]) for name in names}
+
+
+def compare_reports(baseline, report, tolerance=0.25):
+    ''' Lists the results that got worse than the baseline
+    by more than the tolerance, as a fraction'''
+
+    regressions = []
+    for name, results in report.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        for metric in ["frame_time_ms", "latency_ms"]:
+            for point, value in results[metric].items():
+                before = old.get(metric, {}).get(point)
+                if before and value > before * (1 + tolerance):
+                    regressions.append(
+                        f"{name} {metric} {point}: {before} -> {value}")
+        for metric in ["calls_per_frame", "chars_per_frame",
+                       "peak_memory_kb"]:
+            before = old.get(metric)
+            if before and results[metric] > before * (1 + tolerance):
+                regressions.append(
+                    f"{name} {metric}: {before} -> {results[metric]}")
+    return regressions
+
+
+def startup_child():
+    ''' Runs in a fresh interpreter: imports the app and runs it up to
+    the first drawn menu, then prints the timing and loaded modules'''
+
+    import json
+
+    with fake_curses():
+        # Timer starts before the app is imported
+        start = time.perf_counter()
+        import app
+        import helpers
+
+        # Skip the background prefetch, it starts after the menu is drawn
+        helpers.start_prefetch = lambda: None
+
+        result = {}
+
+        def menu_drawn(window):
+            if "time_to_menu" not in result:
+                result["time_to_menu"] = time.perf_counter() - start
+                result["modules"] = sorted(sys.modules)
+
+        try:
+            app.main(FakeWindow(on_refresh=menu_drawn))
+        except StopBenchmark:
+            pass
+
+    print(json.dumps(result))
+
+
+def measure_startup(runs=10):
+    ''' Launches the app in fresh interpreters and returns the time
+    to menu of each run, in and including the interpreter start'''
+
+    import json
+    import subprocess
+    import tempfile
+    from os import path
+
+    results = []
+    for _ in range(runs):
+        # Run in an empty folder so the app's files aren't touched
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, path.abspath(__file__), "startup-child"],
+                capture_output=True, text=True, check=True, cwd=folder)
+            process_time = time.perf_counter() - start
+        result = json.loads(output.stdout)
+        result["process_time"] = process_time
+        results.append(result)
+    return results
+
+
+def startup_report(results):
+    ''' Summarises startup runs as median and worst times in milliseconds'''
+
+    from statistics import median
+
+    in_app = [result["time_to_menu"] * 1000 for result in results]
+    process = [result["process_time"] * 1000 for result in results]
+    return {"runs": len(results),
+            "time_to_menu_median_ms": round(median(in_app), 2),
+            "time_to_menu_max_ms": round(max(in_app), 2),
+            "process_median_ms": round(median(process), 2),
+            "process_max_ms": round(max(process), 2)}
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Typing Wizard benchmarks")
+    parser.add_argument("suite", nargs="?", default="startup",
+                        choices=["startup", "game"],
+                        help="time app startup, or play scripted games")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of times to launch the app")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="fail if the median time to menu (ms) is over this")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="game scenario to run, all of them by default")
+    parser.add_argument("--compare", default=None,
+                        help="results file to check the game results against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a game result can get worse by")
+    parser.add_argument("--output", default=None,
+                        help="file to save the results to as JSON")
+    args = parser.parse_args()
+
+    if args.suite == "game":
+        report = game_report(args.scenario or list(SCENARIOS))
+    else:
+        report = startup_report(measure_startup(args.runs))
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.suite == "game" and args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare_reports(json.load(f), report,
+                                          args.tolerance)
+        for regression in regressions:
+            print(f"Slower than {args.compare}: {regression}")
+        if regressions:
+            sys.exit(1)
+
+    if (args.suite == "startup" and args.budget != None
+            and report["time_to_menu_median_ms"] > args.budget):
+        print(f"Time to menu is over the {args.budget}ms budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["startup-child"]:
+        startup_child()
+    else:
+        main()
@@ -0,0 +1,214 @@
+import struct
+import sys
+import threading
+from array import array
+from os import path, replace
+from random import Random
+import appdata
+
+
+# Word frequency list the corpus is built from, "word<tab>count" per line
+CORPUS_URL = "https://norvig.com/ngrams/count_big.txt"
+
+# Name of the built corpus file in the app data folder
+CORPUS_FILE = "words.bin"
+
+# File layout: header (magic, word count), word byte offsets (uint32,
+# count + 1 entries), cumulative word counts (uint64), utf-8 word bytes.
+# Numbers are stored little-endian.
+MAGIC = b"TWWORDS1"
+HEADER = struct.Struct("<8sI")
+
+# Loaded corpus, kept so the file is only read once per run
+_corpus = None
+
+# Download running for each corpus file, so callers that need the
+# corpus at the same time, like the prefetcher and the menu, share it
+_downloads = {}
+_downloads_lock = threading.Lock()
+
+
+def parse_counts(text):
+    ''' Reads a "word<tab>count" list into a list of lowercase
+    words and a list of counts, merging words that differ by case'''
+
+    counts = {}
+    for line in text.splitlines():
+        fields = line.split("\t")
+        word = fields[0].strip().lower()
+        if word == "":
+            continue
+        try:
+            count = int(fields[1]) if len(fields) > 1 else 1
+        except ValueError:
+            count = 1
+        counts[word] = counts.get(word, 0) + max(count, 1)
+    return list(counts), list(counts.values())
+
+
+def _little_endian(numbers):
+    ''' Swaps an array to little-endian on big-endian machines'''
+
+    if sys.byteorder == "big":
+        numbers.byteswap()
+    return numbers
+
+
+def build_corpus(text, file_path=None):
+    ''' Builds the binary corpus file from a word frequency list
+    and returns the loaded corpus'''
+
+    if file_path == None:
+        file_path = appdata.data_path(CORPUS_FILE)
+
+    words, counts = parse_counts(text)
+
+    # Byte offset each word starts at, plus the end of the last word
+    blob = bytearray()
+    offsets = array("I", [0])
+    for word in words:
+        blob += word.encode("utf-8")
+        offsets.append(len(blob))
+
+    # Running total of counts, used directly as the sampling table
+    cumulative = array("Q")
+    total = 0
+    for count in counts:
+        total += count
+        cumulative.append(total)
+
+    data = (HEADER.pack(MAGIC, len(words))
+            + _little_endian(offsets).tobytes()
+            + _little_endian(cumulative).tobytes()
+            + bytes(blob))
+
+    # Write to a temporary file first so a half written corpus is
+    # never read, each thread writes its own
+    temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    replace(temp_path, file_path)
+
+    return WordCorpus(data)
+
+
+def start_download(file_path=None):
+    ''' Starts downloading the word frequency list and building the
+    corpus from it in the background, returns a future for the corpus.
+    A download already running for the file is shared, not repeated'''
+
+    # asyncio is slow to import, so only load it when it's needed
+    import network
+
+    if file_path == None:
+        file_path = appdata.data_path(CORPUS_FILE)
+    with _downloads_lock:
+        future = _downloads.get(file_path)
+        if future == None or future.done():
+            future = network.get_network().start(
+                CORPUS_URL, "corpus",
+                lambda text: build_corpus(text, file_path))
+            _downloads[file_path] = future
+    return future
+
+
+def download_corpus(file_path=None):
+    ''' Downloads the word frequency list and builds the corpus,
+    returns None if the download fails'''
+
+    import network
+
+    try:
+        return network.wait(start_download(file_path))
+    except network.NetworkError:
+        return None
+
+
+class WordCorpus:
+    ''' Word list loaded from the binary corpus file, words are
+    decoded from the byte buffer only when they are sampled'''
+
+    def __init__(self, data):
+        magic, count = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a word corpus file")
+
+        # Split the file into its offset, count and word sections
+        start = HEADER.size
+        self.offsets = array("I")
+        self.offsets.frombytes(data[start:start + 4 * (count + 1)])
+        _little_endian(self.offsets)
+        start += 4 * (count + 1)
+        self.cumulative = array("Q")
+        self.cumulative.frombytes(data[start:start + 8 * count])
+        _little_endian(self.cumulative)
+        self.words = bytes(data[start + 8 * count:])
+
+    @classmethod
+    def load(cls, file_path):
+        ''' Loads a corpus file'''
+
+        with open(file_path, "rb") as f:
+            return cls(f.read())
+
+    def __len__(self):
+        return len(self.cumulative)
+
+    def word(self, i):
+        ''' Returns the word at index i'''
+
+        return self.words[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def sample(self, count, seed=None):
+        ''' Picks words at random, weighted by how often they are used'''
+
+        if len(self) == 0:
+            return []
+        # choices bisects the cumulative counts table for each pick
+        picks = Random(seed).choices(range(len(self)),
+                                     cum_weights=self.cumulative, k=count)
+        return [self.word(i) for i in picks]
+
+
+def load_corpus():
+    ''' Returns the corpus, loading it from the app data
+    folder the first time, or None if it hasn't been built'''
+
+    global _corpus
+    if _corpus == None:
+        file_path = appdata.data_path(CORPUS_FILE)
+        if path.isfile(file_path):
+            _corpus = WordCorpus.load(file_path)
+    return _corpus
+
+
+def set_corpus(corpus):
+    ''' Replaces the loaded corpus, used after building a new one'''
+
+    global _corpus
+    _corpus = corpus
+
+
+# Tested in pytest
+def sample_words(count=50, seed=None):
+    ''' Returns a string of random words from the corpus,
+    or None if the corpus hasn't been built'''
+
+    corpus = load_corpus()
+    if corpus == None or len(corpus) == 0:
+        return None
+    return " ".join(corpus.sample(count, seed))
+
+
+if __name__ == "__main__":
+    # Build the corpus from a local copy of count_big.txt, for
+    # machines without internet, or download it if no file is given
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            corpus = build_corpus(f.read())
+    else:
+        corpus = download_corpus()
+    if corpus == None:
+        print(f"Unable to download {CORPUS_URL}")
+    else:
+        print(f"Built word corpus with {len(corpus)} words")
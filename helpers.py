@@ -1,32 +1,111 @@
 import curses
+import json
+from math import ceil
 from time import sleep
-from os import get_terminal_size, listdir, getcwd, path
-import requests
-from random import randint
-from numpy import mean, std
-from textwrap import wrap
+from os import get_terminal_size, path
+from datetime import datetime
+from itertools import accumulate
+from bisect import bisect_left
+from layout import PromptLayout, more_text
+import widths
+import corpus
+from prefetch import Prefetcher
+import score_store
+import history
+import passages
+import replay
+
+
+# Terminal window size [width, height], cached until the terminal is resized
+_terminal_size = None
+
+# URL a random quote is loaded from
+QUOTE_URL = "https://api.quotable.io/random"
+
+# Frames of the spinner shown while waiting on the internet
+SPINNER = "|/-\\"
+
+# Background pool of ready typing prompts, created by start_prefetch
+prompt_pool = None
+
+# Number of words in a prompt typed from a file, and whether passages
+# follow on from the last one instead of starting somewhere random
+passage_words = 50
+sequential_passages = False
+
+# Where the prompt last chosen from the menu came from, kept with
+# each session in the history
+prompt_source = None
+
+# Race server to join and the name to race as, None for the defaults
+race_address = None
+race_name = None
+
+# Terminal widths prompts are wrapped to ahead of time, so resizing
+# to a common size doesn't wait for the prompt to be wrapped
+COMMON_COLUMNS = [80, 100, 120, 132, 160, 200]
+
+# Colour numbers the app draws with, each gets a colour pair of the same number
+COLOURS = [9, 13, 39, 77, 160, 208]
+
+# Test lengths that can be chosen before a test starts: a number of
+# seconds, a number of words, or endless until 'enter' is pressed
+TEST_MODES = [("time", 15), ("time", 30), ("time", 60), ("time", 120),
+              ("words", 10), ("words", 25), ("words", 50), ("words", 100),
+              ("endless", None)]
+
+
+# Tested in pytest
+def get_terminal_dimensions():
+    ''' Returns the cached terminal size [width, height],
+    only asking the operating system after a resize'''
+
+    global _terminal_size
+    if _terminal_size == None:
+        size = get_terminal_size()
+        _terminal_size = [size[0], size[1]]
+    return _terminal_size
+
+
+# Tested in pytest
+def check_resize(key):
+    ''' Check user input is a terminal resize event, curses turns
+    SIGWINCH into KEY_RESIZE, and clear the cached terminal size'''
+
+    global _terminal_size
+    if key == curses.KEY_RESIZE:
+        _terminal_size = None
+        return True
+    return False
 
 
 # Tested manually
 def check_valid_terminal():
     ''' Checks if valid terminal size'''
 
-    window_size = [get_terminal_size()[0], get_terminal_size()[1]]
+    window_size = get_terminal_dimensions()
     if window_size[0] < 80 or window_size[1] < 20:
         return False
     return True
 
 
+def prompt_width(columns):
+    ''' Returns the widest a prompt is drawn in a terminal this many
+    columns wide'''
+
+    return int(columns//1.3)
+
+
 # Tested manually
 def get_window_sizes():
     ''' Find the size of the terminal window and 
     calculate maximum string width and starting positions'''
 
     # Get terminal window size [width, height]
-    window_size = [get_terminal_size()[0], get_terminal_size()[1]]
+    window_size = get_terminal_dimensions()
 
     # Calculate max width
-    max_width = int(window_size[0]//1.3)
+    max_width = prompt_width(window_size[0])
 
     # Calculate starting positions based on width and window size
     text_start_x = int((window_size[0] - max_width)//2)
@@ -34,6 +113,19 @@ def get_window_sizes():
     return [max_width, text_start_x, text_start_y]
 
 
+# Tested manually
+def init_colours():
+    ''' Sets up the colour pairs the app uses, drawn on the
+    terminal's default background'''
+
+    curses.start_color()
+    curses.use_default_colors()
+    for colour in COLOURS:
+        # Terminals with fewer colours fall back to the default colour
+        if colour < curses.COLORS and colour < curses.COLOR_PAIRS:
+            curses.init_pair(colour, colour, -1)
+
+
 # Tested in pytest
 def check_ascii_input(key):
     ''' Check user input is alphnumeric/punctuation'''
@@ -43,6 +135,64 @@ def check_ascii_input(key):
     return False
 
 
+# Tested in pytest
+def get_key(window):
+    ''' Waits for a key with get_wch, so any Unicode character can be
+    typed. Characters come back as strings, control keys like 'esc'
+    and 'enter' as their codes, special keys as curses KEY_ codes,
+    and -1 if no key was pressed before the timeout'''
+
+    try:
+        key = window.get_wch()
+    except curses.error:
+        return -1
+    if isinstance(key, str) and (ord(key) < 32 or 127 <= ord(key) < 160):
+        return ord(key)
+    return key
+
+
+# Tested in pytest
+def check_text_input(key):
+    ''' Check user input from get_key is a character that can be typed,
+    in any language'''
+
+    return isinstance(key, str)
+
+
+# Tested in pytest
+def next_test_mode(test_mode, step):
+    ''' Returns the test length step places along from test_mode'''
+
+    # A length from the command line is offered alongside the usual ones
+    modes = TEST_MODES
+    if test_mode not in modes:
+        modes = [test_mode] + TEST_MODES
+    return modes[(modes.index(test_mode) + step) % len(modes)]
+
+
+# Tested in pytest
+def test_mode_text(test_mode):
+    ''' Describes a test length, like "30 second test"'''
+
+    kind, amount = test_mode
+    if kind == "time":
+        return f"{amount} second test"
+    if kind == "words":
+        return f"{amount} word test"
+    return "endless test"
+
+
+# Tested manually
+def prompt_rows(y, racing=False):
+    ''' Returns how many rows of the prompt fit on screen from y,
+    leaving the bottom row for the HUD and room for a race board'''
+
+    rows = get_terminal_dimensions()[1] - y - 2
+    if racing:
+        rows //= 2
+    return rows
+
+
 # Tested in pytest
 def check_enter_input(key):
     ''' Check user input is enter key'''
@@ -56,7 +206,145 @@ def check_enter_input(key):
 def check_backspace(key):
     ''' Check user input is backspace key'''
 
-    if key == 127:
+    # Terminals send delete or ctrl-h, which curses may turn into KEY_BACKSPACE
+    if key in (8, 127, curses.KEY_BACKSPACE):
+        return True
+    return False
+
+
+# Tested manually
+def replay_screen(window, x, y):
+    ''' Lists saved sessions to race as a ghost or watch as a replay,
+    returns a Playback of the chosen session or None for the menu'''
+
+    sessions = replay.list_sessions()
+    best = replay.best_session(sessions)
+
+    # Start on the best session, so racing it is one key press
+    selected = 0
+    if best != None:
+        selected = sessions.index(best)
+    speed = replay.SPEEDS.index(1)
+
+    # Update delay so that program waits on user input
+    window.nodelay(False)
+
+    while check_valid_terminal():
+        window.erase()
+        window.addstr(0, 0, "Press 'esc' to return to menu",
+                      curses.color_pair(77))
+
+        if len(sessions) == 0:
+            window.addstr(y, x, "No sessions yet, finish a game first.")
+        else:
+            window.addstr(y - 3, x, "'up'/'down' choose, 'enter' race its "
+                          "ghost, 'w' watch replay, 'left'/'right' speed",
+                          curses.color_pair(39))
+            window.addstr(y - 2, x, f"Replay speed: "
+                          f"{replay.SPEEDS[speed]}x", curses.color_pair(208))
+
+            # Scroll the list so the selected session is on screen
+            rows = max(1, get_terminal_dimensions()[1] - y - 1)
+            first = max(0, selected - rows + 1)
+            for row, (file_path, details) in enumerate(
+                    sessions[first:first + rows]):
+                date = datetime.fromtimestamp(details["date"])
+                text = (f"{date:%Y-%m-%d %H:%M}  {details['wpm']:>3}wpm  "
+                        f"{details['accuracy']:>5}%  {details['prompt'][:30]}")
+                if (file_path, details) == best:
+                    text += "  (best)"
+                colour = 0
+                if first + row == selected:
+                    colour = curses.A_REVERSE
+                window.addstr(y + row, x, text, colour)
+        window.refresh()
+
+        key = window.getch()
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        elif check_esc(key):
+            return None
+        elif len(sessions) == 0:
+            continue
+        elif key == curses.KEY_UP:
+            selected = max(0, selected - 1)
+        elif key == curses.KEY_DOWN:
+            selected = min(len(sessions) - 1, selected + 1)
+        elif key == curses.KEY_LEFT:
+            speed = max(0, speed - 1)
+        elif key == curses.KEY_RIGHT:
+            speed = min(len(replay.SPEEDS) - 1, speed + 1)
+        elif check_enter_input(key) or key == ord("w"):
+            details, log = replay.load_session(sessions[selected][0])
+            test_mode = replay.session_test_mode(details)
+            if check_enter_input(key):
+                return replay.Playback(details["prompt"], log, "ghost",
+                                       test_mode=test_mode)
+            return replay.Playback(details["prompt"], log, "replay",
+                                   replay.SPEEDS[speed], test_mode)
+
+
+# Tested manually
+def race_lobby(window, x, y):
+    ''' Joins the race server and waits for a race to start,
+    returns the RaceClient or None to go back to the menu'''
+
+    # asyncio is only needed for races, so only load it now
+    import race
+
+    client = race.RaceClient(race_address or race.DEFAULT_ADDRESS,
+                             race_name or "player")
+    client.connect()
+
+    while check_valid_terminal():
+        # Check on the connection ten times a second
+        window.timeout(100)
+        window.erase()
+        window.addstr(0, 0, "Press 'esc' to return to menu",
+                      curses.color_pair(77))
+        if client.status == "error":
+            quick_print(window, x, y, f"Unable to race: {client.error}",
+                        curses.color_pair(160))
+            sleep(2)
+            return None
+        if client.status == "racing":
+            return client
+        if client.status == "connecting":
+            window.addstr(y, x, f"Connecting to {client.address}...")
+        else:
+            window.addstr(y, x, f"Waiting for players: {client.waiting} of "
+                          f"{client.needed}", curses.color_pair(39))
+            window.addstr(y + 1, x, f"Racing as {client.name}")
+        window.refresh()
+
+        key = window.getch()
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        elif check_esc(key):
+            client.close()
+            return None
+
+
+# Tested in pytest
+def print_race_board(renderer, standings, prompt_length, name,
+                     x, y, rows):
+    ''' Draws a progress bar for each racer, furthest along first,
+    on up to rows rows'''
+
+    for row, (racer, typed, wpm, done) in enumerate(standings[:rows]):
+        filled = 20 * min(typed, prompt_length) // max(1, prompt_length)
+        colour = curses.color_pair(39)
+        if racer == name:
+            colour = curses.color_pair(208)
+        renderer.draw(y + row, x, f"{racer:<12} [{'#' * filled:<20}] "
+                      f"{wpm:>3}wpm{' done' if done else ''}", colour)
+
+
+# Tested in pytest
+def check_hud_key(key):
+    ''' Check user input is the F2 key, which toggles the performance HUD'''
+
+    if key == curses.KEY_F2:
         return True
     return False
 
@@ -70,15 +358,47 @@ def check_esc(key):
     return False
 
 
+# Tested in pytest
+def get_input_timeout(start, last_frame, redraw_pending, frame_cap, now,
+                      next_event=None):
+    ''' Calculates how many milliseconds to block waiting for input,
+    returns -1 to block until a key is pressed. next_event is the
+    milliseconds until a ghost or replay keystroke is due'''
+
+    # Minimum time between frames
+    frame_time = 1 / frame_cap
+
+    # If a redraw is waiting, wake up when the current frame has elapsed
+    if redraw_pending:
+        return max(0, ceil((last_frame + frame_time - now) * 1000))
+
+    # Wake up for the next played back keystroke, no faster than frame cap
+    until_event = -1
+    if next_event != None:
+        until_event = max(ceil(next_event),
+                          ceil((last_frame + frame_time - now) * 1000), 0)
+
+    # Before the game starts nothing changes until a key is pressed
+    if start == None:
+        return until_event
+
+    # Wake up when the countdown next ticks over, but no faster than frame cap
+    until_tick = ceil((1 - (now - start) % 1) * 1000)
+    until_tick = max(until_tick, ceil(frame_time * 1000))
+    if until_event == -1:
+        return until_tick
+    return min(until_tick, until_event)
+
+
 def wrap_user_input(user_typed_string, typing_prompt_wrapped):
     '''Creates a list of sub-strings from the user input string 
     that maps to the length of the prompt sub-strings
     so it can be correctly displayed over the top of the prompt.'''
 
-    sub_numbers = [len(i) for i in typing_prompt_wrapped]
-    return [user_typed_string[sum(sub_numbers[:i]):
-                              sum(sub_numbers[:i+1])] for i in range(
-                                  len(sub_numbers))]
+    # Offset each prompt line starts at, plus the end of the prompt
+    offsets = [0, *accumulate(len(i) for i in typing_prompt_wrapped)]
+    return [user_typed_string[offsets[i]:offsets[i+1]]
+            for i in range(len(typing_prompt_wrapped))]
 
 
 # Tested manually
@@ -86,8 +406,8 @@ def get_input_file_location(window, x, y):
     ''' Displays a prompt for user to type a 
     text file path name, returns the validated path'''
 
-    # Set input delay to True so program doesn't pause for input
-    window.nodelay(True)
+    # Update delay so that program waits on user input
+    window.nodelay(False)
 
     # Variable to store user input file path
     file_path = ""
@@ -95,34 +415,9 @@ def get_input_file_location(window, x, y):
     # Attempt to load the text file
     while check_valid_terminal():
 
-        # Get user input
-        key = window.getch()
-
         # Clear screen
         window.erase()
 
-        # If user presses an ascii, add to file_path
-        if check_ascii_input(key):
-            file_path += chr(key)
-        # If user presses 'esc', return to menu
-        elif check_esc(key):
-            return None
-        # If user presses 'backspace' remove from file_path
-        elif check_backspace(key):
-            file_path = file_path[:-1]
-        # If user presses 'enter', check file path is valid
-        elif check_enter_input(key):
-            if path.isfile(file_path) and file_path[-3:] == "txt":
-                return file_path
-            else:
-                # Draws prompt in red
-                quick_print(window, x, y,
-                            "Please provide a valid file path...",
-                            curses.color_pair(160))
-                sleep(1)
-                file_path = ""
-                window.erase()
-
         # Draw option to return to menu and tell user how to input a text-file
         window.addstr(
             0, 0, "Press 'esc' to return to menu",
@@ -138,39 +433,41 @@ def get_input_file_location(window, x, y):
         # Refresh page with text
         window.refresh()
 
+        # Wait for user input
+        key = get_key(window)
 
-def load_input_file(file_name):
-    '''Loads prompt txt file from within 
-    app directory, returns a string of file contents'''
-
-    with open(file_name, 'r') as f:
-        lines = f.read().splitlines()
-        if len(lines) == 0:
+        # If terminal is resized, move prompt to fit the new size
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        # If user types a character, add to file_path
+        elif check_text_input(key):
+            file_path += key
+        # If user presses 'esc', return to menu
+        elif check_esc(key):
             return None
-        text = " ".join(" ".join(lines).split()[:50])
+        # If user presses 'backspace' remove from file_path
+        elif check_backspace(key):
+            file_path = file_path[:widths.grapheme_start(
+                file_path, len(file_path) - 1)]
+        # If user presses 'enter', check file path is valid
+        elif check_enter_input(key):
+            if path.isfile(file_path) and file_path[-3:] == "txt":
+                return file_path
+            else:
+                # Draws prompt in red
+                quick_print(window, x, y,
+                            "Please provide a valid file path...",
+                            curses.color_pair(160))
+                sleep(1)
+                file_path = ""
 
-        if len(text) > 400:
-            return text[:400]
-        return text
-        # return " ".join(text)
 
+def load_input_file(file_name):
+    '''Loads a passage of the prompt txt file, up to passage_words
+    words or 8 characters a word, returns the passage or None if empty'''
 
-# Tested in pytest
-def load_high_score():
-    ''' Loads scores file and returns list of scores'''
-
-    file_list = listdir(getcwd())
-    if "scores.txt" in file_list:
-        with open("scores.txt", 'r') as f:
-            results = f.read().splitlines()
-            if len(results) == 0:
-                return ["No high scores."]
-            else:
-                for score in results:
-                    if len(score.split(": ")[-1].split(", ")) != 4:
-                        return None
-            return results
-    return ["No high scores."]
+    return passages.load_passage(file_name, passage_words, passage_words * 8,
+                                 sequential=sequential_passages)
 
 
 def quick_print(window, x, y, text, colour=None):
@@ -201,6 +498,9 @@ def measure_consistency(wpm_values):
     the standard deviation of wpm from 0 - 100%'''
     ''' Algorithm inspired by https://monkeytype.com/about'''
 
+    # numpy is slow to import, so only load it when it's needed
+    from numpy import mean, std
+
     # If provided an empty wpm_values list, return 0
     if len(wpm_values) == 0:
         return round(0, 2)
@@ -262,99 +562,139 @@ def calculate_wpm(prompt, user_typed, time_in_seconds):
 
 
 # Tested manually
-def print_typing_text(window, typing_prompt,
-                      wrapped_user_typed,
-                      text_start_x, text_start_y):
+def print_typing_text(renderer, prompt_layout,
+                      user_typed_string,
+                      text_start_x, text_start_y, drawn_length=None,
+                      ghost=None, drawn_ghost=None):
     ''' Draws prompt and user typed input to 
-    screen and displays accuracy colour coding '''
-
-    # Draw typing prompt to screen
-    draw(window, typing_prompt, text_start_x, text_start_y)
-
-    # Draw user input
-    for line in range(len(wrapped_user_typed)):
-        for char in range(len(wrapped_user_typed[line])):
-            # Change colour of user input text
-            if wrapped_user_typed[line][char] != typing_prompt[line][char]:
-                colour = curses.color_pair(160)  # Red text if wrong
+    screen and displays accuracy colour coding.
+    Only lines changed since drawn_length characters were 
+    typed are rebuilt, None rebuilds every line.
+    ghost is the position of a ghost cursor to highlight,
+    drawn_ghost where it was last drawn'''
+
+    # Look up colours once per frame rather than once per character
+    wrong = curses.color_pair(160)  # Red text if wrong
+    right = curses.color_pair(77)  # Green text if right
+    ghost_colour = curses.color_pair(208) | curses.A_REVERSE
+
+    # Find the lines the typed input or the ghost could have changed,
+    # only the rows on screen are drawn when the prompt scrolls
+    visible = prompt_layout.visible_rows()
+    if drawn_length == None:
+        rows = visible
+        # Rows on screen past the end of the prompt are cleared
+        if prompt_layout.rows != None:
+            for line in range(visible.stop, visible.start + prompt_layout.rows):
+                renderer.draw_row(text_start_y + line - prompt_layout.top, ())
+    else:
+        rows = set(changed_rows(prompt_layout, drawn_length,
+                                len(user_typed_string)))
+        if ghost != drawn_ghost:
+            for position in (ghost, drawn_ghost):
+                if position != None:
+                    rows.add(prompt_layout.locate(position)[0])
+        rows = sorted(row for row in rows if row in visible)
+
+    for line in rows:
+        typing_prompt = prompt_layout.line(line)
+        user_typed = prompt_layout.typed_line(user_typed_string, line)
+
+        # Screen column of each character and where each grapheme starts,
+        # so wide characters and letters with accents are drawn whole
+        columns = widths.columns(typing_prompt)
+        bounds = widths.cluster_bounds(typing_prompt)
+
+        # Column of the ghost cursor if it is on this line
+        ghost_column = None
+        if ghost != None and prompt_layout.locate(ghost)[0] == line:
+            ghost_column = prompt_layout.locate(ghost)[1]
+
+        # Characters typed wrong, found in one pass over the row, in
+        # plain ASCII every character is a grapheme of one column
+        typed_length = len(user_typed)
+        ascii_row = typing_prompt.isascii() and user_typed.isascii()
+        if typing_prompt.startswith(user_typed):
+            wrong_at = []
+        else:
+            wrong_at = [char for char, (typed, expected)
+                        in enumerate(zip(user_typed, typing_prompt))
+                        if typed != expected]
+        if ghost_column != None and ghost_column < typed_length:
+            wrong_at = sorted(wrong_at + [ghost_column])
+
+        # Group user input into runs of the same colour, typing between
+        # mistakes is drawn as one run and each grapheme holding a
+        # mistake or the ghost is coloured whole
+        runs = []
+        run_end = 0
+        for char in wrong_at:
+            if char < run_end:
+                continue
+            if ascii_row:
+                start, end = char, char + 1
             else:
-                colour = curses.color_pair(77)  # Green text if right
-            # Add each individual character to screen
-            if wrapped_user_typed[line][char] == " ":
-                window.addstr(text_start_y + line, text_start_x +
-                              char, typing_prompt[line][char], colour)
+                start = widths.grapheme_start(typing_prompt, char)
+                end = bounds[bisect_left(bounds, char + 1)]
+            if start > run_end:
+                runs.append((text_start_x + columns[run_end],
+                             typing_prompt[run_end:start], right))
+            typed = user_typed[start:end]
+            expected = typing_prompt[start:end]
+            # Change colour of user input text, a grapheme
+            # still being typed is right so far
+            if expected.startswith(typed):
+                colour = right
+                text = expected
             else:
-                window.addstr(text_start_y + line, text_start_x +
-                              char, wrapped_user_typed[line][char], colour)
-
-
-# Tested in pytest
-def sort_scores(scores):
-    ''' Sorts scores in descending order by 
-    wpm/difficulty/consistency/accuracy'''
-
-    # Loop over scores to separate values so they can be sorted
-    score_list = []
-    for score in scores:
-        # Split scores up into name and results, then append to score_list
-        name = score.split(": ")[0]
-        results = score.split(": ")[-1].split(", ")
-        score_list.append([name, *results])
-
-    # Sort the new list of values
-    score_list.sort(key=lambda x: (x[1][:-3], x[2],
-                                   x[3][:-13], x[4][:-10]), reverse=True)
-
-    # Recombine the list of lists back into a list of strings
-    for i in range(len(score_list)):
-        score_list[i] = f"{score_list[i][0]}: {score_list[i][1]}, {score_list[i][2]}, {score_list[i][3]}, {score_list[i][4]}"
-    return score_list
-
-
-# Tested in pytest
-def save_score_to_file(username, wpm, accuracy, difficulty, consistency):
-    ''' Opens or creates a file, sorts the 
-    scores by wpm/accuracy/difficulty, saves scores to file'''
-
-    # Check if scores file already exists
-    if "scores.txt" in listdir(getcwd()):
-        # Open file and read scores into a variable
-        with open("scores.txt", "r+") as file_in:
-            scores = file_in.read().splitlines()
-            scores.append(
-                f"{username}: {wpm}wpm, {difficulty}, {consistency}% consistency, {accuracy}% accuracy")
-            # Sort the scores
-            sorted_scores = sort_scores(scores)
-        # Truncate scores.txt file and re-write sorted scores to it
-        with open("scores.txt", "w") as file_out:
-            for score in sorted_scores:
-                print(score, file=file_out)
-        # Return sorted score list for testing purposes
-        return sorted_scores
-    # If scores file doesn't exist, create it and add new score
-    else:
-        with open("scores.txt", "w") as new_file:
-            new_file.write(
-                f"{username}: {wpm}wpm, {difficulty}, {consistency}% consistency, {accuracy}% accuracy")
-        # Return score for testing purposes
-        return [f"{username}: {wpm}wpm, {difficulty}, {consistency}% consistency, {accuracy}% accuracy"]
-
-
-# Tested in pytest
-def username_unused(username):
-    ''' Checks if submitted username has already been used'''
-
-    if username == "":
-        return False
-    if "scores.txt" in listdir(getcwd()):
-        # Open file and read scores into a variable
-        with open("scores.txt", "r") as file_in:
-            lines = file_in.readlines()
-            for name in lines:
-                if username == name.split(": ")[0]:
-                    return False
-            return True
-    return True
+                colour = wrong
+                # Typed spaces and mistakes of a different width
+                # show the prompt character underneath
+                if " " in typed or not ascii_row and widths.text_width(
+                        typed) != columns[end] - columns[start]:
+                    text = expected
+                else:
+                    text = typed
+            if ghost_column != None and start <= ghost_column < end:
+                colour |= ghost_colour
+            # Mistakes next to each other make one run
+            if runs and runs[-1][2] == colour and run_end == start:
+                runs[-1] = (runs[-1][0], runs[-1][1] + text, colour)
+            else:
+                runs.append((text_start_x + columns[start], text, colour))
+            run_end = end
+
+        # The rest of the typed input is right
+        rest = bounds[bisect_left(bounds, typed_length)]
+        if rest > run_end:
+            runs.append((text_start_x + columns[run_end],
+                         typing_prompt[run_end:rest], right))
+
+        # Rest of the prompt line is drawn without colour,
+        # apart from the ghost cursor if it is ahead
+        if (ghost_column != None and rest <= ghost_column
+                < len(typing_prompt)):
+            ghost_start = widths.grapheme_start(typing_prompt, ghost_column)
+            ghost_end = bounds[bisect_left(bounds, ghost_column + 1)]
+            if rest < ghost_start:
+                runs.append((text_start_x + columns[rest],
+                             typing_prompt[rest:ghost_start], 0))
+            runs.append((text_start_x + columns[ghost_start],
+                         typing_prompt[ghost_start:ghost_end], ghost_colour))
+            rest = ghost_end
+        if rest < len(typing_prompt):
+            runs.append((text_start_x + columns[rest],
+                         typing_prompt[rest:], 0))
+
+        renderer.draw_row(text_start_y + line - prompt_layout.top, tuple(runs))
+
+
+def changed_rows(prompt_layout, old_length, new_length):
+    ''' Returns the rows of the prompt between two typed lengths'''
+
+    first_row = prompt_layout.locate(min(old_length, new_length))[0]
+    last_row = prompt_layout.locate(max(old_length, new_length))[0]
+    return range(first_row, last_row + 1)
 
 
 def final_screen(window, consistency, wpm, accuracy, difficulty, x, y):
@@ -372,6 +712,9 @@ def final_screen(window, consistency, wpm, accuracy, difficulty, x, y):
     else:
         difficulty = "Easy mode"
 
+    # Update delay so that program waits on user input
+    window.nodelay(False)
+
     # Loop to get user input
     while check_valid_terminal():
 
@@ -397,29 +740,35 @@ def final_screen(window, consistency, wpm, accuracy, difficulty, x, y):
                       username, curses.color_pair(39))
 
         # Position cursor to username typing area
-        window.move(y + 5, x + (len(statistics[4]) + len(username)))
+        window.move(y + 5, x + (len(statistics[4])
+                                + widths.text_width(username)))
 
         # Refresh window with text
         window.refresh()
 
         # Get user input
-        key = window.getch()
+        key = get_key(window)
 
-        if check_ascii_input(key):  # Check if key is alphanumeric/punctuation
+        if check_resize(key):  # Check if terminal resized, move text to fit
+            x, y = get_window_sizes()[1:]
+        elif check_text_input(key):  # Check if key is a typed character
             # Add to username
-            window_width = get_terminal_size()[0]
-            text_start = get_window_sizes()[1]
-            if len(statistics[4]) < (window_width - text_start):
-                username += chr(key)
+            window_width = get_terminal_dimensions()[0]
+            if len(statistics[4]) < (window_width - x):
+                username += key
         elif check_backspace(key):  # Check if key is backspace
             # Remove from username
-            username = username[:-1]
+            username = username[:widths.grapheme_start(
+                username, len(username) - 1)]
         elif check_enter_input(key):  # Check if enter key
-            # Check username isn't used
-            if username_unused(username.strip()):
-                # Save score to file
-                save_score_to_file(username.strip(), wpm, accuracy,
-                                   difficulty, consistency)
+            # Nothing to save until a username is typed
+            if username.strip() == "":
+                continue
+            # Save score, unless the username is already used
+            if score_store.get_store().add(username.strip(), wpm, accuracy,
+                                           difficulty, consistency):
+                # Remembered so the leaderboard can find this score
+                score_store.get_store().remember_username(username.strip())
                 return 1
             else:
                 # If username used, prompt for new username
@@ -433,12 +782,241 @@ def final_screen(window, consistency, wpm, accuracy, difficulty, x, y):
             return 1
 
 
+# Tested manually
+def leaderboard_screen(window, x, y):
+    ''' Displays the high scores a screen at a time, sorted by any
+    column and filtered by difficulty, with the user's score marked'''
+
+    store = score_store.get_store()
+    username = store.last_username()
+    view = score_store.LeaderboardView(
+        store, get_terminal_dimensions()[1] - y - 1)
+    message = ""
+
+    # Keys that sort by each column
+    sort_keys = {ord("w"): "wpm", ord("c"): "consistency",
+                 ord("a"): "accuracy", ord("n"): "username"}
+
+    # Update delay so that program waits on user input
+    window.nodelay(False)
+
+    while check_valid_terminal():
+        width = get_terminal_dimensions()[0] - x - 1
+        window.erase()
+        window.addstr(0, 0, "Press 'esc' to return to menu",
+                      curses.color_pair(77))
+
+        if len(view.visible) == 0 and view.difficulty == None:
+            window.addstr(y, x, "No high scores.")
+        else:
+            if view.sort == "username":
+                order = "Z to A" if view.reverse else "A to Z"
+            else:
+                order = "lowest first" if view.reverse else "highest first"
+            shown = view.difficulty or "all difficulties"
+            controls = ("'up'/'down'/'page up'/'page down'/'home'/'end' scroll,"
+                        " sort by 'w'pm 'c'onsistency 'a'ccuracy 'n'ame,"
+                        " 'd' difficulty, 'y' your score")
+            window.addstr(y - 3, x, controls[:width], curses.color_pair(39))
+            window.addstr(y - 2, x, f"Sorted by {view.sort}, {order}, "
+                          f"{shown} {message}"[:width], curses.color_pair(208))
+            window.addstr(y - 1, x, f"{'Rank':>7}  {'Name':<20} {'Speed':>7}"
+                          f"  {'Difficulty':<10} {'Consistency':>11}"
+                          f"  {'Accuracy':>8}"[:width])
+
+            # Only the rows on screen are ever loaded
+            for row, score in enumerate(view.visible):
+                name, wpm, difficulty, consistency, accuracy, _ = score
+                text = (f"{view.first_rank + row + 1:>7}  {name[:20]:<20}"
+                        f" {wpm:>4}wpm  {difficulty:<10} {consistency:>10}%"
+                        f"  {accuracy:>7}%")
+                colour = 0
+                if name == username:
+                    colour = curses.color_pair(208) | curses.A_REVERSE
+                window.addstr(y + row, x, text[:width], colour)
+        window.refresh()
+
+        key = window.getch()
+        message = ""
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+            view.resize(get_terminal_dimensions()[1] - y - 1)
+        elif key == curses.KEY_DOWN:
+            view.scroll(1)
+        elif key == curses.KEY_UP:
+            view.scroll(-1)
+        elif key == curses.KEY_NPAGE:
+            view.scroll(view.rows)
+        elif key == curses.KEY_PPAGE:
+            view.scroll(-view.rows)
+        elif key == curses.KEY_HOME:
+            view.home()
+        elif key == curses.KEY_END:
+            view.end()
+        elif key in sort_keys:
+            view.set_sort(sort_keys[key])
+        elif key == ord("d"):
+            view.next_difficulty()
+        elif key == ord("y"):
+            if username == None or not view.jump_to(username):
+                message = "- no saved score to show"
+        elif check_esc(key):
+            return
+
+
+# Tested manually
+def heatmap_screen(window, x, y):
+    ''' Displays a keyboard coloured by how fast, or how accurately,
+    each key is typed across every session, and the slowest pairs'''
+
+    # numpy is slow to import, so only load it when it's needed
+    import keystats
+
+    data = keystats.open_stats(mode="r")
+    summary = keystats.key_summary(data)
+    bigrams = keystats.slowest_bigrams(data)
+    show_errors = False
+
+    # Keys are coloured fastest third green, then orange, slowest third red
+    means = sorted(mean for mean, _, _ in summary.values() if mean != None)
+    if means:
+        thresholds = [means[len(means) // 3], means[2 * len(means) // 3]]
+
+    while check_valid_terminal():
+        window.nodelay(False)
+        window.erase()
+        window.addstr(0, 0, "Press 'e' to switch between speed and "
+                      "mistakes, any other key to return to menu",
+                      curses.color_pair(77))
+
+        if len(means) == 0:
+            window.addstr(y, x, "No typing recorded yet, finish a game first.")
+        else:
+            title = "Key speed (green fast, red slow)"
+            if show_errors:
+                title = "Key mistakes (green under 2%, red over 6%)"
+            window.addstr(y - 2, x, title, curses.color_pair(39))
+
+            # Each row of keys is indented like a keyboard
+            rows = keystats.KEYBOARD + [" "]
+            for row, keys in enumerate(rows):
+                column = x + row * 2
+                for key in keys:
+                    mean, rate, attempts = summary[key]
+                    if show_errors:
+                        level = None if attempts == 0 else (
+                            0 if rate < 0.02 else 1 if rate < 0.06 else 2)
+                    else:
+                        level = None if mean == None else (
+                            0 if mean <= thresholds[0]
+                            else 1 if mean <= thresholds[1] else 2)
+                    colour = 0
+                    if level != None:
+                        colour = curses.color_pair([77, 208, 160][level])
+                        colour |= curses.A_REVERSE
+                    label = f" {key} " if key != " " else "     space     "
+                    window.addstr(y + row * 2, column, label, colour)
+                    column += len(label) + 1
+
+            # The slowest pairs of characters to practise
+            text = ", ".join(f"'{pair}' {mean:.0f}ms" for pair, mean in bigrams)
+            text = f"Slowest pairs: {text or 'not enough typing yet'}"
+            window.addstr(y + len(rows) * 2, x,
+                          text[:get_terminal_dimensions()[0] - x - 1])
+        window.refresh()
+
+        key = window.getch()
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        elif key == ord("e"):
+            show_errors = not show_errors
+        else:
+            return
+
+
+# Tested manually
+def progress_screen(window, x, y):
+    ''' Displays totals and personal bests from the session history,
+    and a chart of typing speed by week, by session or through the
+    last session. Everything shown is read from totals kept as
+    sessions are added, so it shows straight away however many
+    sessions there are'''
+
+    charts = ["week", "session", "last"]
+    chart = 0
+    store = history.get_history()
+
+    while check_valid_terminal():
+        window.nodelay(False)
+        window.erase()
+        window.addstr(0, 0, "Press 'c' to change chart, any other key "
+                      "to return to menu", curses.color_pair(77))
+        columns, rows = get_terminal_dimensions()
+        width = columns - 2 * x
+
+        totals = store.totals()
+        if totals["sessions"] == 0:
+            window.addstr(y, x, "No sessions yet, finish a game first.")
+        else:
+            minutes = int(totals["seconds"] // 60)
+            lines = [f"{totals['sessions']} sessions, {minutes // 60}h "
+                     f"{minutes % 60}m typed, average {totals['wpm']:.0f}wpm "
+                     f"{totals['accuracy']:.1f}% accuracy",
+                     f"Last {min(totals['sessions'], history.ROLLING_SESSIONS)}"
+                     f" sessions: {totals['rolling_wpm']:.0f}wpm "
+                     f"{totals['rolling_accuracy']:.1f}% accuracy"]
+            bests = [f"{difficulty}, {test_mode_text(history.parse_mode(mode))}"
+                     f": {wpm}wpm" for difficulty, mode, wpm, _, _
+                     in store.bests()[:3]]
+            lines.append(f"Personal bests: {'; '.join(bests)}")
+            window.addstr(2, x, "Your progress", curses.color_pair(13))
+            for row, line in enumerate(lines):
+                window.addstr(3 + row, x, line[:width])
+
+            # The chart fills the rest of the screen, with the wpm
+            # each row stands for down the side
+            chart_width = width - 6
+            if charts[chart] == "week":
+                weeks = store.weeks(chart_width)
+                values = [wpm for _, _, _, wpm, _ in weeks]
+                title = "Average wpm by week"
+                axis = (f"Weeks from {history.week_start(weeks[0][0])} to "
+                        f"{history.week_start(weeks[-1][0])}")
+            elif charts[chart] == "session":
+                values = store.recent(chart_width)
+                title = f"Wpm of the last {len(values)} sessions"
+                axis = "Oldest to newest"
+            else:
+                values = store.last_series()[-chart_width:]
+                title = "Wpm through the last session"
+                axis = f"Each second, {len(values)} seconds"
+
+            height = max(3, rows - 11)
+            top = max(10, -(-max(values, default=0) // 10) * 10)
+            window.addstr(7, x, title, curses.color_pair(39))
+            for row, line in enumerate(history.chart_rows(values, height, top)):
+                label = f"{round(top * (height - row) / height):>4} |"
+                window.addstr(8 + row, x, label + line, curses.color_pair(208))
+            window.addstr(8 + height, x, f"{'':>4} +{'-' * len(values)}")
+            window.addstr(9 + height, x + 6, axis[:chart_width])
+        window.refresh()
+
+        key = window.getch()
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        elif key == ord("c"):
+            chart = (chart + 1) % len(charts)
+        else:
+            return
+
+
 def faq_screen(window, x, y,):
     ''' Displays the FAQ screen text'''
 
     about_text = ["How to play:",
                   "    Start typing to begin 30 second timer,",
                   "    type as fast and as accurately as you can!",
+                  "    'left'/'right' change the length of the test first.",
                   "",
                   "What do the terms mean?",
                   "",
@@ -473,48 +1051,154 @@ def faq_screen(window, x, y,):
         # Get user input
         key = window.getch()
 
+        # If terminal resized, redraw to fit the new size
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+            continue
+
         if key != None:
             return
 
 
 # Tested in pytest
-def load_api(url):
-    ''' Makes an API request to supplied url and 
-    creates a typing prompt from the response'''
+def parse_quote(text):
+    ''' Creates a typing prompt from a quote API response'''
+
+    response = json.loads(text)
+    return f"{response['content']} - {response['author']}"
+
+
+# Parser for each kind of API response, random words come
+# from the word corpus instead
+API_PARSERS = {"quote": parse_quote}
+
+
+def start_api(url, source):
+    ''' Starts an API request to supplied url in the background,
+    returns a future for the typing prompt made from the response.
+    source is the kind of response, a key of API_PARSERS'''
+
+    # asyncio is slow to import, so only load it when it's needed
+    import network
+
+    return network.get_network().start(url, source, API_PARSERS[source])
+
+
+# Tested in pytest
+def load_api(url, source):
+    ''' Makes an API request to supplied url and creates a typing
+    prompt from the response, raises a network.NetworkError saying
+    why if the request fails'''
+
+    import network
+
+    return network.wait(start_api(url, source))
+
+
+# Tested manually
+def wait_for_fetch(window, x, y, message, future, failure):
+    ''' Shows message with a spinner while a background request runs,
+    returns its result. Returns None if 'esc' cancels the request, or if
+    it fails, after telling the user why with the failure message'''
+
+    import network
+
+    frame = 0
+    while not future.done():
+        # Turn the spinner ten times a second
+        window.timeout(100)
+        window.erase()
+        window.addstr(0, 0, "Press 'esc' to cancel", curses.color_pair(77))
+        window.addstr(y, x, f"{message} {SPINNER[frame % len(SPINNER)]}")
+        window.refresh()
+        frame += 1
+
+        key = window.getch()
+        if check_resize(key):
+            x, y = get_window_sizes()[1:]
+        elif check_esc(key):
+            future.cancel()
+            break
 
     try:
-        # Try make request to the url
-        if "quotable" in url:
-            # Request a random quote
-            response = requests.get(url, timeout=2).json()
-        else:
-            # Request a txt file of 29,136 words
-            response = requests.get(url, timeout=2).text.split("\n")
-    except:
-        # Return if an error is generated
-        return 0
-
-    if "quotable" in url:
-        # Return string of quote
-        return f"{response['content']} - {response['author']}"
-    else:
-        # Clean up response into a list of words
-        text = []
-        for word in response:
-            text.append(word.split("\t")[0].lower())
+        return network.wait(future)
+    except network.Cancelled:
+        return None
+    except network.NetworkError as error:
+        quick_print(window, x, y, f"{failure}: {error}", curses.color_pair(160))
+        sleep(2)
+        return None
+
+
+def load_random_words():
+    ''' Returns 50 random words from the word corpus, downloading
+    and building it the first time, or None if that fails'''
+
+    words = corpus.sample_words(50)
+    if words == None:
+        corpus.set_corpus(corpus.download_corpus())
+        words = corpus.sample_words(50)
+    return words
+
+
+# Tested manually
+def download_word_list(window, x, y):
+    ''' Downloads the word list and builds the word corpus the first
+    time it is needed, returns the corpus or None if that failed'''
+
+    words = wait_for_fetch(window, x, y,
+                           "Downloading word list from https://norvig.com/ngrams/",
+                           corpus.start_download(),
+                           "Unable to load random words")
+    corpus.set_corpus(words)
+    return words
+
+
+# Tested manually
+def load_practice_words(window, x, y):
+    ''' Returns 50 words with the pairs of characters the user is
+    slowest at, downloading the word list the first time, or None if
+    there isn't enough typing recorded yet'''
+
+    # numpy is slow to import, so only load it when it's needed
+    import practice
+
+    if corpus.load_corpus() == None and download_word_list(window, x, y) == None:
+        return None
+    quick_print(window, x, y, "Finding words to practise...")
+    return practice.practice_prompt(50)
+
+
+# Tested manually
+def start_prefetch():
+    ''' Starts loading prompts in the background so menu choices
+    that need the internet can start straight away'''
 
-        # Select 50 random words
-        word_selection = [text[randint(0, len(text))]
-                          for _ in range(50)]
+    global prompt_pool
+    if prompt_pool == None:
+        # The width table takes a second to build the first time
+        widths.preload()
+        prompt_pool = Prefetcher({"words": load_random_words,
+                                  "quote": lambda: load_api(QUOTE_URL,
+                                                            "quote")})
 
-        # Return string of word selection
-        return " ".join(word_selection)
+
+def take_prompt(source):
+    ''' Takes a prompt the background prefetcher has ready,
+    returns None if there isn't one'''
+
+    if prompt_pool == None:
+        return None
+    return prompt_pool.get(source)
 
 
 # Tested manually
 def menu(window, x, y, max_width):
-    ''' Displays menu for user to select an option, 
-    returns a typing prompt based on the option'''
+    ''' Displays menu for user to select an option, returns a
+    wrapped typing prompt layout based on the option, and the
+    session to race or replay or the live race, or None'''
+
+    global prompt_source
 
     # List of menu options
     menu_text = ["Welcome to Typing Wizard, a typing game to test your skills!",
@@ -524,7 +1208,12 @@ def menu(window, x, y, max_width):
                  "3. Type a quote",
                  "4. See high scores",
                  "5. FAQ",
-                 "6. Quit"]
+                 "6. Race your best or watch a replay",
+                 "7. Race other players",
+                 "8. Key speed heatmap",
+                 "9. Practise your slowest keys",
+                 "p. Your progress",
+                 "0. Quit"]
 
     # Set cursor to invisible
     curses.curs_set(0)
@@ -541,7 +1230,7 @@ def menu(window, x, y, max_width):
         for i in range(len(menu_text)):
             if i < 2:
                 colour = curses.color_pair(13)  # Magenta title text
-            elif i == 7:
+            elif i == len(menu_text) - 1:
                 colour = curses.color_pair(160)  # Red quit text
             else:
                 colour = curses.color_pair(39)  # Blue option text
@@ -550,10 +1239,15 @@ def menu(window, x, y, max_width):
         # Draw text on screen
         window.refresh()
 
+        # Once the menu is showing, start loading prompts in the background
+        start_prefetch()
+
         # Get user input
         key = window.getch()
 
-        if key == 49:  # If user presses 1
+        if check_resize(key):  # If terminal resized, redraw to fit
+            max_width, x, y = get_window_sizes()
+        elif key == 49:  # If user presses 1
             # Get a file path from user
             file_path = get_input_file_location(window, x, y)
 
@@ -561,6 +1255,8 @@ def menu(window, x, y, max_width):
             if file_path == None:
                 continue
             else:
+                # Large files take a moment to index the first time
+                quick_print(window, x, y, "Loading text file...")
                 file_text = load_input_file(file_path)
 
             if file_text == None:
@@ -568,61 +1264,71 @@ def menu(window, x, y, max_width):
                             curses.color_pair(160))
                 sleep(2)
             else:
-                return wrap(file_text, max_width, drop_whitespace=False)
+                # Long tests carry on with more passages from the file
+                prompt_source = "file"
+                return PromptLayout(file_text, max_width, more_text(
+                    lambda: load_input_file(file_path))), None
 
         elif key == 50:  # If user presses 2
-            # Loading page
-            quick_print(
-                window, x, y, "Loading 50 words from https://norvig.com/ngrams/")
-
-            # Make API call
-            response = load_api(
-                "https://norvig.com/ngrams/count_big.txt")
-
-            # Check if response is correct
-            if response != 0:
-                return wrap(response, max_width, drop_whitespace=False)
-            else:
-                # Tell user why request failed
-                quick_print(window, x, y, "Unable to load random words, sorry!",
-                            curses.color_pair(160))
-                sleep(2)
-                continue
+            # Take 50 words the prefetcher has ready, or sample them now
+            response = take_prompt("words")
+            if response == None:
+                # The first time, the word list needs to be downloaded
+                if (corpus.load_corpus() == None
+                        and download_word_list(window, x, y) == None):
+                    continue
+                response = corpus.sample_words(50)
+
+            prompt_source = "words"
+            return PromptLayout(response, max_width, more_text(
+                lambda: corpus.sample_words(50))), None
         elif key == 51:  # If user presses 3
-            # Display loading screen
-            quick_print(
-                window, x, y, "Loading a quote from https://api.quotable.io/random")
-
-            # Make API call
-            response = load_api("https://api.quotable.io/random")
-
-            # Check if response is correct
-            if response != 0:
-                return wrap(response, max_width, drop_whitespace=False)
-            else:
-                # Tell user why request failed
-                quick_print(window, x, y, "Unable to load quote, sorry!",
-                            curses.color_pair(160))
-                sleep(2)
+            # Take a quote the prefetcher has ready
+            response = take_prompt("quote")
+            if response == None:
+                # Make API call, showing a loading screen until it's done
+                response = wait_for_fetch(window, x, y,
+                                          f"Loading a quote from {QUOTE_URL}",
+                                          start_api(QUOTE_URL, "quote"),
+                                          "Unable to load quote")
+            if response == None:
                 continue
+
+            # Long tests carry on with any quotes already loaded
+            prompt_source = "quote"
+            return PromptLayout(response, max_width, more_text(
+                lambda: take_prompt("quote"))), None
         elif key == 52:  # If user presses 4
-            # Load high scores file
-            scores = load_high_score()
-            if scores == None:
-                with open("scores.txt", "w") as f:
-                    pass
-                scores = ["No high scores."]
-            window.erase()
-            window.addstr(0, 0, "Press any key to return to menu",
-                          curses.color_pair(77))
-            # Print scores to screen
-            draw(window, scores, x, y)
-            window.refresh()
-            # Wait for user input
-            window.getch()
+            leaderboard_screen(window, x, y)
         elif key == 53:  # If user presses 5
             faq_screen(window, x, y,)
         elif key == 54:  # If user presses 6
+            playback = replay_screen(window, x, y)
+            if playback != None:
+                prompt_source = playback.mode
+                return PromptLayout(playback.prompt, max_width), playback
+        elif key == 55:  # If user presses 7
+            client = race_lobby(window, x, y)
+            if client != None:
+                prompt_source = "race"
+                return PromptLayout(client.prompt, max_width), client
+        elif key == 56:  # If user presses 8
+            heatmap_screen(window, x, y)
+        elif key == ord("p"):  # If user presses p
+            progress_screen(window, x, y)
+        elif key == 57:  # If user presses 9
+            response = load_practice_words(window, x, y)
+            if response != None:
+                import practice
+                prompt_source = "practice"
+                return PromptLayout(response, max_width, more_text(
+                    lambda: practice.practice_prompt(50))), None
+            elif corpus.load_corpus() != None:
+                # Tell user why there is nothing to practise
+                quick_print(window, x, y, "Not enough typing to practise yet, "
+                            "finish a few games first!", curses.color_pair(160))
+                sleep(2)
+        elif key == 48:  # If user presses 0
             quick_print(window, x, y, "Goodbye", curses.color_pair(77))
             sleep(1)
             quit()
@@ -0,0 +1,264 @@
+import sqlite3
+import sys
+from array import array
+from datetime import date
+from time import time
+import appdata
+
+
+# Name of the session history database in the app data folder
+HISTORY_FILE = "history.db"
+
+# Number of latest sessions the rolling averages are over
+ROLLING_SESSIONS = 10
+
+# Every finished session is appended to sessions and never changed.
+# The other tables are totals kept up to date as each session is added,
+# so the progress screen reads a handful of rows however long the
+# history is: one row of overall totals, with sums over the latest
+# ROLLING_SESSIONS sessions, a row per week and the best session for
+# each difficulty and test length
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    date REAL NOT NULL,
+    source TEXT NOT NULL,
+    duration REAL NOT NULL,
+    difficulty TEXT NOT NULL,
+    test_mode TEXT NOT NULL,
+    wpm INTEGER NOT NULL,
+    accuracy REAL NOT NULL,
+    consistency REAL NOT NULL,
+    wpm_series BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    sessions INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    wpm REAL NOT NULL,
+    accuracy REAL NOT NULL,
+    rolling_wpm REAL NOT NULL,
+    rolling_accuracy REAL NOT NULL
+);
+INSERT OR IGNORE INTO totals VALUES (1, 0, 0, 0, 0, 0, 0);
+CREATE TABLE IF NOT EXISTS weeks (
+    week INTEGER PRIMARY KEY,
+    sessions INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    wpm REAL NOT NULL,
+    accuracy REAL NOT NULL,
+    best_wpm INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bests (
+    difficulty TEXT NOT NULL,
+    test_mode TEXT NOT NULL,
+    session INTEGER NOT NULL,
+    wpm INTEGER NOT NULL,
+    accuracy REAL NOT NULL,
+    date REAL NOT NULL,
+    PRIMARY KEY (difficulty, test_mode)
+);
+"""
+
+# History for the app data folder, opened by get_history
+_history = None
+
+
+def week_of(timestamp):
+    ''' Returns the number of the week a time is in, weeks start on
+    Monday in local time'''
+
+    return (date.fromtimestamp(timestamp).toordinal() - 1) // 7
+
+
+def week_start(week):
+    ''' Returns the date of the Monday a week starts on'''
+
+    return date.fromordinal(week * 7 + 1)
+
+
+def mode_key(test_mode):
+    ''' Returns the text a test length is stored as, like "time 30"'''
+
+    kind, amount = test_mode
+    return kind if amount == None else f"{kind} {amount}"
+
+
+def parse_mode(text):
+    ''' Returns the test length a mode_key stands for'''
+
+    kind, _, amount = text.partition(" ")
+    return (kind, int(amount) if amount else None)
+
+
+def pack_series(series):
+    ''' Packs wpm samples into little-endian unsigned shorts'''
+
+    samples = array("H", (min(max(int(wpm), 0), 65535) for wpm in series))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def unpack_series(data):
+    samples = array("H")
+    samples.frombytes(data)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return list(samples)
+
+
+class History:
+    ''' Every finished session in SQLite, with totals, weekly progress
+    and personal bests updated as each session is added rather than
+    worked out from every session when they are shown'''
+
+    def __init__(self, file_path):
+        # Wait for other processes' writes rather than failing
+        self.connection = sqlite3.connect(file_path, timeout=10)
+        # Write-ahead logging lets readers carry on while another writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, source, duration, difficulty, test_mode, wpm, accuracy,
+            consistency, wpm_series, timestamp=None):
+        ''' Adds a finished session and updates the totals, touching
+        only the rows the session changes, returns the session's id'''
+
+        if timestamp == None:
+            timestamp = time()
+        mode = mode_key(test_mode)
+        week = week_of(timestamp)
+
+        # One transaction, so the totals always match the sessions
+        with self.connection:
+            session = self.connection.execute(
+                "INSERT INTO sessions (date, source, duration, difficulty, "
+                "test_mode, wpm, accuracy, consistency, wpm_series) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (timestamp, source, duration, difficulty, mode, wpm,
+                 accuracy, consistency, pack_series(wpm_series))).lastrowid
+
+            # The session that has just left the rolling window
+            dropped = self.connection.execute(
+                "SELECT wpm, accuracy FROM sessions ORDER BY id DESC "
+                "LIMIT 1 OFFSET ?", (ROLLING_SESSIONS,)).fetchone()
+            dropped_wpm, dropped_accuracy = dropped or (0, 0)
+            self.connection.execute(
+                "UPDATE totals SET sessions = sessions + 1, "
+                "seconds = seconds + ?, wpm = wpm + ?, "
+                "accuracy = accuracy + ?, rolling_wpm = rolling_wpm + ?, "
+                "rolling_accuracy = rolling_accuracy + ?",
+                (duration, wpm, accuracy, wpm - dropped_wpm,
+                 accuracy - dropped_accuracy))
+
+            self.connection.execute(
+                "INSERT INTO weeks VALUES (?, 1, ?, ?, ?, ?) "
+                "ON CONFLICT (week) DO UPDATE SET "
+                "sessions = sessions + 1, seconds = seconds + excluded.seconds, "
+                "wpm = wpm + excluded.wpm, "
+                "accuracy = accuracy + excluded.accuracy, "
+                "best_wpm = max(best_wpm, excluded.best_wpm)",
+                (week, duration, wpm, accuracy, wpm))
+
+            self.connection.execute(
+                "INSERT INTO bests VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (difficulty, test_mode) DO UPDATE SET "
+                "session = excluded.session, wpm = excluded.wpm, "
+                "accuracy = excluded.accuracy, date = excluded.date "
+                "WHERE excluded.wpm > wpm",
+                (difficulty, mode, session, wpm, accuracy, timestamp))
+        return session
+
+    def totals(self):
+        ''' Returns {sessions, seconds, wpm, accuracy, rolling_wpm,
+        rolling_accuracy}, with averages over every session and over
+        the latest ROLLING_SESSIONS'''
+
+        sessions, seconds, wpm, accuracy, rolling_wpm, rolling_accuracy = (
+            self.connection.execute(
+                "SELECT sessions, seconds, wpm, accuracy, rolling_wpm, "
+                "rolling_accuracy FROM totals").fetchone())
+        count = max(sessions, 1)
+        rolling = max(min(sessions, ROLLING_SESSIONS), 1)
+        return {"sessions": sessions, "seconds": seconds,
+                "wpm": wpm / count, "accuracy": accuracy / count,
+                "rolling_wpm": rolling_wpm / rolling,
+                "rolling_accuracy": rolling_accuracy / rolling}
+
+    def weeks(self, count):
+        ''' Returns the latest count weeks with sessions, oldest first,
+        as (week, sessions, seconds, average wpm, best wpm)'''
+
+        rows = self.connection.execute(
+            "SELECT week, sessions, seconds, wpm / sessions, best_wpm "
+            "FROM weeks ORDER BY week DESC LIMIT ?", (count,)).fetchall()
+        rows.reverse()
+        return rows
+
+    def recent(self, count):
+        ''' Returns the wpm of the latest count sessions, oldest first'''
+
+        rows = self.connection.execute(
+            "SELECT wpm FROM sessions ORDER BY id DESC LIMIT ?",
+            (count,)).fetchall()
+        return [wpm for wpm, in reversed(rows)]
+
+    def bests(self):
+        ''' Returns the personal bests as (difficulty, test length, wpm,
+        accuracy, date), fastest first'''
+
+        return self.connection.execute(
+            "SELECT difficulty, test_mode, wpm, accuracy, date FROM bests "
+            "ORDER BY wpm DESC").fetchall()
+
+    def last_series(self):
+        ''' Returns the wpm each second of the latest session, or an
+        empty list if there isn't one'''
+
+        row = self.connection.execute(
+            "SELECT wpm_series FROM sessions ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        return [] if row == None else unpack_series(row[0])
+
+
+# Tested in pytest
+def chart_rows(values, height, top=None):
+    ''' Draws values as a bar chart of height rows, one column per
+    value, returns the rows from the top down. Bars are scaled so top,
+    or the largest value, fills the height'''
+
+    if top == None:
+        top = max(values, default=0)
+    # Each row is split in two, ':' is a bar ending half way up a row
+    levels = [round(value / top * height * 2) if top > 0 else 0
+              for value in values]
+    rows = []
+    for row in range(height, 0, -1):
+        rows.append("".join("#" if level >= row * 2 else
+                            ":" if level == row * 2 - 1 else " "
+                            for level in levels))
+    return rows
+
+
+def get_history():
+    ''' Returns the session history in the app data folder, opening
+    it the first time'''
+
+    global _history
+    if _history == None:
+        _history = History(appdata.data_path(HISTORY_FILE))
+    return _history
+
+
+def record_session(stats, end_ns, source, hard_mode, test_mode):
+    ''' Adds a finished game to the history in the app data folder'''
+
+    _, wpm, accuracy = stats.wpm_at(end_ns)
+    get_history().add(source, stats.elapsed(end_ns),
+                      "Hard mode" if hard_mode else "Easy mode", test_mode,
+                      wpm, accuracy, stats.consistency(),
+                      stats.wpm_series(end_ns))
@@ -0,0 +1,168 @@
+import json
+import re
+import struct
+import threading
+import zlib
+from hashlib import sha1
+from os import listdir, path, remove, replace, stat, utime
+from time import time
+import appdata
+
+
+# Folder in the app data folder responses are cached in
+CACHE_FOLDER = "http_cache"
+
+# Entry file layout: header (magic, length of the details), the details
+# as JSON (url, ETag, Last-Modified, when it was stored and for how
+# long it is fresh), then the zlib compressed response body
+MAGIC = b"TWHTTP01"
+HEADER = struct.Struct("<8sI")
+
+# Bytes of entries kept on disk, the least recently used go first
+MAX_BYTES = 32 << 20
+
+# max-age in a Cache-Control header
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class CacheEntry:
+    ''' A cached response body, with what is needed to check it
+    with the server again'''
+
+    def __init__(self, url, body, etag=None, last_modified=None,
+                 stored=0, ttl=0):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = stored
+        self.ttl = ttl
+
+    def fresh(self, now=None):
+        ''' Checks the entry can be used without asking the server'''
+
+        if now == None:
+            now = time()
+        return now - self.stored < self.ttl
+
+    def conditional_headers(self):
+        ''' Returns headers asking the server to answer 304 Not
+        Modified if the body hasn't changed'''
+
+        headers = {}
+        if self.etag != None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified != None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+# Tested in pytest
+def response_ttl(headers, default):
+    ''' Returns the seconds a response stays fresh, from its
+    Cache-Control header or the default, or None if it mustn't be
+    stored at all'''
+
+    control = headers.get("Cache-Control", "").lower()
+    if "no-store" in control:
+        return None
+    if "no-cache" in control:
+        return 0
+    max_age = MAX_AGE.search(control)
+    if max_age != None:
+        return int(max_age.group(1))
+    return default
+
+
+class HttpCache:
+    ''' Response bodies saved on disk by URL, one file each, so
+    downloads that haven't changed aren't downloaded again. A file's
+    modification time is when it was last used, so the least recently
+    used are removed when the cache is over its size'''
+
+    def __init__(self, folder=None, max_bytes=MAX_BYTES):
+        if folder == None:
+            folder = path.dirname(appdata.data_path(
+                path.join(CACHE_FOLDER, "_")))
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+        # Entries are written from the network threads
+        self.lock = threading.Lock()
+
+    def entry_path(self, url):
+        ''' Returns the file an entry for a url is kept in'''
+
+        key = sha1(url.encode("utf-8")).hexdigest()
+        return path.join(self.folder, f"{key}.cache")
+
+    def lookup(self, url):
+        ''' Returns the cached entry for a url, or None if there isn't
+        one, marking it as just used'''
+
+        file_path = self.entry_path(url)
+        try:
+            with open(file_path, "rb") as f:
+                magic, length = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC:
+                    return None
+                details = json.loads(f.read(length).decode("utf-8"))
+                body = zlib.decompress(f.read())
+            utime(file_path)
+        except (OSError, ValueError, struct.error, zlib.error):
+            return None
+        if details["url"] != url:
+            return None
+        return CacheEntry(url, body, details["etag"],
+                          details["last_modified"], details["stored"],
+                          details["ttl"])
+
+    def store(self, entry):
+        ''' Saves an entry, then removes the least recently used
+        entries if the cache is too big'''
+
+        details = json.dumps({"url": entry.url, "etag": entry.etag,
+                              "last_modified": entry.last_modified,
+                              "stored": entry.stored,
+                              "ttl": entry.ttl}).encode("utf-8")
+        file_path = self.entry_path(entry.url)
+
+        # Each thread writes its own temporary file
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(details)))
+            f.write(details)
+            f.write(zlib.compress(entry.body, 6))
+        with self.lock:
+            replace(temp_path, file_path)
+            self.evict()
+
+    def evict(self):
+        ''' Removes the least recently used entries until the cache
+        fits in its size'''
+
+        entries = []
+        for name in listdir(self.folder):
+            if name.endswith(".cache"):
+                try:
+                    info = stat(path.join(self.folder, name))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime_ns, info.st_size, name))
+        entries.sort(reverse=True)
+
+        used = 0
+        for _, size, name in entries:
+            used += size
+            # The newest entry is always kept, even if it's over the size
+            if used > self.max_bytes and used > size:
+                try:
+                    remove(path.join(self.folder, name))
+                except OSError:
+                    pass
+
+    def size(self):
+        ''' Returns the bytes of entries on disk'''
+
+        return sum(stat(path.join(self.folder, name)).st_size
+                   for name in listdir(self.folder) if name.endswith(".cache"))
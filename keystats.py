@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from os import path
+import numpy as np
+import appdata
+from stats import BACKSPACE
+
+# File locks keep two copies of the app from adding to the statistics
+# at once, Windows has no fcntl so sessions there aren't locked
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Name of the key statistics file in the app data folder
+KEYSTATS_FILE = "keystats.npy"
+
+# Printable ASCII characters are tracked, index 0 stands for the start
+# of the prompt and each character c is at index ord(c) - 31
+FIRST_CHAR = 32
+LAST_CHAR = 126
+SIZE = LAST_CHAR - FIRST_CHAR + 2
+
+# The statistics file is one fixed-size array of planes, each indexed
+# by [previous prompt character, prompt character], the sums for a key
+# are the sums over every previous character
+ATTEMPTS, ERRORS, TIMED, TOTAL_MS = range(4)
+SHAPE = (4, SIZE, SIZE)
+
+# Gaps between keystrokes longer than this are pauses, not typing speed
+MAX_GAP_NS = 2 * 10**9
+
+# How much mistakes add to a pair's cost when choosing what to
+# practise, a pair mistyped one time in ten counts as 50% slower
+ERROR_WEIGHT = 5
+
+# Keyboard rows drawn by the heatmap, and the key each shifted
+# character is typed with on a US keyboard
+KEYBOARD = ["`1234567890-=", "qwertyuiop[]\\", "asdfghjkl;'", "zxcvbnm,./"]
+SHIFTED = dict(zip('~!@#$%^&*()_+{}|:"<>?', "`1234567890-=[]\\;',./"))
+
+
+def char_index(codes):
+    ''' Maps character codes to statistics indexes, 0 if not tracked'''
+
+    return np.where((codes >= FIRST_CHAR) & (codes <= LAST_CHAR),
+                    codes - (FIRST_CHAR - 1), 0)
+
+
+def open_stats(file_path=None, mode="r+"):
+    ''' Opens the statistics file as a memory mapped array,
+    creating it the first time'''
+
+    if file_path == None:
+        file_path = appdata.data_path(KEYSTATS_FILE)
+    if not path.isfile(file_path):
+        if mode == "r":
+            return np.zeros(SHAPE)
+        return np.lib.format.open_memmap(file_path, mode="w+",
+                                         dtype=np.float64, shape=SHAPE)
+    data = np.lib.format.open_memmap(file_path, mode=mode)
+    if data.shape != SHAPE:
+        raise ValueError("Key statistics file has the wrong shape")
+    return data
+
+
+@contextmanager
+def locked(file_path):
+    ''' Holds a lock on the statistics file while the block runs, so
+    another process can't create or add to it at the same time. The
+    lock is taken on a file next to it, as the statistics file may not
+    exist yet'''
+
+    if fcntl == None:
+        yield
+        return
+    with open(file_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Tested in pytest
+def record_session(prompt, log, file_path=None):
+    ''' Adds the keystrokes of a finished session to the statistics,
+    touching only the session's keystrokes and never past sessions'''
+
+    if len(log) == 0:
+        return
+    times = np.frombuffer(log.times, dtype=np.int64)
+    positions = np.frombuffer(log.positions, dtype=np.int32)
+    correct = np.frombuffer(log.correct, dtype=np.int8)
+    prompt_codes = np.frombuffer(prompt.encode("utf-32-le"), dtype=np.uint32)
+
+    # A keystroke's latency is the gap since the one before, unless that
+    # was a backspace, as fixing a mistake isn't typing speed
+    gaps = np.diff(times, prepend=times[0])
+    timed = np.ones(len(times), dtype=bool)
+    timed[0] = False
+    timed[1:] &= correct[:-1] != BACKSPACE
+    timed &= gaps <= MAX_GAP_NS
+
+    # Only typed characters are counted, against the prompt character due
+    typed = (correct != BACKSPACE) & (positions < len(prompt_codes))
+    positions = positions[typed]
+    key = char_index(prompt_codes[positions].astype(np.int64))
+    previous = np.where(
+        positions > 0,
+        char_index(prompt_codes[np.maximum(positions - 1, 0)].astype(np.int64)),
+        0)
+    wrong = correct[typed] == 0
+    gaps = gaps[typed]
+    timed = timed[typed]
+
+    # Untracked characters are left out
+    tracked = key > 0
+    key, previous = key[tracked], previous[tracked]
+    wrong, gaps, timed = wrong[tracked], gaps[tracked], timed[tracked]
+
+    # np.add.at reads and writes the shared file, so another process
+    # adding at the same time could lose one of the sessions
+    if file_path == None:
+        file_path = appdata.data_path(KEYSTATS_FILE)
+    with locked(file_path):
+        data = open_stats(file_path)
+        np.add.at(data[ATTEMPTS], (previous, key), 1)
+        np.add.at(data[ERRORS], (previous[wrong], key[wrong]), 1)
+        np.add.at(data[TIMED], (previous[timed], key[timed]), 1)
+        np.add.at(data[TOTAL_MS], (previous[timed], key[timed]),
+                  gaps[timed] / 1e6)
+        data.flush()
+
+
+def key_summary(data):
+    ''' Returns {key: (mean latency in ms or None, error rate, attempts)}
+    for the keyboard keys, counting shifted characters with their key'''
+
+    totals = data.sum(axis=1)
+    summary = {}
+    for row in KEYBOARD + [" "]:
+        for key in row:
+            summary[key] = np.zeros(4)
+    for code in range(FIRST_CHAR, LAST_CHAR + 1):
+        char = chr(code).lower()
+        char = SHIFTED.get(char, char)
+        summary[char] += totals[:, code - (FIRST_CHAR - 1)]
+
+    result = {}
+    for key, (attempts, errors, timed, total_ms) in summary.items():
+        mean = float(total_ms / timed) if timed else None
+        rate = float(errors / attempts) if attempts else 0.0
+        result[key] = (mean, rate, int(attempts))
+    return result
+
+
+def slowest_bigrams(data, count=8, min_samples=3):
+    ''' Returns the slowest pairs of characters as (pair, mean latency
+    in ms), only counting pairs typed at least min_samples times'''
+
+    timed = data[TIMED, 1:, 1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = data[TOTAL_MS, 1:, 1:] / timed
+    pairs = [(chr(first + FIRST_CHAR) + chr(second + FIRST_CHAR),
+              float(means[first, second]))
+             for first, second in zip(*np.nonzero(timed >= min_samples))]
+    return sorted(pairs, key=lambda pair: (-pair[1], pair[0]))[:count]
+
+
+def weakest_bigrams(data, count=10, min_samples=3):
+    ''' Returns the pairs of characters most worth practising as
+    (pair, cost), the mean latency in ms made worse by mistakes,
+    only counting pairs typed at least min_samples times'''
+
+    timed = data[TIMED, 1:, 1:]
+    attempts = data[ATTEMPTS, 1:, 1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        costs = (data[TOTAL_MS, 1:, 1:] / timed
+                 * (1 + ERROR_WEIGHT * data[ERRORS, 1:, 1:] / attempts))
+    pairs = [(chr(first + FIRST_CHAR) + chr(second + FIRST_CHAR),
+              float(costs[first, second]))
+             for first, second in zip(*np.nonzero(timed >= min_samples))]
+    return sorted(pairs, key=lambda pair: (-pair[1], pair[0]))[:count]
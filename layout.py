@@ -0,0 +1,366 @@
+import re
+import sys
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from copy import copy
+from itertools import accumulate
+from queue import Queue
+import widths
+
+
+# Rows kept above the first row on screen once a prompt has scrolled,
+# so backspace can still reach back a little way
+KEPT_ROWS = 2
+
+WORD = re.compile(r"\S+")
+
+# Bytes of wrapped prompts the layout cache keeps
+CACHE_BUDGET = 8 << 20
+
+
+def first_words(text, count):
+    ''' Returns the text up to the end of its count-th word'''
+
+    for number, word in enumerate(WORD.finditer(text)):
+        if number == count - 1:
+            return text[:word.end()]
+    return text
+
+
+def more_text(load):
+    ''' Generator of more text for a prompt from a loading function,
+    ending the first time the function has nothing to give'''
+
+    while True:
+        text = load()
+        if not text:
+            return
+        yield text
+
+
+def wrap_offsets(text, width):
+    ''' Wraps text to width screen columns, returns the lines and the
+    offset each starts at, with a final entry for the end of the text'''
+
+    lines = tuple(widths.wrap(text, width))
+    return lines, (0, *accumulate(len(line) for line in lines))
+
+
+def layout_size(lines, offsets):
+    ''' Returns roughly how many bytes a wrapped prompt takes'''
+
+    return (sys.getsizeof(lines) + sys.getsizeof(offsets)
+            + sum(sys.getsizeof(line) for line in lines)
+            + 32 * len(offsets))
+
+
+class LayoutCache:
+    ''' Wrapped lines and line offsets of prompts by the prompt's hash
+    and the width, so wrapping a prompt again at a width it has been
+    wrapped to before, like after resizing back or restarting it, is a
+    dictionary lookup. The least recently used layouts are dropped once
+    the cache takes more than its budget in bytes.
+    Layouts can be worked out ahead of time in a background thread'''
+
+    def __init__(self, budget=CACHE_BUDGET):
+        self.budget = budget
+        self.layouts = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Layouts are added from the background thread too
+        self.lock = threading.Lock()
+
+        # Prompts waiting to be wrapped in the background, and the
+        # thread wrapping them, started the first time it's needed
+        self.queue = Queue()
+        self.worker = None
+
+    def wrap(self, text, width):
+        ''' Returns the lines and line offsets of text wrapped to width
+        screen columns, as tuples so they can be shared'''
+
+        # Long prompts are only hashed once, str keeps its hash
+        key = (hash(text), len(text), width)
+        with self.lock:
+            layout = self.layouts.get(key)
+            if layout != None:
+                self.layouts.move_to_end(key)
+                self.hits += 1
+                return layout
+            self.misses += 1
+
+        layout = wrap_offsets(text, width)
+        size = layout_size(*layout)
+        with self.lock:
+            if key not in self.layouts:
+                self.layouts[key] = layout
+                self.size += size
+
+            # Drop the least recently used layouts, keeping this one
+            while self.size > self.budget and len(self.layouts) > 1:
+                _, old = self.layouts.popitem(last=False)
+                self.size -= layout_size(*old)
+        return layout
+
+    def precompute(self, text, screen_widths):
+        ''' Wraps text to each width in the background, so it is
+        ready if the terminal is resized to one of them'''
+
+        if self.worker == None:
+            self.worker = threading.Thread(target=self._work,
+                                           name="layout-cache", daemon=True)
+            self.worker.start()
+        self.queue.put((text, tuple(screen_widths)))
+
+    def _work(self):
+        ''' Wraps prompts from the queue until the app closes'''
+
+        while True:
+            text, screen_widths = self.queue.get()
+            for width in screen_widths:
+                self.wrap(text, width)
+            self.queue.task_done()
+
+    def wait(self):
+        ''' Waits for the background thread to wrap every queued prompt'''
+
+        self.queue.join()
+
+    def clear(self):
+        ''' Empties the cache'''
+
+        with self.lock:
+            self.layouts.clear()
+            self.size = 0
+
+
+# Layouts shared by every prompt
+layout_cache = LayoutCache()
+
+
+class PromptLayout:
+    ''' A typing prompt wrapped to a maximum width in screen columns,
+    with the character offset each line starts at so typed positions
+    map straight to rows.
+    A prompt can show only some of its rows, scrolling as it is typed
+    and dropping rows far above the screen, and can grow from a
+    generator of more text as the user nears its end'''
+
+    def __init__(self, text, width, more=None, word_limit=None):
+        # Wrap the prompt once, keeping spaces so offsets line up
+        self.width = width
+        text = widths.normalize(text)
+        self.source = text
+        self.word_limit = word_limit
+        if word_limit != None:
+            text = first_words(text, word_limit)
+        lines, offsets = layout_cache.wrap(text, width)
+        self.lines = list(lines)
+        self.text = ''.join(lines)
+
+        # Index in text just after each word, kept up to date as the
+        # prompt grows so the words left are found without a rescan
+        self.word_ends = [word.end() for word in WORD.finditer(self.text)]
+
+        # offsets[i] is the index in text where line i starts,
+        # with a final entry for the end of the prompt
+        self.offsets = list(offsets)
+
+        # Generator of more text, None once the prompt is complete
+        self.more = more
+        if word_limit != None and len(self.word_ends) >= word_limit:
+            self.more = None
+
+        # Row number of lines[0], rows above it have been dropped
+        self.first_row = 0
+
+        # First row on screen and the number of rows shown, None for all
+        self.top = 0
+        self.rows = None
+
+    def reflow(self, width):
+        ''' Returns the prompt wrapped to a new width, character
+        positions stay the same so typed input still lines up'''
+
+        if width == self.width:
+            return self
+        layout = copy(self)
+        layout.width = width
+        layout.lines = list(self.lines)
+        layout.offsets = list(self.offsets)
+        layout.word_ends = list(self.word_ends)
+        layout._wrap_from(0)
+        layout.top = layout.first_row
+        return layout
+
+    def limit_words(self, word_limit):
+        ''' Returns the prompt cut to a number of words, or its full
+        text for None, before any of it has been typed'''
+
+        layout = PromptLayout(self.source, self.width, self.more, word_limit)
+        layout.rows = self.rows
+        return layout
+
+    def precompute(self, screen_widths):
+        ''' Wraps the prompt to other widths in the background, so
+        resizing to one of them doesn't have to wait for it'''
+
+        layout_cache.precompute(self.text[self.offsets[0]:], screen_widths)
+
+    def _wrap_from(self, i, added=""):
+        ''' Re-wraps the text from the start of lines[i] onwards, with
+        added text on the end'''
+
+        start = self.offsets[i]
+        if i == 0:
+            # All of the prompt kept is re-wrapped on a resize, which
+            # the cache may already have
+            lines, offsets = layout_cache.wrap(self.text[start:] + added,
+                                               self.width)
+        else:
+            lines, offsets = wrap_offsets(self.text[start:] + added,
+                                          self.width)
+        self.text = self.text[:start] + ''.join(lines)
+        del self.lines[i:]
+        self.lines.extend(lines)
+        del self.offsets[i:]
+        self.offsets.extend(start + offset for offset in offsets)
+
+    def extend(self, text):
+        ''' Adds text to the end of the prompt, re-wrapping only its
+        last lines, returns the text added'''
+
+        text = widths.normalize(text)
+        if self.text and not self.text[-1].isspace():
+            text = " " + text
+        if self.word_limit != None:
+            # Stop the prompt at the word limit
+            remaining = self.word_limit - len(self.word_ends)
+            if len(WORD.findall(text)) >= remaining:
+                text = first_words(text, remaining) if remaining > 0 else ""
+                self.more = None
+        length = len(self.text)
+        # The last word of the second to last line may now
+        # run on, so wrapping starts from there
+        self._wrap_from(max(0, len(self.lines) - 2), text)
+        # The added text starts with a space or follows one,
+        # so its words are new words
+        self.word_ends.extend(word.end()
+                              for word in WORD.finditer(self.text, length))
+        return self.text[length:]
+
+    def fill(self, position, ahead):
+        ''' Adds text from the generator until there are at least ahead
+        characters past position, returns the text added'''
+
+        added = ""
+        while self.more != None and len(self.text) - position < ahead:
+            text = next(self.more, None)
+            if text == None:
+                self.more = None
+            else:
+                added += self.extend(text)
+        return added
+
+    def words_left(self, position):
+        ''' Returns the number of words not typed to their end from a
+        position, a word part way through counts as left'''
+
+        return len(self.word_ends) - bisect_right(self.word_ends, position)
+
+    def complete(self):
+        ''' Checks the prompt won't get any longer'''
+
+        return self.more == None
+
+    def __len__(self):
+        return self.first_row + len(self.lines)
+
+    def line(self, row):
+        ''' Returns the text of a row'''
+
+        return self.lines[row - self.first_row]
+
+    def locate(self, position):
+        ''' Finds the (row, column) of a character position in the prompt'''
+
+        # The end of the prompt sits just after the last character
+        if position >= len(self.text):
+            if len(self.lines) == 0:
+                return (0, 0)
+            return (len(self) - 1, len(self.lines[-1]))
+
+        # Positions in dropped rows are placed at the first row kept
+        if position < self.offsets[0]:
+            return (self.first_row, 0)
+
+        index = bisect_right(self.offsets, position) - 1
+        return (self.first_row + index, position - self.offsets[index])
+
+    def display_column(self, row, column):
+        ''' Returns the screen column of a character in a row, wide
+        characters take two columns and accents none'''
+
+        return widths.columns(self.line(row))[column]
+
+    def grapheme_start(self, position):
+        ''' Returns the position of the first character of the
+        grapheme holding a position, like a letter under an accent'''
+
+        row, column = self.locate(position)
+        start = position - column
+        return start + widths.grapheme_start(self.line(row), column)
+
+    def typed_line(self, user_typed_string, row):
+        ''' Returns the part of the typed string that sits over a prompt line'''
+
+        index = row - self.first_row
+        return user_typed_string[self.offsets[index]:self.offsets[index + 1]]
+
+    def start(self):
+        ''' Returns the position of the first character still kept,
+        backspace can't go back past it'''
+
+        return self.offsets[0]
+
+    def set_rows(self, rows):
+        ''' Shows at most rows rows at a time, None shows them all'''
+
+        self.rows = None if rows == None else max(3, rows)
+
+    def visible_rows(self):
+        ''' Returns the rows on screen'''
+
+        if self.rows == None:
+            return range(self.first_row, len(self))
+        return range(self.top, min(len(self), self.top + self.rows))
+
+    def scroll_to(self, position):
+        ''' Scrolls so the row being typed has a row on screen above and
+        below it, dropping rows far above the screen, returns True if
+        the prompt scrolled'''
+
+        if self.rows == None:
+            return False
+        row = self.locate(position)[0]
+        top = self.top
+        if row > top + self.rows - 2:
+            # Reaching the last row on screen brings the next rows up
+            top = min(row - 1, len(self) - self.rows)
+        elif row < top + 1:
+            top = row - 1
+        top = max(top, self.first_row)
+        if top == self.top:
+            return False
+        self.top = top
+
+        # Drop the rows too far above the screen to go back to
+        drop = top - KEPT_ROWS - self.first_row
+        if drop > 0:
+            del self.lines[:drop]
+            del self.offsets[:drop]
+            self.first_row += drop
+        return True
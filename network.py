@@ -0,0 +1,247 @@
+import asyncio
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from time import time
+from http_cache import CacheEntry, HttpCache, response_ttl
+
+
+# Seconds one attempt at loading from each source may take, how many
+# times a failed attempt is tried again, and seconds a cached response
+# is used before checking with the server again, None to not cache it.
+# Quotes are random, so they are always checked, but a cached one can
+# still be typed when offline
+SOURCES = {
+    "quote": {"timeout": 2, "retries": 2, "ttl": 0},
+    "corpus": {"timeout": 15, "retries": 1, "ttl": 7 * 86400},
+}
+DEFAULT_SOURCE = {"timeout": 5, "retries": 1, "ttl": None}
+
+# Seconds waited before the first retry, doubling for each retry after
+BACKOFF = 0.25
+MAX_BACKOFF = 4
+
+# Connections kept open to each host, and requests run at once
+POOL_SIZE = 4
+
+# Shared network loop, created the first time it is needed
+_network = None
+
+
+class NetworkError(Exception):
+    ''' Loading something from the internet failed, the message says
+    why in words that can be shown to the user'''
+
+
+class RequestTimeout(NetworkError):
+    ''' The server took too long to answer'''
+
+
+class ConnectionFailed(NetworkError):
+    ''' The server couldn't be reached, like when offline'''
+
+
+class ServerError(NetworkError):
+    ''' The server answered with an HTTP error status'''
+
+    def __init__(self, status):
+        super().__init__(f"the server answered with error {status}")
+        self.status = status
+
+
+class BadResponse(NetworkError):
+    ''' The server's answer wasn't what was expected'''
+
+
+class Cancelled(NetworkError):
+    ''' The user stopped waiting for the request'''
+
+
+def retryable(error):
+    ''' Checks a failed request is worth trying again, timeouts, lost
+    connections and server errors often pass, a missing page won't'''
+
+    if isinstance(error, ServerError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (RequestTimeout, ConnectionFailed))
+
+
+class Network:
+    ''' Runs requests on an asyncio loop in a background thread, so the
+    game never waits on the internet. Requests share one
+    requests.Session, which keeps connections to each host open so
+    later requests skip connecting again.
+    With a cache, responses are saved on disk and only downloaded
+    again once they are stale and the server says they've changed'''
+
+    def __init__(self, backoff=BACKOFF, pool_size=POOL_SIZE, cache=None):
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.cache = cache
+
+        # requests is slow to import, so the session is made on first use
+        self.session = None
+        self.session_lock = threading.Lock()
+
+        # Blocking requests calls run on the executor's threads
+        self.executor = ThreadPoolExecutor(pool_size,
+                                           thread_name_prefix="network")
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name="network", daemon=True)
+        self.thread.start()
+
+    def _session(self):
+        ''' Returns the shared session, creating it the first time'''
+
+        with self.session_lock:
+            if self.session == None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+            return self.session
+
+    def _get(self, url, timeout, ttl=None):
+        ''' Makes one blocking request, turning requests' errors into
+        NetworkErrors, returns the response text. A fresh cached
+        response is returned without asking the server, a stale one
+        is only downloaded again if the server says it has changed'''
+
+        entry = None
+        if self.cache != None and ttl != None:
+            entry = self.cache.lookup(url)
+            if entry != None and entry.fresh():
+                return entry.body.decode("utf-8")
+
+        session = self._session()
+        import requests
+
+        headers = {} if entry == None else entry.conditional_headers()
+        try:
+            response = session.get(url, timeout=timeout, headers=headers)
+        except requests.Timeout:
+            raise RequestTimeout("the server took too long to answer")
+        except requests.ConnectionError:
+            raise ConnectionFailed("couldn't connect, check your internet")
+        except requests.RequestException as error:
+            raise NetworkError(str(error))
+
+        if response.status_code == 304 and entry != None:
+            # Not modified, the cached body is fresh for another ttl
+            entry.ttl = response_ttl(response.headers, ttl)
+            if entry.ttl != None:
+                entry.stored = time()
+                self.cache.store(entry)
+            return entry.body.decode("utf-8")
+        if response.status_code >= 400:
+            raise ServerError(response.status_code)
+
+        text = response.text
+        if self.cache != None and ttl != None:
+            ttl = response_ttl(response.headers, ttl)
+            if ttl != None:
+                self.cache.store(CacheEntry(
+                    url, text.encode("utf-8"), response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"), time(), ttl))
+        return text
+
+    def _stale(self, url, ttl):
+        ''' Returns the cached text for a url however old it is, or
+        None if it isn't cached'''
+
+        if self.cache == None or ttl == None:
+            return None
+        entry = self.cache.lookup(url)
+        if entry == None:
+            return None
+        return entry.body.decode("utf-8")
+
+    async def get(self, url, source=None, timeout=None, retries=None):
+        ''' Loads the text at a url, trying again after failures that
+        may pass, waiting longer each time. If every attempt fails a
+        stale cached copy is used, like when offline, or a
+        NetworkError is raised if there isn't one'''
+
+        settings = SOURCES.get(source, DEFAULT_SOURCE)
+        if timeout == None:
+            timeout = settings["timeout"]
+        if retries == None:
+            retries = settings["retries"]
+        ttl = settings["ttl"]
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(retries + 1):
+            try:
+                # The request's own timeout ends it in its thread, the
+                # outer one makes sure the attempt is given up on
+                return await asyncio.wait_for(
+                    loop.run_in_executor(None, self._get, url, timeout, ttl),
+                    timeout + 1)
+            except asyncio.TimeoutError:
+                error = RequestTimeout("the server took too long to answer")
+            except NetworkError as failure:
+                error = failure
+            if attempt == retries or not retryable(error):
+                if retryable(error):
+                    stale = await loop.run_in_executor(None, self._stale,
+                                                       url, ttl)
+                    if stale != None:
+                        return stale
+                raise error
+            await asyncio.sleep(min(self.backoff * 2 ** attempt, MAX_BACKOFF))
+
+    async def fetch(self, url, source=None, parse=None, timeout=None,
+                    retries=None):
+        ''' Loads a url and turns its text into a result with parse,
+        which runs off the loop so a slow parse holds nothing up'''
+
+        text = await self.get(url, source, timeout, retries)
+        if parse == None:
+            return text
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, parse, text)
+        except (ValueError, KeyError, TypeError) as error:
+            raise BadResponse(f"the server's answer couldn't be read "
+                              f"({error})")
+
+    def start(self, url, source=None, parse=None, timeout=None, retries=None):
+        ''' Starts loading a url in the background, returns a
+        concurrent.futures.Future for the result that can be cancelled'''
+
+        return asyncio.run_coroutine_threadsafe(
+            self.fetch(url, source, parse, timeout, retries), self.loop)
+
+    def close(self):
+        ''' Stops the loop and closes the session's connections'''
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.session != None:
+            self.session.close()
+
+
+def wait(future, timeout=None):
+    ''' Waits for a request started with Network.start, returns its
+    result or raises its NetworkError, or Cancelled if it was cancelled'''
+
+    try:
+        return future.result(timeout)
+    except CancelledError:
+        raise Cancelled("cancelled")
+
+
+def get_network():
+    ''' Returns the app's network loop, starting it the first time'''
+
+    global _network
+    if _network == None:
+        _network = Network(cache=HttpCache())
+    return _network
@@ -0,0 +1,191 @@
+import mmap
+import re
+import struct
+import sys
+from array import array
+from hashlib import sha1
+from os import path, replace, stat
+from random import Random
+import appdata
+
+
+# Folder in the app data folder the sentence indexes are cached in
+INDEX_FOLDER = "passages"
+
+# Index file layout: header (magic, file mtime in ns, file size, number
+# of sentences, next sentence for sequential passages) then the byte
+# offset each sentence starts at as little-endian uint64
+MAGIC = b"TWPASS01"
+HEADER = struct.Struct("<8sqqQQ")
+OFFSET = struct.Struct("<Q")
+
+# Where a new sentence or paragraph starts: after sentence punctuation
+# (and any closing quotes or brackets) followed by whitespace, or a blank line
+SENTENCE_END = re.compile(rb"[.!?][\"')\]]*\s+|\n[ \t\r]*\n\s*")
+
+# Characters a sentence ending can start with
+ENDINGS = (b".", b"!", b"?", b"\n")
+
+# Start of the first sentence
+TEXT = re.compile(rb"\S")
+
+# A word is any run of characters that aren't whitespace
+WORD = re.compile(rb"\S+")
+
+# The file is read, and offsets are written to the
+# index, in chunks so memory use stays flat
+READ_SIZE = 1 << 20
+CHUNK = 65536
+
+
+def index_path(file_path):
+    ''' Returns where the sentence index for a text file is cached'''
+
+    key = sha1(path.abspath(file_path).encode("utf-8")).hexdigest()
+    return appdata.data_path(path.join(INDEX_FOLDER, f"{key}.idx"))
+
+
+def build_index(file_path, index_file):
+    ''' Streams a text file in chunks and writes the byte offset
+    of every sentence to the index file, returns the count'''
+
+    info = stat(file_path)
+    count = 0
+    offsets = array("Q")
+    with open(file_path, "rb") as f, open(index_file + ".tmp", "wb") as out:
+        # Header is written again once the number of sentences is known
+        out.write(HEADER.pack(MAGIC, info.st_mtime_ns, info.st_size, 0, 0))
+
+        # File offset of the start of the buffer
+        base = 0
+        buffer = b""
+        started = False
+        while True:
+            scan_from = 0
+            chunk = f.read(READ_SIZE)
+            end_of_file = len(chunk) == 0
+            buffer += chunk
+
+            # The first sentence starts at the first non-whitespace byte
+            if not started:
+                first = TEXT.search(buffer)
+                if first == None:
+                    base += len(buffer)
+                    buffer = b""
+                    if end_of_file:
+                        break
+                    continue
+                offsets.append(base + first.start())
+                scan_from = first.start()
+                started = True
+
+            # Keep the end of the buffer from the last character that could
+            # start a sentence ending, in case one is split across chunks
+            cut = max(buffer.rfind(char, scan_from) for char in ENDINGS)
+            if cut == -1:
+                cut = len(buffer)
+            for match in SENTENCE_END.finditer(buffer, scan_from):
+                if match.end() == len(buffer):
+                    if not end_of_file:
+                        cut = min(cut, match.start())
+                    break
+                offsets.append(base + match.end())
+                cut = max(cut, match.end())
+            if len(offsets) >= CHUNK:
+                count += _write_offsets(out, offsets)
+
+            if end_of_file:
+                break
+            base += cut
+            buffer = buffer[cut:]
+
+        count += _write_offsets(out, offsets)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, info.st_mtime_ns, info.st_size, count, 0))
+    replace(index_file + ".tmp", index_file)
+    return count
+
+
+def _write_offsets(out, offsets):
+    ''' Writes a chunk of offsets to the index and empties it'''
+
+    count = len(offsets)
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    out.write(offsets.tobytes())
+    del offsets[:]
+    return count
+
+
+def open_index(file_path):
+    ''' Returns the cached index for a text file as an open binary file
+    and its header, rebuilding it if the text file has changed'''
+
+    index_file = index_path(file_path)
+    info = stat(file_path)
+    if path.isfile(index_file):
+        index = open(index_file, "r+b")
+        header = HEADER.unpack(index.read(HEADER.size))
+        if header[:3] == (MAGIC, info.st_mtime_ns, info.st_size):
+            return index, header
+        index.close()
+    build_index(file_path, index_file)
+    index = open(index_file, "r+b")
+    return index, HEADER.unpack(index.read(HEADER.size))
+
+
+def read_passage(text, start, words, max_chars):
+    ''' Reads up to a number of words from a byte offset of a memory
+    mapped file, returns the passage and the offset just after it'''
+
+    # Up to 4 bytes a character, plus room for runs of whitespace
+    window = text[start:start + max_chars * 4 + 4096]
+
+    # Find where the last word ends, so only that much is decoded
+    end = 0
+    for number, word in enumerate(WORD.finditer(window)):
+        if number == words:
+            break
+        end = word.end()
+
+    passage = " ".join(window[:end].decode("utf-8", "ignore").split())
+    if len(passage) > max_chars:
+        passage = passage[:max_chars]
+    return passage, start + end
+
+
+# Tested in pytest
+def load_passage(file_path, words=50, max_chars=400,
+                 sequential=False, seed=None):
+    ''' Returns a passage from a text file, starting at a random sentence
+    or the sentence after the last passage, or None if the file is empty'''
+
+    index, header = open_index(file_path)
+    with index:
+        count = header[3]
+        if count == 0:
+            return None
+
+        # Pick the sentence the passage starts at
+        if sequential:
+            sentence = header[4] % count
+        else:
+            sentence = Random(seed).randrange(count)
+        index.seek(HEADER.size + sentence * OFFSET.size)
+        start = OFFSET.unpack(index.read(OFFSET.size))[0]
+
+        with open(file_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+                passage, end = read_passage(text, start, words, max_chars)
+
+                # Remember where the next sequential passage starts
+                if sequential:
+                    while sentence < count - 1:
+                        index.seek(HEADER.size + (sentence + 1) * OFFSET.size)
+                        if OFFSET.unpack(index.read(OFFSET.size))[0] >= end:
+                            break
+                        sentence += 1
+                    index.seek(0)
+                    index.write(HEADER.pack(*header[:4], sentence + 1))
+
+    return passage
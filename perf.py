@@ -0,0 +1,115 @@
+import atexit
+import json
+from collections import deque
+
+
+class FrameProfiler:
+    ''' Times each frame the game draws: render time, how long the
+    oldest key waited to reach the screen, time spent calculating
+    statistics and addstr calls, for the HUD and an optional trace'''
+
+    def __init__(self, trace_file=None):
+        # Whether the HUD is drawn
+        self.visible = False
+
+        # Time the oldest key not yet on screen was pressed, in ns
+        self.key_time = None
+        # Time the current frame started drawing, in ns
+        self.frame_start = None
+        # Nanoseconds spent on statistics since the last frame
+        self.stats_ns = 0
+
+        # Results of the last frame, shown by the HUD
+        self.render_ns = 0
+        self.latency_ns = None
+        self.last_stats_ns = 0
+        self.calls = 0
+
+        # End times of the frames in the last second, to count FPS
+        self.frame_ends = deque()
+
+        # Frames are written to the trace as they happen, in Chrome's
+        # JSON array format which doesn't need closing if the app exits
+        self.trace = None
+        if trace_file != None:
+            self.trace = open(trace_file, "w")
+            self.trace.write("[\n")
+            atexit.register(self.close)
+
+    def toggle(self):
+        ''' Shows or hides the HUD'''
+
+        self.visible = not self.visible
+
+    def key(self, time_ns):
+        ''' Records a key press, if an earlier one isn't waiting to be drawn'''
+
+        if self.key_time == None:
+            self.key_time = time_ns
+
+    def add_stats_time(self, nanoseconds):
+        self.stats_ns += nanoseconds
+
+    def start_frame(self, time_ns):
+        self.frame_start = time_ns
+
+    def end_frame(self, time_ns, calls):
+        ''' Finishes the current frame once it has been sent to the terminal'''
+
+        self.render_ns = time_ns - self.frame_start
+        self.last_stats_ns = self.stats_ns
+        self.calls = calls
+
+        # Frames drawn for the countdown keep the last key's latency
+        latency_ns = None
+        if self.key_time != None:
+            latency_ns = time_ns - self.key_time
+            self.latency_ns = latency_ns
+
+        # Keep the frames that ended in the last second
+        self.frame_ends.append(time_ns)
+        while self.frame_ends[0] <= time_ns - 10**9:
+            self.frame_ends.popleft()
+
+        if self.trace != None:
+            self.write_trace(latency_ns)
+        self.key_time = None
+        self.stats_ns = 0
+
+    def fps(self):
+        return len(self.frame_ends)
+
+    def hud_text(self):
+        ''' Returns the HUD line for the last frame'''
+
+        latency = "-"
+        if self.latency_ns != None:
+            latency = f"{self.latency_ns / 1e6:.2f}ms"
+        return (f"FPS {self.fps()} | render {self.render_ns / 1e6:.2f}ms"
+                f" | latency {latency} | addstr {self.calls}"
+                f" | stats {self.last_stats_ns / 1e6:.2f}ms | 'F2' to hide")
+
+    def write_trace(self, latency_ns):
+        ''' Writes the last frame to the trace as a duration event,
+        with the key wait and counters, timestamps in microseconds'''
+
+        events = [{"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                   "ts": self.frame_start / 1000,
+                   "dur": self.render_ns / 1000,
+                   "args": {"addstr": self.calls,
+                            "stats_us": self.last_stats_ns / 1000}},
+                  {"name": "frame", "ph": "C", "pid": 1,
+                   "ts": self.frame_start / 1000,
+                   "args": {"fps": self.fps(), "addstr": self.calls}}]
+        if latency_ns != None:
+            events.append({"name": "key to screen", "ph": "X", "pid": 1,
+                           "tid": 2, "ts": self.key_time / 1000,
+                           "dur": latency_ns / 1000})
+        for event in events:
+            self.trace.write(json.dumps(event) + ",\n")
+        # Flushed every frame so the trace survives the app being killed
+        self.trace.flush()
+
+    def close(self):
+        if self.trace != None and not self.trace.closed:
+            self.trace.close()
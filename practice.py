@@ -0,0 +1,208 @@
+import struct
+from os import path, replace
+from random import Random
+import numpy as np
+import appdata
+import corpus
+import keystats
+
+
+# Name of the practice index file in the app data folder
+INDEX_FILE = "practice.bin"
+
+# File layout: header (magic, corpus word count, corpus total count,
+# number of postings), then for each pair of characters the offset its
+# words start at (count + 1 entries) and the word indexes (uint32
+# little-endian), each pair's words ordered most common first
+MAGIC = b"TWPRAC01"
+HEADER = struct.Struct("<8sIQI")
+
+# Pairs are numbered like the key statistics, previous * SIZE + next
+SPACE = keystats.char_index(np.array([ord(" ")]))[0]
+PAIRS = keystats.SIZE * keystats.SIZE
+
+# Number of weak pairs a practice prompt targets
+TARGETS = 10
+
+# Words for a pair are picked from its most common words only,
+# so practice prompts are made of words worth knowing
+POOL_SIZE = 200
+
+# Loaded index, kept so the file is only opened once per run
+_index = None
+
+
+def pair_code(pair):
+    ''' Returns the number of a pair of characters, 0 if it isn't tracked'''
+
+    first, second = keystats.char_index(np.array([ord(c) for c in pair]))
+    if first == 0 or second == 0:
+        return 0
+    return int(first) * keystats.SIZE + int(second)
+
+
+# Tested in pytest
+def build_index(word_corpus, file_path=None):
+    ''' Builds the index from every pair of characters to the words
+    containing it, counting the spaces either side of each word, saves
+    it and returns it loaded'''
+
+    if file_path == None:
+        file_path = appdata.data_path(INDEX_FILE)
+
+    count = len(word_corpus)
+    letters = keystats.char_index(
+        np.frombuffer(word_corpus.words, dtype=np.uint8).astype(np.int64))
+    offsets = np.frombuffer(word_corpus.offsets, dtype=np.uint32)
+    starts, ends = offsets[:-1].astype(np.int64), offsets[1:].astype(np.int64)
+    lengths = ends - starts
+    word_of = np.repeat(np.arange(count), lengths)
+
+    # Pairs inside each word, then a space before and after each word
+    inside = word_of[:-1] == word_of[1:]
+    typed = lengths > 0
+    previous = np.concatenate([letters[:-1][inside],
+                               np.full(typed.sum(), SPACE),
+                               letters[ends[typed] - 1]])
+    following = np.concatenate([letters[1:][inside],
+                                letters[starts[typed]],
+                                np.full(typed.sum(), SPACE)])
+    words = np.concatenate([word_of[:-1][inside],
+                            np.nonzero(typed)[0], np.nonzero(typed)[0]])
+
+    # Untracked characters, like accented letters, are left out
+    tracked = (previous > 0) & (following > 0)
+    pairs = previous[tracked] * keystats.SIZE + following[tracked]
+    words = words[tracked]
+
+    # Words are numbered most common first, so one sort orders the
+    # pairs and each pair's words, and leaves repeats side by side
+    frequency = np.diff(np.frombuffer(word_corpus.cumulative, dtype=np.uint64),
+                        prepend=np.uint64(0)).astype(np.int64)
+    by_rank = np.argsort(-frequency, kind="stable")
+    rank = np.empty(count, dtype=np.int64)
+    rank[by_rank] = np.arange(count)
+    keys = np.sort(pairs * count + rank[words])
+    keys = keys[np.diff(keys, prepend=-1) != 0]
+    postings = by_rank[keys % max(count, 1)]
+    starts = np.searchsorted(keys // max(count, 1), np.arange(PAIRS + 1))
+
+    total = int(word_corpus.cumulative[-1]) if count else 0
+    with open(file_path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, count, total, len(postings)))
+        f.write(starts.astype("<u4").tobytes())
+        f.write(postings.astype("<u4").tobytes())
+    replace(file_path + ".tmp", file_path)
+
+    return PracticeIndex(file_path)
+
+
+class PracticeIndex:
+    ''' Index from pairs of characters to the words containing them,
+    memory mapped so only the pairs a prompt needs are read'''
+
+    def __init__(self, file_path):
+        with open(file_path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError("Not a practice index file")
+        magic, self.count, self.total, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a practice index file")
+
+        data = np.memmap(file_path, dtype="<u4", mode="r",
+                         offset=HEADER.size, shape=(PAIRS + 1 + length,))
+        self.offsets = data[:PAIRS + 1]
+        self.postings = data[PAIRS + 1:]
+
+    def matches(self, word_corpus):
+        ''' Checks the index was built from this corpus'''
+
+        total = int(word_corpus.cumulative[-1]) if len(word_corpus) else 0
+        return self.count == len(word_corpus) and self.total == total
+
+    def words_with(self, pair):
+        ''' Returns the indexes of the words containing a pair of
+        characters, most common first'''
+
+        code = pair_code(pair)
+        if code == 0:
+            return self.postings[:0]
+        return self.postings[self.offsets[code]:self.offsets[code + 1]]
+
+
+def load_index(word_corpus):
+    ''' Returns the index for a corpus, loading it from the app data
+    folder, or building it the first time or if the corpus changed'''
+
+    global _index
+    if _index != None and _index.matches(word_corpus):
+        return _index
+    file_path = appdata.data_path(INDEX_FILE)
+    index = None
+    if path.isfile(file_path):
+        try:
+            index = PracticeIndex(file_path)
+        except (OSError, ValueError):
+            index = None
+    if index == None or not index.matches(word_corpus):
+        index = build_index(word_corpus, file_path)
+    _index = index
+    return _index
+
+
+def target_pairs(weak_pairs):
+    ''' Turns the weakest pairs into lowercase pairs and their costs,
+    as the word list is lowercase, keeping the highest cost of a pair'''
+
+    targets = {}
+    for pair, cost in weak_pairs:
+        pair = pair.lower()
+        targets[pair] = max(cost, targets.get(pair, 0))
+    return list(targets.items())
+
+
+# Tested in pytest
+def practice_words(word_corpus, index, targets, count=50, seed=None):
+    ''' Picks words containing the target pairs, each pair chosen in
+    proportion to its cost and each word from the most common words
+    containing it, weighted by how often it is used'''
+
+    cumulative = np.frombuffer(word_corpus.cumulative, dtype=np.uint64)
+    pools, pool_weights, costs = [], [], []
+    for pair, cost in targets:
+        pool = np.asarray(index.words_with(pair)[:POOL_SIZE], dtype=np.int64)
+        if len(pool) == 0:
+            continue
+        frequency = cumulative[pool].astype(np.int64)
+        frequency[pool > 0] -= cumulative[pool[pool > 0] - 1].astype(np.int64)
+        pools.append(pool.tolist())
+        pool_weights.append(np.cumsum(frequency).tolist())
+        costs.append(cost)
+    if len(pools) == 0:
+        return []
+
+    random = Random(seed)
+    words = []
+    for i in random.choices(range(len(pools)), weights=costs, k=count):
+        pick = random.choices(pools[i], cum_weights=pool_weights[i])[0]
+        words.append(word_corpus.word(pick))
+    return words
+
+
+# Tested in pytest
+def practice_prompt(count=50, seed=None, stats_path=None):
+    ''' Returns a prompt of words containing the pairs of characters
+    the user types slowest or mistypes most, or None if there is no
+    word list or not enough typing has been recorded'''
+
+    word_corpus = corpus.load_corpus()
+    if word_corpus == None or len(word_corpus) == 0:
+        return None
+    data = keystats.open_stats(stats_path, "r")
+    targets = target_pairs(keystats.weakest_bigrams(data, TARGETS))
+    words = practice_words(word_corpus, load_index(word_corpus), targets,
+                           count, seed)
+    if len(words) == 0:
+        return None
+    return " ".join(words)
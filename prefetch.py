@@ -0,0 +1,66 @@
+import threading
+from queue import Queue, Empty, Full
+
+
+class Prefetcher:
+    ''' Keeps a small queue of ready-to-use typing prompts for each
+    source, refilled by background threads so taking one never waits'''
+
+    def __init__(self, sources, size=3, retry_delay=5):
+        # sources maps a name to a function that loads one prompt,
+        # returning None or raising an error if it failed
+        self.sources = sources
+        self.retry_delay = retry_delay
+        self.queues = {name: Queue(maxsize=size) for name in sources}
+        self.stopped = threading.Event()
+
+        # One daemon thread per source, so a slow source doesn't hold up others
+        self.threads = [threading.Thread(target=self._fill, args=(name,),
+                                         name=f"prefetch-{name}", daemon=True)
+                        for name in sources]
+        for thread in self.threads:
+            thread.start()
+
+    def _fill(self, name):
+        ''' Loads prompts for a source until its queue is full, then
+        waits for space, backing off while the source is failing'''
+
+        delay = self.retry_delay
+        while not self.stopped.is_set():
+            try:
+                prompt = self.sources[name]()
+            except Exception:
+                prompt = None
+
+            # Wait before retrying a failed source, up to a minute
+            if prompt == None:
+                self.stopped.wait(delay)
+                delay = min(delay * 2, 60)
+                continue
+            delay = self.retry_delay
+
+            # Blocks while the queue is full, checking for stop now and then
+            while not self.stopped.is_set():
+                try:
+                    self.queues[name].put(prompt, timeout=0.5)
+                    break
+                except Full:
+                    pass
+
+    def get(self, name, timeout=0):
+        ''' Takes a ready prompt from a source's queue,
+        returns None if none is ready within timeout seconds'''
+
+        try:
+            if timeout == 0:
+                return self.queues[name].get_nowait()
+            return self.queues[name].get(timeout=timeout)
+        except Empty:
+            return None
+
+    def stop(self):
+        ''' Stops the background threads'''
+
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout=1)
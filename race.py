@@ -0,0 +1,457 @@
+import asyncio
+import json
+import threading
+from time import monotonic
+
+
+# Address a race server listens on by default
+DEFAULT_ADDRESS = "localhost:8765"
+
+# Seconds between progress broadcasts, progress that arrives in
+# between is merged so each player is sent at most once a tick
+TICK = 0.1
+
+# A client whose unsent data passes this many bytes misses progress
+# broadcasts until it catches up, so a slow client can't hold up the
+# others. Other messages are always sent, as the race needs them
+WRITE_LIMIT = 1 << 16
+
+
+def parse_address(address):
+    ''' Splits "host:port" into (host, port), or "unix:/path" into
+    ("unix", path) for a Unix socket'''
+
+    if address.startswith("unix:"):
+        return "unix", address[5:]
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def encode(message):
+    ''' Turns a message into a line of JSON'''
+
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def read_count(value):
+    ''' Returns value if it is a whole number of 0 or more, raises
+    ValueError if it isn't'''
+
+    # bool is a kind of int, but isn't a count
+    if type(value) != int or value < 0:
+        raise ValueError(f"Bad count {value!r}")
+    return value
+
+
+# Tested in pytest
+def read_progress(message):
+    ''' Returns (typed, wpm, done) from a progress message, raises
+    ValueError if they are missing or aren't counts and a boolean'''
+
+    typed, wpm, done = message["typed"], message["wpm"], message["done"]
+    read_count(typed)
+    read_count(wpm)
+    if type(done) != bool:
+        raise ValueError(f"Bad progress done {done!r}")
+    return typed, wpm, done
+
+
+# Tested in pytest
+def read_states(players):
+    ''' Returns the racers in a message, raises ValueError unless
+    each is a [name, typed, wpm, done] list'''
+
+    if type(players) != list:
+        raise ValueError("Racers are a list")
+    for state in players:
+        if type(state) != list or len(state) != 4 or type(state[0]) != str:
+            raise ValueError(f"Bad racer {state!r}")
+        read_progress({"typed": state[1], "wpm": state[2], "done": state[3]})
+    return players
+
+
+class Player:
+    ''' A client connected to the race server'''
+
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+        self.typed = 0
+        self.wpm = 0
+        self.done = False
+
+        # Boolean for a player that missed progress broadcasts
+        self.behind = False
+
+    def state(self):
+        return [self.name, self.typed, self.wpm, self.done]
+
+
+class RaceServer:
+    ''' Hands the same prompt to everyone waiting once enough players
+    have joined, counts them down together, then broadcasts every
+    player's progress each tick until the race is over'''
+
+    def __init__(self, prompt_source, players=2, countdown=3, duration=30,
+                 tick=TICK):
+        # Function returning the prompt for a race
+        self.prompt_source = prompt_source
+        self.players = players
+        self.countdown = countdown
+        self.duration = duration
+        self.tick = tick
+
+        # Players waiting for the next race, and players in the race
+        self.lobby = []
+        self.racers = []
+        self.race = None
+
+        # Racers whose progress changed since the last broadcast
+        self.changed = {}
+
+    async def serve(self, address):
+        ''' Starts listening on a "host:port" or "unix:/path" address'''
+
+        host, port = parse_address(address)
+        if host == "unix":
+            return await asyncio.start_unix_server(self.handle, port)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        ''' Reads a client's messages until it disconnects'''
+
+        player = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if type(message) != dict:
+                    raise ValueError("Messages are JSON objects")
+                if message["type"] == "join" and player == None:
+                    player = Player(self.unique_name(message["name"]), writer)
+                    self.lobby.append(player)
+                    self.send([player], encode({"type": "joined",
+                                                "name": player.name}))
+                    self.send_lobby()
+                    if len(self.lobby) >= self.players and self.race == None:
+                        self.race = asyncio.create_task(self.run_race())
+                elif message["type"] == "progress" and player in self.racers:
+                    player.typed, player.wpm, player.done = read_progress(
+                        message)
+                    self.changed[player.name] = player
+        except (ConnectionError, ValueError, KeyError, TypeError):
+            pass
+        finally:
+            if player in self.lobby:
+                self.lobby.remove(player)
+                self.send_lobby()
+            if player in self.racers:
+                self.racers.remove(player)
+            writer.close()
+
+    def unique_name(self, name):
+        ''' Shortens a player's name, numbering it if it is taken'''
+
+        name = str(name)[:12] or "player"
+        taken = {player.name for player in self.lobby + self.racers}
+        unique = name
+        number = 2
+        while unique in taken:
+            unique = f"{name}{number}"
+            number += 1
+        return unique
+
+    def send(self, players, data):
+        ''' Writes the same bytes to many players without waiting on any'''
+
+        for player in players:
+            if not player.writer.transport.is_closing():
+                player.writer.write(data)
+
+    def broadcast_progress(self):
+        ''' Sends every racer the players that changed since the last
+        tick. Racers over the WRITE_LIMIT are skipped, then sent every
+        player's progress in one message once they have caught up'''
+
+        if not self.changed and not any(player.behind
+                                         for player in self.racers):
+            return
+        changed = None
+        if self.changed:
+            changed = encode({"type": "progress", "players": [
+                player.state() for player in self.changed.values()]})
+            self.changed = {}
+        everyone = None
+        for player in self.racers:
+            transport = player.writer.transport
+            if transport.is_closing():
+                continue
+            if transport.get_write_buffer_size() > WRITE_LIMIT:
+                player.behind = True
+            elif player.behind:
+                if everyone == None:
+                    everyone = encode({"type": "progress", "players": [
+                        racer.state() for racer in self.racers]})
+                player.writer.write(everyone)
+                player.behind = False
+            elif changed != None:
+                player.writer.write(changed)
+
+    def send_lobby(self):
+        self.send(self.lobby, encode({"type": "lobby",
+                                      "players": len(self.lobby),
+                                      "needed": self.players}))
+
+    async def run_race(self):
+        ''' Runs a race with everyone in the lobby, or sends them away
+        if there is no prompt to race on'''
+
+        prompt = self.prompt_source()
+        if prompt == None:
+            self.send(self.lobby, encode({
+                "type": "error", "message": "the server has no prompt"}))
+            for player in self.lobby:
+                player.writer.close()
+            self.lobby = []
+            self.race = None
+            return
+
+        self.racers = self.lobby
+        self.lobby = []
+        self.changed = {}
+        self.send(self.racers, encode({
+            "type": "start", "prompt": prompt, "start_in": self.countdown,
+            "duration": self.duration,
+            "players": [player.state() for player in self.racers]}))
+
+        # Broadcast the players that changed each tick, until
+        # everyone has finished or the time is up
+        end = monotonic() + self.countdown + self.duration + 2
+        while monotonic() < end and self.racers:
+            await asyncio.sleep(self.tick)
+            self.broadcast_progress()
+            if all(player.done for player in self.racers):
+                break
+
+        self.send(self.racers, encode({"type": "results", "players": sorted(
+            (player.state() for player in self.racers),
+            key=lambda state: -state[2])}))
+        self.racers = []
+        self.race = None
+
+        # Players who joined during the race start the next one
+        if len(self.lobby) >= self.players:
+            self.race = asyncio.create_task(self.run_race())
+
+
+class RaceClient:
+    ''' Connects the game to a race server from a background thread,
+    so network waits never hold up the game loop. The game reads the
+    latest state and sends progress that is merged until the next tick'''
+
+    # Mode of play, like a replay.Playback
+    mode = "race"
+
+    def __init__(self, address, name, tick=TICK):
+        self.address = address
+        self.name = name
+        self.tick = tick
+
+        # "connecting", "lobby", "racing", "finished" or "error"
+        self.status = "connecting"
+        self.error = None
+        self.waiting = 0
+        self.needed = 0
+
+        # Race prompt, and the local time.monotonic it starts at
+        self.prompt = None
+        self.start_time = None
+        self.duration = 30
+
+        # Name -> [name, typed, wpm, done] for every racer
+        self.board = {}
+
+        # Latest progress not sent yet
+        self.progress = None
+
+        self.loop = None
+        self.task = None
+        self.wake = None
+        self.thread = threading.Thread(target=self._run_thread,
+                                       name="race-client", daemon=True)
+
+    def connect(self):
+        self.thread.start()
+
+    def _run_thread(self):
+        try:
+            asyncio.run(self._run())
+        except asyncio.CancelledError:
+            pass
+        except (OSError, ValueError) as error:
+            self.error = str(error)
+            self.status = "error"
+
+    async def _run(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.wake = asyncio.Event()
+        host, port = parse_address(self.address)
+        if host == "unix":
+            reader, writer = await asyncio.open_unix_connection(port)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode({"type": "join", "name": self.name}))
+        self.status = "lobby"
+
+        sender = asyncio.create_task(self._send(writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    self._receive(json.loads(line))
+                except (ValueError, KeyError, TypeError) as error:
+                    raise ValueError(
+                        f"Bad message from the race server ({error!r})")
+        finally:
+            sender.cancel()
+            writer.close()
+            if self.status not in ("finished", "error"):
+                self.error = "Disconnected from the race server"
+                self.status = "error"
+
+    def _receive(self, message):
+        ''' Updates the race from a server message, raises ValueError
+        if the message isn't one the client can use'''
+
+        if type(message) != dict:
+            raise ValueError("Bad message from the race server")
+        kind = message["type"]
+        if kind == "joined":
+            self.name = str(message["name"])
+        elif kind == "lobby":
+            self.waiting = read_count(message["players"])
+            self.needed = read_count(message["needed"])
+        elif kind == "start":
+            players = read_states(message["players"])
+            duration = read_count(message["duration"])
+            start_in = read_count(message["start_in"])
+            if type(message["prompt"]) != str:
+                raise ValueError("Bad race prompt")
+            self.board = {state[0]: state for state in players}
+            self.duration = duration
+            self.start_time = monotonic() + start_in
+            self.prompt = message["prompt"]
+            self.status = "racing"
+        elif kind == "progress":
+            board = dict(self.board)
+            for state in read_states(message["players"]):
+                board[state[0]] = state
+            self.board = board
+        elif kind == "results":
+            self.board = {state[0]: state
+                          for state in read_states(message["players"])}
+            self.status = "finished"
+        elif kind == "error":
+            self.error = f"The race server refused ({message['message']})"
+            self.status = "error"
+
+    async def _send(self, writer):
+        ''' Sends the latest progress at most once a tick'''
+
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            typed, wpm, done = self.progress
+            writer.write(encode({"type": "progress", "typed": typed,
+                                 "wpm": wpm, "done": done}))
+            await writer.drain()
+            await asyncio.sleep(self.tick)
+
+    def send_progress(self, typed, wpm, done=False):
+        ''' Queues the player's progress, replacing any not sent yet'''
+
+        if (typed, wpm, done) == self.progress:
+            return
+        self.progress = (typed, wpm, done)
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def close(self):
+        ''' Disconnects from the server'''
+
+        if self.task != None and self.thread.is_alive():
+            self.status = "finished"
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            self.thread.join(timeout=1)
+
+    def started(self, now):
+        return self.start_time != None and now >= self.start_time
+
+    def standings(self):
+        ''' Returns every racer's state, furthest along first'''
+
+        return sorted(self.board.values(),
+                      key=lambda state: (-state[1], state[0]))
+
+    def next_event_ms(self, now_ns):
+        ''' Returns the milliseconds until the race starts, or until
+        the next progress broadcast once it has'''
+
+        if self.start_time == None:
+            return self.tick * 1000
+        until_start = (self.start_time - now_ns / 1e9) * 1000
+        if until_start > 0:
+            return min(until_start, self.tick * 1000)
+        return self.tick * 1000
+
+
+def race_prompt(file_path=None, words=50):
+    ''' Returns a race prompt from a text file, or random words'''
+
+    if file_path != None:
+        import passages
+        return passages.load_passage(file_path, words, words * 8)
+    import corpus
+    return corpus.sample_words(words)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Typing Wizard race server")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS,
+                        help="host:port or unix:/path/to/socket to listen on")
+    parser.add_argument("--players", type=int, default=2,
+                        help="number of players a race waits for")
+    parser.add_argument("--countdown", type=int, default=3,
+                        help="seconds counted down before a race")
+    parser.add_argument("--file", default=None,
+                        help="text file to take prompts from, instead of "
+                        "random words")
+    args = parser.parse_args()
+
+    if race_prompt(args.file) == None:
+        print("No word list yet, run the app and choose random words "
+              "once, or use --file")
+        return
+
+    async def serve():
+        server = RaceServer(lambda: race_prompt(args.file),
+                            max(1, args.players), args.countdown)
+        async with await server.serve(args.address):
+            print(f"Race server listening on {args.address}")
+            await asyncio.Future()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import curses
+import widths
+
+
+class Renderer:
+    ''' Keeps track of the text runs on each screen row and only
+    redraws the part of a row that changed since the last frame'''
+
+    def __init__(self, window):
+        self.window = window
+
+        # Row number -> tuple of (x, text, colour) runs currently on screen
+        self.rows = {}
+
+        # Number of addstr calls made, for the performance HUD
+        self.calls = 0
+
+    def invalidate(self):
+        ''' Forgets what is on screen and clears it, used after
+        another screen has drawn over the window'''
+
+        self.rows = {}
+        self.window.erase()
+
+    def draw(self, y, x, text, colour=0):
+        ''' Draws a single run of text as the full contents of a row'''
+
+        self.draw_row(y, ((x, text, colour),))
+
+    def draw_row(self, y, runs):
+        ''' Replaces the contents of a row with a tuple of
+        (x, text, colour) runs, writing only what changed'''
+
+        old_runs = self.rows.get(y, ())
+        if old_runs == runs:
+            return
+        self.rows[y] = runs
+
+        # Skip the runs at the start of the row that are unchanged
+        i = 0
+        while i < min(len(old_runs), len(runs)) and old_runs[i] == runs[i]:
+            i += 1
+
+        # Within the first changed run, skip characters still on screen
+        skip = 0
+        skip_x = 0
+        if i < len(old_runs) and i < len(runs):
+            old_x, old_text, old_colour = old_runs[i]
+            x, text, colour = runs[i]
+            if old_x == x and old_colour == colour:
+                while (skip < min(len(old_text), len(text))
+                       and old_text[skip] == text[skip]):
+                    skip += 1
+                skip_x = skip
+                # Graphemes are only split where both runs have a
+                # grapheme boundary, and the skipped text is measured
+                # in screen columns
+                if skip and not (text.isascii() and old_text.isascii()):
+                    while skip and not (
+                            skip in widths.cluster_bounds(text)
+                            and skip in widths.cluster_bounds(old_text)):
+                        skip -= 1
+                    skip_x = widths.columns(text)[skip]
+
+        # Clear the rest of the row from the first changed cell
+        if i < len(old_runs):
+            clear_x = old_runs[i][0] + skip_x
+            if i < len(runs):
+                clear_x = min(clear_x, runs[i][0] + skip_x)
+            self.window.move(y, clear_x)
+            self.window.clrtoeol()
+
+        # Draw the changed runs, one call per run
+        for x, text, colour in runs[i:]:
+            if skip:
+                x, text, skip = x + skip_x, text[skip:], 0
+            if text:
+                self.calls += 1
+                try:
+                    self.window.addstr(y, x, text, colour)
+                except curses.error:
+                    # Writing to the bottom right cell moves
+                    # the cursor off screen, which curses reports
+                    pass
+
+    def take_calls(self):
+        ''' Returns the number of addstr calls since it was last called'''
+
+        calls = self.calls
+        self.calls = 0
+        return calls
+
+    def flush(self, cursor_y, cursor_x):
+        ''' Places the cursor and sends all changes to the terminal at once'''
+
+        self.window.move(cursor_y, cursor_x)
+        self.window.noutrefresh()
+        curses.doupdate()
@@ -0,0 +1,227 @@
+import json
+import struct
+from array import array
+from bisect import bisect_right
+from os import listdir, path, remove, replace
+from time import time, time_ns
+import appdata
+from stats import TypingStats, KeystrokeLog, BACKSPACE
+
+
+# Folder in the app data folder finished sessions are saved in
+SESSION_FOLDER = "sessions"
+
+# Session file layout: header (magic, length of the details) then the
+# session details as JSON and its keystroke log
+MAGIC = b"TWSESS01"
+HEADER = struct.Struct("<8sI")
+
+# Number of sessions kept, the best one is always kept as well
+MAX_SESSIONS = 100
+
+# Replay speeds that can be chosen
+SPEEDS = [0.5, 1, 2, 4]
+
+# Test length of sessions saved before the length could be chosen
+DEFAULT_TEST_MODE = ("time", 30)
+
+
+def session_folder():
+    return path.dirname(appdata.data_path(path.join(SESSION_FOLDER, "_")))
+
+
+# Tested in pytest
+def save_session(prompt, log, wpm, accuracy, consistency, hard_mode,
+                 test_mode=DEFAULT_TEST_MODE):
+    ''' Saves a finished session so it can be raced or replayed,
+    removing the oldest sessions once there are too many'''
+
+    details = json.dumps({"prompt": prompt, "wpm": wpm,
+                          "accuracy": accuracy, "consistency": consistency,
+                          "hard_mode": hard_mode,
+                          "test_mode": list(test_mode),
+                          "date": time()}).encode("utf-8")
+
+    # Named by the time, so sorting the names sorts the sessions
+    file_path = path.join(session_folder(), f"{time_ns()}.tws")
+    with open(file_path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(details)))
+        f.write(details)
+        f.write(log.to_bytes())
+    replace(file_path + ".tmp", file_path)
+
+    sessions = list_sessions()
+    if len(sessions) > MAX_SESSIONS:
+        best = best_session(sessions)
+        for old_path, _ in sessions[MAX_SESSIONS:]:
+            if best == None or old_path != best[0]:
+                remove(old_path)
+    return file_path
+
+
+def read_details(file_path):
+    ''' Reads the details of a saved session, returns None if
+    it isn't a session file'''
+
+    with open(file_path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            return None
+        return json.loads(f.read(length).decode("utf-8"))
+
+
+# Tested in pytest
+def list_sessions():
+    ''' Returns the saved sessions as (file path, details), newest first'''
+
+    folder = session_folder()
+    sessions = []
+    for name in sorted(listdir(folder), reverse=True):
+        if not name.endswith(".tws"):
+            continue
+        file_path = path.join(folder, name)
+        try:
+            details = read_details(file_path)
+        except (OSError, ValueError):
+            continue
+        if details != None:
+            sessions.append((file_path, details))
+    return sessions
+
+
+def best_session(sessions):
+    ''' Returns the (file path, details) of the fastest session, or None'''
+
+    if len(sessions) == 0:
+        return None
+    return max(sessions, key=lambda session: (session[1]["wpm"],
+                                              session[1]["accuracy"]))
+
+
+# Tested in pytest
+def load_session(file_path):
+    ''' Returns the details and keystroke log of a saved session'''
+
+    with open(file_path, "rb") as f:
+        data = f.read()
+    magic, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a session file")
+    details = json.loads(data[HEADER.size:HEADER.size + length])
+    return details, KeystrokeLog.from_bytes(data[HEADER.size + length:])
+
+
+def session_test_mode(details):
+    ''' Returns the test length a saved session was played with'''
+
+    return tuple(details.get("test_mode", DEFAULT_TEST_MODE))
+
+
+class Playback:
+    ''' Plays a keystroke log back against the clock, as a ghost to race
+    or a replay at a chosen speed, finding where it is up to by bisecting
+    its timestamps so a frame never scans the whole log'''
+
+    def __init__(self, prompt, log, mode="replay", speed=1,
+                 test_mode=DEFAULT_TEST_MODE):
+        self.prompt = prompt
+        self.log = log
+        # "ghost" to race the session, "replay" to watch it
+        self.mode = mode
+        self.speed = speed
+        # Test length the session was played with
+        self.test_mode = test_mode
+
+        # Nanoseconds from the first keystroke to each keystroke
+        self.first = log.times[0] if len(log) else 0
+        self.times = array('q', [key_time - self.first
+                                 for key_time in log.times])
+
+        # Length of the typed text after each keystroke
+        self.lengths = array('i', [
+            position + (correct != BACKSPACE)
+            for position, correct in zip(log.positions, log.correct)])
+
+        # Clock time the playback started, and the log time it started from
+        self.clock_start = None
+        self.log_start = 0
+
+        # Keystrokes played so far, the text and stats they add up to
+        self.index = 0
+        self.typed = []
+        self.stats = TypingStats(prompt)
+
+    def start(self, now_ns):
+        self.clock_start = now_ns
+        self.log_start = 0
+
+    def started(self):
+        return self.clock_start != None
+
+    def log_time(self, now_ns):
+        ''' Returns how far through the log the playback is, in ns'''
+
+        if self.clock_start == None:
+            return 0
+        return self.log_start + int((now_ns - self.clock_start) * self.speed)
+
+    def set_speed(self, speed, now_ns):
+        ''' Changes the speed, carrying on from the current point'''
+
+        if self.clock_start != None:
+            self.log_start = self.log_time(now_ns)
+            self.clock_start = now_ns
+        self.speed = speed
+
+    def position_at(self, log_ns):
+        ''' Returns the length of the typed text at a point in the log'''
+
+        played = bisect_right(self.times, log_ns)
+        if played == 0:
+            return 0
+        return self.lengths[played - 1]
+
+    def seek(self, log_ns):
+        ''' Plays the keystrokes up to a point in the log, only applying
+        the ones since the last seek unless it goes backwards'''
+
+        played = bisect_right(self.times, log_ns)
+        if played < self.index:
+            self.index = 0
+            self.typed = []
+            self.stats = TypingStats(self.prompt)
+        for i in range(self.index, played):
+            if self.log.correct[i] == BACKSPACE:
+                self.stats.backspace(self.log.times[i])
+                del self.typed[-1:]
+            else:
+                self.stats.add_char(chr(self.log.keys[i]), self.log.times[i])
+                self.typed.append(chr(self.log.keys[i]))
+        self.index = played
+
+    def typed_text(self):
+        return "".join(self.typed)
+
+    def finished(self):
+        return self.index >= len(self.times)
+
+    def wpm(self, log_ns):
+        ''' Returns the (gross, net, accuracy) of the played keystrokes
+        at a point in the log'''
+
+        # After the last keystroke the session is over, so the speed stays
+        if len(self.times):
+            log_ns = min(log_ns, self.times[-1])
+        return self.stats.wpm_at(self.first + log_ns)
+
+    def next_event_ms(self, now_ns):
+        ''' Returns the milliseconds until the next keystroke is due,
+        or None if the playback is over or hasn't started'''
+
+        if self.clock_start == None or self.finished():
+            return None
+        wait_ns = (self.times[self.index] - self.log_time(now_ns)) / self.speed
+        return max(0, wait_ns / 1e6)
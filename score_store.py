@@ -0,0 +1,374 @@
+import sqlite3
+from os import path
+import appdata
+
+
+# Name of the score database in the app data folder
+SCORES_FILE = "scores.db"
+
+# Old plain text scores file, imported into the database once
+LEGACY_SCORES_FILE = "scores.txt"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    wpm INTEGER NOT NULL,
+    difficulty TEXT NOT NULL,
+    consistency REAL NOT NULL,
+    accuracy REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_by_wpm
+    ON scores (wpm, difficulty, consistency, accuracy);
+CREATE INDEX IF NOT EXISTS scores_by_consistency ON scores (consistency);
+CREATE INDEX IF NOT EXISTS scores_by_accuracy ON scores (accuracy);
+CREATE INDEX IF NOT EXISTS difficulty_by_wpm
+    ON scores (difficulty, wpm, consistency, accuracy);
+CREATE INDEX IF NOT EXISTS difficulty_by_consistency
+    ON scores (difficulty, consistency);
+CREATE INDEX IF NOT EXISTS difficulty_by_accuracy
+    ON scores (difficulty, accuracy);
+CREATE INDEX IF NOT EXISTS difficulty_by_username
+    ON scores (difficulty, username);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS score_counts (
+    difficulty TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS count_added AFTER INSERT ON scores BEGIN
+    INSERT INTO score_counts VALUES (NEW.difficulty, 1)
+        ON CONFLICT (difficulty) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS count_removed AFTER DELETE ON scores BEGIN
+    UPDATE score_counts SET count = count - 1
+        WHERE difficulty = OLD.difficulty;
+END;
+"""
+
+# Columns the leaderboard can be sorted by, with the columns that break
+# ties, so by wpm hard mode comes ahead of easy mode. Numbers sort highest first, names A to Z, and the row id breaks
+# any tie left so every score has one place. Pages are found by
+# comparing these columns with the row they start after, which the
+# indexes above answer without counting through the rows before
+SORTS = {"wpm": ["wpm", "difficulty", "consistency", "accuracy"],
+         "consistency": ["consistency"],
+         "accuracy": ["accuracy"],
+         "username": ["username"]}
+
+# The number of scores for each difficulty is kept in score_counts by
+# triggers, so counting them doesn't read every score
+
+# Columns of a leaderboard row
+ROW_COLUMNS = "username, wpm, difficulty, consistency, accuracy, id"
+
+# Score store for the app data folder, opened by get_store
+_store = None
+
+
+def sort_key(row, sort):
+    ''' Returns the values a leaderboard row is ordered by in a sort'''
+
+    names = ROW_COLUMNS.split(", ")
+    return tuple(row[names.index(column)] for column in SORTS[sort] + ["id"])
+
+
+def parse_score(line):
+    ''' Reads a line of scores.txt into (username, wpm, difficulty,
+    consistency, accuracy), returns None if the line isn't a score'''
+
+    if ": " not in line:
+        return None
+    username, results = line.rsplit(": ", 1)
+    results = results.split(", ")
+    if len(results) != 4:
+        return None
+
+    # Older files list the results in different orders, so match by suffix
+    score = {}
+    try:
+        for result in results:
+            if result.endswith("% consistency"):
+                score["consistency"] = float(result[:-13])
+            elif result.endswith("% accuracy"):
+                score["accuracy"] = float(result[:-10])
+            elif result.endswith("wpm"):
+                score["wpm"] = int(result[:-3])
+            elif result.endswith("mode"):
+                score["difficulty"] = result
+    except ValueError:
+        return None
+    if len(score) != 4:
+        return None
+    return (username, score["wpm"], score["difficulty"],
+            score["consistency"], score["accuracy"])
+
+
+class ScoreStore:
+    ''' High scores kept in SQLite, indexed by username and by rank
+    so saving a score and reading the leaderboard don't scan the table'''
+
+    def __init__(self, file_path):
+        # Wait for other processes' writes rather than failing
+        self.connection = sqlite3.connect(file_path, timeout=10)
+        # Write-ahead logging lets readers carry on while another writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, username, wpm, accuracy, difficulty, consistency):
+        ''' Saves a score, returns False if the username is already used'''
+
+        if username == "":
+            return False
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT INTO scores (username, wpm, difficulty, "
+                    "consistency, accuracy) VALUES (?, ?, ?, ?, ?)",
+                    (username, wpm, difficulty, consistency, accuracy))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def count(self, difficulty=None):
+        ''' Returns the number of saved scores, for one difficulty
+        if it is given'''
+
+        if difficulty == None:
+            return self.connection.execute(
+                "SELECT IFNULL(SUM(count), 0) FROM score_counts").fetchone()[0]
+        row = self.connection.execute(
+            "SELECT count FROM score_counts WHERE difficulty = ?",
+            (difficulty,)).fetchone()
+        return 0 if row == None else row[0]
+
+    def _leaderboard_query(self, sort, reverse, difficulty, start=None,
+                           after=None, before=None):
+        ''' Returns the WHERE and ORDER BY clauses and arguments for
+        rows in the order of a sort, see page'''
+
+        columns = SORTS[sort] + ["id"]
+        descending = (sort != "username") != reverse
+        if before != None:
+            descending = not descending
+
+        conditions, args = [], []
+        if difficulty != None:
+            conditions.append("difficulty = ?")
+            args.append(difficulty)
+        for key, operator in [(start, "<="), (after, "<"), (before, "<")]:
+            if key != None:
+                if not descending:
+                    operator = operator.replace("<", ">")
+                conditions.append(f"({', '.join(columns)}) {operator} "
+                                  f"({', '.join('?' * len(columns))})")
+                args.extend(key)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        direction = " DESC" if descending else ""
+        order = ", ".join(column + direction for column in columns)
+        return where, order, args
+
+    def page(self, limit, sort="wpm", reverse=False, difficulty=None,
+             start=None, after=None, before=None):
+        ''' Returns up to limit leaderboard rows as (username, wpm,
+        difficulty, consistency, accuracy, id), in the order of a sort,
+        for one difficulty if it is given. Rows can start at the row
+        with sort key start, after the row with key after, or be the
+        rows just before the row with key before, otherwise they are
+        from the top of the leaderboard'''
+
+        where, order, args = self._leaderboard_query(
+            sort, reverse, difficulty, start, after, before)
+        rows = self.connection.execute(
+            f"SELECT {ROW_COLUMNS} FROM scores {where}ORDER BY {order} "
+            "LIMIT ?", args + [limit]).fetchall()
+        # Rows before a row are found going backwards
+        if before != None:
+            rows.reverse()
+        return rows
+
+    def rank(self, row, sort="wpm", reverse=False, difficulty=None):
+        ''' Returns the number of rows ahead of a row in a sort. SQLite
+        can't look up a row's position, so this counts the rows ahead
+        through the sort's index, which takes longer the further down
+        the row is. It is only used to jump to a row, pages don't need it'''
+
+        where, _, args = self._leaderboard_query(
+            sort, reverse, difficulty, before=sort_key(row, sort))
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM scores {where}", args).fetchone()[0]
+
+    def find(self, username):
+        ''' Returns the leaderboard row of a username, or None'''
+
+        return self.connection.execute(
+            f"SELECT {ROW_COLUMNS} FROM scores WHERE username = ?",
+            (username,)).fetchone()
+
+    def remember_username(self, username):
+        ''' Keeps the username the last score was saved with'''
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO settings VALUES "
+                "('last_username', ?)", (username,))
+
+    def last_username(self):
+        ''' Returns the username the last score was saved with, or None'''
+
+        row = self.connection.execute(
+            "SELECT value FROM settings WHERE name = 'last_username'"
+        ).fetchone()
+        return None if row == None else row[0]
+
+    def import_scores_file(self, file_path):
+        ''' Copies the scores from a scores.txt file into the store,
+        skipping lines that aren't scores and usernames already used,
+        returns the number of scores imported'''
+
+        with open(file_path, "r") as f:
+            scores = [parse_score(line) for line in f.read().splitlines()]
+        with self.connection:
+            cursor = self.connection.executemany(
+                "INSERT OR IGNORE INTO scores (username, wpm, difficulty, "
+                "consistency, accuracy) VALUES (?, ?, ?, ?, ?)",
+                [score for score in scores if score != None])
+        return cursor.rowcount
+
+    def import_legacy_scores(self, file_path=LEGACY_SCORES_FILE):
+        ''' Imports an old scores.txt file if there is one, returns
+        the number of scores imported. Scores already in the store are
+        skipped, so importing the same file again adds nothing'''
+
+        if not path.isfile(file_path):
+            return 0
+        return self.import_scores_file(file_path)
+
+
+class LeaderboardView:
+    ''' The leaderboard rows that fit on screen, fetched a page at a
+    time so scrolling costs the same however many scores there are.
+    The rank of the first row is kept up to date as it scrolls'''
+
+    # Difficulties the view can be filtered to, in the order they cycle
+    DIFFICULTIES = [None, "Hard mode", "Easy mode"]
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = max(1, rows)
+        self.sort = "wpm"
+        self.reverse = False
+        self.difficulty = None
+
+        # Sort key of the first row shown, None for the top
+        self.first = None
+        # Number of rows ahead of the first row shown
+        self.first_rank = 0
+        self.fetch()
+
+    def fetch(self):
+        ''' Loads the rows on screen, and one more to see if there are
+        rows below them'''
+
+        found = self.store.page(self.rows + 1, self.sort, self.reverse,
+                                self.difficulty, start=self.first)
+        self.visible = found[:self.rows]
+        self.more = len(found) > self.rows
+
+    def resize(self, rows):
+        self.rows = max(1, rows)
+        self.fetch()
+
+    def scroll(self, lines):
+        ''' Moves the view down, or up if lines is negative, stopping
+        at the top and once the last row is on screen'''
+
+        if lines < 0:
+            if self.first == None:
+                return
+            ahead = self.store.page(-lines, self.sort, self.reverse,
+                                    self.difficulty, before=self.first)
+            if len(ahead) > 0:
+                self.first = sort_key(ahead[0], self.sort)
+                self.first_rank -= len(ahead)
+            self.fetch()
+        elif lines > 0 and self.more:
+            found = self.store.page(self.rows + lines + 1, self.sort,
+                                    self.reverse, self.difficulty,
+                                    start=self.first)
+            shift = min(lines, len(found) - self.rows)
+            self.first = sort_key(found[shift], self.sort)
+            self.first_rank += shift
+            self.visible = found[shift:shift + self.rows]
+            self.more = len(found) > shift + self.rows
+
+    def home(self):
+        self.first = None
+        self.first_rank = 0
+        self.fetch()
+
+    def end(self):
+        ''' Moves the view to the bottom of the leaderboard'''
+
+        # The last rows are the first rows of the reversed order
+        found = self.store.page(self.rows, self.sort, not self.reverse,
+                                self.difficulty)
+        if len(found) == 0:
+            self.home()
+            return
+        self.first = sort_key(found[-1], self.sort)
+        self.first_rank = self.store.count(self.difficulty) - len(found)
+        self.fetch()
+
+    def set_sort(self, sort):
+        ''' Sorts by a column, choosing it again reverses the order'''
+
+        if sort == self.sort:
+            self.reverse = not self.reverse
+        else:
+            self.sort = sort
+            self.reverse = False
+        self.home()
+
+    def next_difficulty(self):
+        ''' Cycles between all scores, hard mode and easy mode'''
+
+        i = self.DIFFICULTIES.index(self.difficulty)
+        self.difficulty = self.DIFFICULTIES[(i + 1) % len(self.DIFFICULTIES)]
+        self.home()
+
+    def jump_to(self, username):
+        ''' Moves the view so a user's score is in the middle, returns
+        False if they have no score in the view'''
+
+        row = self.store.find(username)
+        if row == None or self.difficulty not in (None, row[2]):
+            return False
+        key = sort_key(row, self.sort)
+        ahead = self.store.page(self.rows // 2, self.sort, self.reverse,
+                                self.difficulty, before=key)
+        self.first = sort_key(ahead[0], self.sort) if ahead else key
+        self.first_rank = (self.store.rank(row, self.sort, self.reverse,
+                                           self.difficulty) - len(ahead))
+        self.fetch()
+        return True
+
+
+def get_store():
+    ''' Returns the score store in the app data folder, opening it the
+    first time. An old scores.txt file is only imported when the
+    database is created, not every time the app starts'''
+
+    global _store
+    if _store == None:
+        file_path = appdata.data_path(SCORES_FILE)
+        created = not path.isfile(file_path)
+        _store = ScoreStore(file_path)
+        if created:
+            _store.import_legacy_scores()
+    return _store
@@ -0,0 +1,122 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+# Sessions scored by each worker process at a time
+CHUNK_SIZE = 20000
+
+
+def text_buffer(texts):
+    ''' Joins texts into one array with an element per character, bytes
+    if every text is ASCII, otherwise UTF-32 code points, and returns
+    it with the offset each text starts at (plus the end)'''
+
+    joined = "".join(texts)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    if joined.isascii():
+        return np.frombuffer(joined.encode("ascii"), dtype=np.uint8), offsets
+    return (np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32),
+            offsets)
+
+
+def count_errors(prompts, typed):
+    ''' Counts the typed characters that don't match their prompt
+    for every session, comparing whole buffers at once'''
+
+    for prompt, text in zip(prompts, typed):
+        if len(text) > len(prompt):
+            raise ValueError("Typed text is longer than its prompt")
+
+    # Only the part of each prompt that was typed is compared
+    typed_buffer, offsets = text_buffer(typed)
+    prompt_buffer = text_buffer(
+        [prompt[:len(text)] for prompt, text in zip(prompts, typed)])[0]
+    if typed_buffer.dtype != prompt_buffer.dtype:
+        typed_buffer = typed_buffer.astype(np.uint32)
+        prompt_buffer = prompt_buffer.astype(np.uint32)
+
+    # Running total of mistakes, so each session's count is a subtraction
+    mistakes = np.zeros(len(typed_buffer) + 1, dtype=np.int64)
+    np.cumsum(typed_buffer != prompt_buffer, out=mistakes[1:])
+    return mistakes[offsets[1:]] - mistakes[offsets[:-1]], np.diff(offsets)
+
+
+def batch_consistency(samples):
+    ''' Calculates the consistency of every session's wpm samples,
+    matches helpers.measure_consistency for each'''
+
+    counts = np.array([len(values) for values in samples], dtype=np.int64)
+    values = np.concatenate(
+        [np.asarray(values, dtype=np.float64) for values in samples]
+        + [np.zeros(0)])
+    consistency = np.zeros(len(samples))
+
+    # reduceat needs every segment to have at least one sample
+    has_samples = counts > 0
+    if not has_samples.any():
+        return consistency
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_samples]
+    counts = counts[has_samples]
+
+    # Population standard deviation of each session, the same as numpy's std
+    means = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(means, counts)
+    variances = np.add.reduceat(deviations * deviations, starts) / counts
+
+    # Map the coefficient of variation onto a scale from 0 to 100,
+    # a mean of 0 or a negative result gives 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = 100 - np.sqrt(variances) / means * 100
+    result[(means == 0) | ~(result > 0)] = 0
+    consistency[has_samples] = result
+    return consistency
+
+
+def score_batch(sessions):
+    ''' Scores a list of (prompt, typed, seconds, wpm samples) sessions,
+    returns arrays of gross wpm, net wpm, accuracy and consistency'''
+
+    prompts, typed, seconds, samples = zip(*sessions)
+    errors, lengths = count_errors(prompts, typed)
+    seconds = np.asarray(seconds, dtype=np.float64)
+
+    # Same formulas, in the same order, as helpers.calculate_wpm
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gross = np.trunc((lengths / 5) / (seconds / 60))
+        net = np.trunc(((lengths / 5) - errors) / (seconds / 60))
+        accuracy = ((lengths - errors) / lengths) * 100
+    typed_any = lengths > 0
+    gross = np.where(typed_any, gross, 0).astype(np.int64)
+    net = np.where(typed_any, np.maximum(net, 0), 0).astype(np.int64)
+
+    # Python's round is used, numpy rounds some halves differently
+    accuracy = np.array([round(value, 1) if any_typed else 0
+                         for value, any_typed
+                         in zip(accuracy.tolist(), typed_any.tolist())])
+    consistency = np.array(
+        [round(value, 2) for value in batch_consistency(samples).tolist()])
+    return {"gross_wpm": gross, "net_wpm": net,
+            "accuracy": accuracy, "consistency": consistency}
+
+
+# Tested in pytest
+def score_sessions(sessions, workers=1, chunk_size=CHUNK_SIZE):
+    ''' Scores many recorded sessions, each a (prompt, typed text,
+    seconds, wpm samples) tuple, spreading large batches over worker
+    processes, returns a dict of arrays in the order of the sessions'''
+
+    sessions = list(sessions)
+    if len(sessions) == 0:
+        return {"gross_wpm": np.zeros(0, dtype=np.int64),
+                "net_wpm": np.zeros(0, dtype=np.int64),
+                "accuracy": np.zeros(0), "consistency": np.zeros(0)}
+    if workers <= 1 or len(sessions) <= chunk_size:
+        return score_batch(sessions)
+
+    chunks = [sessions[i:i + chunk_size]
+              for i in range(0, len(sessions), chunk_size)]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(score_batch, chunks))
+    return {name: np.concatenate([result[name] for result in results])
+            for name in results[0]}
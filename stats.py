@@ -0,0 +1,279 @@
+import struct
+import sys
+from array import array
+from math import sqrt
+from time import monotonic_ns
+
+
+# Serialised log layout: header (magic, number of keystrokes) then the
+# timestamp, key code, position and correct columns, little-endian
+LOG_MAGIC = b"TWKEYS01"
+LOG_HEADER = struct.Struct("<8sI")
+
+# Value of the correct column for a backspace
+BACKSPACE = -1
+
+
+class KeystrokeLog:
+    ''' Every keystroke of a session in array-backed columns: a
+    time.monotonic_ns timestamp, the key code, the prompt position
+    it typed or deleted, and whether it was correct (BACKSPACE for
+    a deleted character)'''
+
+    def __init__(self):
+        self.times = array('q')
+        self.keys = array('i')
+        self.positions = array('i')
+        self.correct = array('b')
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, time_ns, key, position, correct):
+        ''' Appends a keystroke to the log'''
+
+        self.times.append(time_ns)
+        self.keys.append(key)
+        self.positions.append(position)
+        self.correct.append(correct)
+
+    def columns(self):
+        return (self.times, self.keys, self.positions, self.correct)
+
+    def to_bytes(self):
+        ''' Serialises the log so the session can be analysed later'''
+
+        data = [LOG_HEADER.pack(LOG_MAGIC, len(self))]
+        for column in self.columns():
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            data.append(column.tobytes())
+        return b"".join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        ''' Loads a log serialised by to_bytes'''
+
+        magic, count = LOG_HEADER.unpack_from(data)
+        if magic != LOG_MAGIC:
+            raise ValueError("Not a keystroke log")
+        log = cls()
+        start = LOG_HEADER.size
+        for column in log.columns():
+            end = start + column.itemsize * count
+            column.frombytes(data[start:end])
+            if sys.byteorder == "big":
+                column.byteswap()
+            start = end
+        return log
+
+
+class TypingStats:
+    ''' Running typing statistics for one prompt, derived from its
+    keystroke log one keystroke at a time so no work is repeated
+    over text that is already typed'''
+
+    def __init__(self, prompt):
+        # Full prompt string the user is typing
+        self.prompt = prompt
+
+        # Every keystroke, with its timestamp
+        self.log = KeystrokeLog()
+
+        # Time the test started, None if it starts at the first keystroke
+        self.start_ns = None
+
+        # Number of characters typed and how many of them are wrong
+        self.typed = 0
+        self.errors = 0
+
+        # 1 for each typed position that doesn't match the prompt,
+        # so a backspace knows whether it removed an error
+        self.mistakes = bytearray(len(prompt))
+
+        # Number of net wpm samples used for consistency, with their
+        # running mean and sum of squared differences (Welford's
+        # algorithm), so long sessions don't keep every sample
+        self.sample_count = 0
+        self.mean = 0.0
+        self.squared_diffs = 0.0
+
+    @classmethod
+    def from_log(cls, prompt, log):
+        ''' Rebuilds the statistics of a session from its keystroke log'''
+
+        stats = cls(prompt)
+        for time_ns, key, position, correct in zip(*log.columns()):
+            if correct == BACKSPACE:
+                stats.backspace(time_ns)
+            else:
+                stats.add_char(chr(key), time_ns)
+        return stats
+
+    def extend(self, text):
+        ''' Adds text to the end of the prompt, as an endless
+        prompt grows'''
+
+        self.prompt += text
+        self.mistakes.extend(bytes(len(text)))
+
+    def add_char(self, char, time_ns=None):
+        ''' Records a typed character and samples the wpm at that
+        moment, returns False if the prompt is full'''
+
+        if self.typed >= len(self.prompt):
+            return False
+        if time_ns == None:
+            time_ns = monotonic_ns()
+
+        # Compare the new character against the prompt
+        wrong = char != self.prompt[self.typed]
+        self.log.add(time_ns, ord(char), self.typed, not wrong)
+        self.mistakes[self.typed] = wrong
+        self.errors += wrong
+        self.typed += 1
+
+        # Store wpm value each time user types a char
+        # so consistency value can be computed
+        self.add_sample(self.wpm_at(time_ns)[1])
+        return True
+
+    def backspace(self, time_ns=None):
+        ''' Removes the last typed character, returns False if none typed'''
+
+        if self.typed == 0:
+            return False
+        if time_ns == None:
+            time_ns = monotonic_ns()
+
+        # Remove the character and any error it caused
+        self.typed -= 1
+        self.log.add(time_ns, 127, self.typed, BACKSPACE)
+        self.errors -= self.mistakes[self.typed]
+        self.mistakes[self.typed] = 0
+        return True
+
+    def started(self):
+        ''' Checks if any key has been pressed'''
+
+        return len(self.log) > 0
+
+    def begin(self, time_ns):
+        ''' Starts the test at a set time, like the start of a race,
+        rather than at the first keystroke'''
+
+        self.start_ns = time_ns
+
+    def start_time(self):
+        ''' Returns the time the test started, None if it hasn't'''
+
+        if self.start_ns != None:
+            return self.start_ns
+        if len(self.log) == 0:
+            return None
+        return self.log.times[0]
+
+    def elapsed(self, time_ns):
+        ''' Seconds from the start of the test to time_ns'''
+
+        if self.start_time() == None:
+            return 0.0
+        return (time_ns - self.start_time()) / 1e9
+
+    def last_key_time(self):
+        ''' Timestamp of the latest keystroke'''
+
+        return self.log.times[-1]
+
+    def finished(self):
+        ''' Checks if the full prompt has been typed'''
+
+        return self.typed == len(self.prompt)
+
+    def wpm(self, time_in_seconds):
+        ''' Calculates (gross wpm, net wpm, accuracy),
+        matches helpers.calculate_wpm for the same input'''
+
+        if self.typed == 0:
+            return (0, 0, 0)
+
+        # Gross WPM is how fast you are typing with no error penalties
+        gross_wpm = int((self.typed/5)/(time_in_seconds/60))
+
+        # Net WPM uses the Gross WPM and adds an error penalty
+        net_wpm = int(((self.typed/5) - self.errors)/(time_in_seconds/60))
+        if net_wpm < 0:
+            net_wpm = 0
+
+        # Accuracy is the percentage of correctly typed characters
+        accuracy = round(((self.typed - self.errors)/self.typed) * 100, 1)
+
+        return (gross_wpm, net_wpm, accuracy)
+
+    def wpm_at(self, time_ns):
+        ''' Calculates (gross wpm, net wpm, accuracy) at a moment in the
+        session, to the nanosecond, the first second counts as a whole
+        second so the first keys don't give huge speeds'''
+
+        return self.wpm(max(self.elapsed(time_ns), 1.0))
+
+    def wpm_series(self, end_ns):
+        ''' Returns the net wpm at the end of each second of the session
+        up to end_ns, replaying its keystroke log once'''
+
+        start = self.start_time()
+        if start == None:
+            return []
+        seconds = max(self.elapsed(end_ns), 1.0)
+
+        series = []
+        # 1 for each typed character that is wrong, so a backspace
+        # knows whether it removed an error
+        wrong = bytearray()
+        errors = 0
+        times, _, _, correct = self.log.columns()
+        i = 0
+        second = 1
+        while second < seconds + 1:
+            # The last sample is at the end of the session
+            elapsed = min(second, seconds)
+            limit = start + int(elapsed * 1e9)
+            while i < len(times) and times[i] <= limit:
+                if correct[i] == BACKSPACE:
+                    if wrong:
+                        errors -= wrong.pop()
+                else:
+                    wrong.append(correct[i] == 0)
+                    errors += correct[i] == 0
+                i += 1
+            series.append(max(0, int(((len(wrong)/5) - errors)/(elapsed/60))))
+            second += 1
+        return series
+
+    def add_sample(self, wpm):
+        ''' Stores a wpm sample and updates the running mean and variance'''
+
+        self.sample_count += 1
+        delta = wpm - self.mean
+        self.mean += delta / self.sample_count
+        self.squared_diffs += delta * (wpm - self.mean)
+
+    def consistency(self):
+        ''' Calculates typing consistency from 0 - 100%,
+        matches helpers.measure_consistency for the same samples'''
+
+        # No samples or a mean of 0 would divide by zero
+        if self.sample_count == 0 or self.mean == 0:
+            return round(0, 2)
+
+        # Population standard deviation, the same as numpy's std
+        standard_deviation = sqrt(self.squared_diffs / self.sample_count)
+
+        # Map the coefficient of variation onto a scale from 0 to 100
+        consistency = 100 - (standard_deviation / self.mean * 100)
+
+        if consistency < 0:
+            return round(0, 2)
+
+        return round(consistency, 2)
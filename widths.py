@@ -0,0 +1,262 @@
+import struct
+import threading
+import unicodedata
+import zlib
+from bisect import bisect_right
+from functools import lru_cache
+from os import path, replace
+from textwrap import TextWrapper, wrap as wrap_ascii
+import appdata
+
+
+# Name of the display width table file in the app data folder
+TABLE_FILE = "widths.bin"
+
+# File layout: header (magic, Unicode version the table was built
+# from), then the zlib compressed table, one byte per code point
+MAGIC = b"TWWIDTH1"
+HEADER = struct.Struct("<8s16s")
+VERSION = unicodedata.unidata_version.encode("ascii")
+
+# Each table byte is the number of columns a code point takes on
+# screen, plus EXTEND if it joins the character before it into one
+# grapheme, like an accent or an emoji skin tone
+WIDTH = 3
+EXTEND = 4
+
+# Joins the characters either side of it into one emoji
+ZWJ = 0x200D
+
+# Pairs of regional indicators are drawn as one flag
+REGIONAL = range(0x1F1E6, 0x1F200)
+
+# Whitespace textwrap turns into spaces
+WHITESPACE = {ord(char): " " for char in "\t\n\x0b\x0c\r"}
+
+# Loaded table, kept so it is only read once per run
+_table = None
+
+# Held while the table is loaded, so a lookup waits for a load already
+# running in the background rather than building the table again
+_table_lock = threading.Lock()
+
+
+def build_table():
+    ''' Works out the width of every code point from unicodedata,
+    which is too slow to call for each character as it is drawn'''
+
+    table = bytearray(0x110000)
+    for code in range(0x110000):
+        char = chr(code)
+        category = unicodedata.category(char)
+        if category in ("Mn", "Me", "Cc", "Cs") or (category == "Cf"
+                                                    and code != 0xAD):
+            width = 0
+        elif 0x1160 <= code <= 0x11FF or 0xD7B0 <= code <= 0xD7FF:
+            # Hangul vowels and final consonants join the syllable before
+            width = 0
+        elif unicodedata.east_asian_width(char) in ("W", "F"):
+            width = 2
+        else:
+            width = 1
+        if (category in ("Mn", "Me", "Mc") or code in (0x200C, ZWJ)
+                or 0x1F3FB <= code <= 0x1F3FF or 0xE0020 <= code <= 0xE007F
+                or 0x1160 <= code <= 0x11FF or 0xD7B0 <= code <= 0xD7FF):
+            width |= EXTEND
+        table[code] = width
+    return bytes(table)
+
+
+def load_table(file_path=None):
+    ''' Returns the width table, loading it from the app data folder,
+    or building it the first time or after a Python upgrade changes
+    the Unicode version'''
+
+    global _table
+    if _table != None and file_path == None:
+        return _table
+    with _table_lock:
+        if _table != None and file_path == None:
+            return _table
+        if file_path == None:
+            file_path = appdata.data_path(TABLE_FILE)
+
+        table = None
+        if path.isfile(file_path):
+            try:
+                with open(file_path, "rb") as f:
+                    magic, version = HEADER.unpack(f.read(HEADER.size))
+                    if magic == MAGIC and version.rstrip(b"\0") == VERSION:
+                        table = zlib.decompress(f.read())
+            except (OSError, struct.error, zlib.error):
+                table = None
+        if table == None or len(table) != 0x110000:
+            table = build_table()
+            with open(file_path + ".tmp", "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+                f.write(zlib.compress(table, 9))
+            replace(file_path + ".tmp", file_path)
+        _table = table
+        return _table
+
+
+def preload():
+    ''' Loads the width table on a background thread, so the first
+    build is done while the menu is showing rather than when the first
+    non-ASCII prompt is drawn, returns the thread'''
+
+    thread = threading.Thread(target=load_table, name="widths", daemon=True)
+    thread.start()
+    return thread
+
+
+# Tested in pytest
+def normalize(text):
+    ''' Composes accents with the letters they sit on, so text typed
+    on a keyboard matches however the prompt was written'''
+
+    if text.isascii():
+        return text
+    return unicodedata.normalize("NFC", text)
+
+
+# Tested in pytest
+def compose(previous, char):
+    ''' Returns the one character an accent typed on its own makes
+    with the character before it, or None if they don't combine'''
+
+    if not previous or char.isascii() or not load_table()[ord(char)] & EXTEND:
+        return None
+    composed = unicodedata.normalize("NFC", previous + char)
+    if len(composed) == 1:
+        return composed
+    return None
+
+
+# Tested in pytest
+@lru_cache(maxsize=1024)
+def cluster_bounds(text):
+    ''' Returns the index each grapheme of the text starts at, with a
+    final entry for the end of the text. A grapheme is what the user
+    sees as one character, like a letter and its accents'''
+
+    if text.isascii():
+        return range(len(text) + 1)
+    table = load_table()
+    bounds = [0]
+    previous = None
+    regional = 0
+    for i, char in enumerate(text):
+        code = ord(char)
+        if i > 0:
+            if table[code] & EXTEND:
+                pass
+            elif previous == ZWJ and table[code] & WIDTH == 2:
+                pass
+            elif code in REGIONAL and regional == 1:
+                regional = 2
+            else:
+                bounds.append(i)
+                regional = 0
+        if code in REGIONAL and regional == 0:
+            regional = 1
+        previous = code
+    if text:
+        bounds.append(len(text))
+    return tuple(bounds)
+
+
+# Tested in pytest
+@lru_cache(maxsize=1024)
+def columns(text):
+    ''' Returns the screen column each character of the text starts
+    at, with a final entry for the width of the text. Characters
+    inside a grapheme share the column it starts at'''
+
+    if text.isascii():
+        return range(len(text) + 1)
+    table = load_table()
+    bounds = cluster_bounds(text)
+    result = []
+    column = 0
+    for start, end in zip(bounds, bounds[1:]):
+        result.extend([column] * (end - start))
+        codes = [ord(char) for char in text[start:end]]
+        if len(codes) == 2 and codes[0] in REGIONAL and codes[1] in REGIONAL:
+            width = 2
+        else:
+            # A grapheme is as wide as its widest character
+            width = max(table[code] & WIDTH for code in codes)
+        column += width
+    result.append(column)
+    return tuple(result)
+
+
+def text_width(text):
+    ''' Returns the number of columns the text takes on screen'''
+
+    if text.isascii():
+        return len(text)
+    return columns(text)[-1]
+
+
+def grapheme_start(text, index):
+    ''' Returns where the grapheme holding the character at index starts'''
+
+    bounds = cluster_bounds(text)
+    return bounds[bisect_right(bounds, index) - 1]
+
+
+# Tested in pytest
+def wrap_columns(text, width):
+    ''' Wraps text into lines of at most width screen columns, keeping
+    spaces so the lines join back into the text. Breaks in the same
+    places as textwrap, but measures wide characters as two columns
+    and never splits a grapheme'''
+
+    text = text.expandtabs().translate(WHITESPACE)
+    chunks = [chunk for chunk in TextWrapper.wordsep_re.split(text) if chunk]
+    chunks.reverse()
+    lines = []
+    while chunks:
+        line = []
+        used = 0
+
+        # Fill the line with whole chunks while they fit
+        while chunks and used + text_width(chunks[-1]) <= width:
+            used += text_width(chunks[-1])
+            line.append(chunks.pop())
+
+        # Break a chunk too long for a line of its own at the last
+        # grapheme that fits, or a hyphen before it
+        if chunks and text_width(chunks[-1]) > width:
+            chunk = chunks[-1]
+            space_left = width - used if width >= 1 else 1
+            chunk_columns = columns(chunk)
+            end = 0
+            for bound in cluster_bounds(chunk)[1:]:
+                if chunk_columns[bound] > space_left:
+                    break
+                end = bound
+            hyphen = chunk.rfind("-", 0, end)
+            if hyphen > 0 and any(char != "-" for char in chunk[:hyphen]):
+                end = hyphen + 1
+            # A grapheme wider than the line goes on a line of its own
+            if end == 0 and len(line) == 0:
+                end = cluster_bounds(chunk)[1]
+            if end:
+                line.append(chunk[:end])
+                chunks[-1] = chunk[end:]
+
+        if line:
+            lines.append("".join(line))
+    return lines
+
+
+def wrap(text, width):
+    ''' Wraps a prompt to width screen columns, plain ASCII is left
+    to textwrap as every character takes one column'''
+
+    if text.isascii():
+        return wrap_ascii(text, width, drop_whitespace=False)
+    return wrap_columns(text, width)